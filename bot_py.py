@@ -1,18 +1,39 @@
 #!/usr/bin/env python3
 # -*- coding: utf-8 -*-
 
+import io
 import os
 import re
+import csv
+import sys
+import math
+import time
 import random
+import heapq
 import sqlite3
+import json
+import asyncio
+import hashlib
+import signal
+import unicodedata
+import zlib
 import itertools
-from datetime import datetime
+import tempfile
+import threading
+from collections import OrderedDict, deque
+from datetime import datetime, timedelta, timezone
 from typing import List, Optional, Dict
 from telegram import (
+    Bot,
     Update,
     InlineKeyboardMarkup,
-    InlineKeyboardButton
+    InlineKeyboardButton,
+    InlineQueryResultArticle,
+    InlineQueryResultsButton,
+    InputTextMessageContent,
 )
+from telegram.error import BadRequest
+from telegram.request import BaseRequest
 from telegram.constants import (
     ParseMode,
     ChatMemberStatus
@@ -23,6 +44,9 @@ from telegram.ext import (
     MessageHandler,
     CallbackQueryHandler,
     ConversationHandler,
+    InlineQueryHandler,
+    TypeHandler,
+    ApplicationHandlerStop,
     filters,
     ContextTypes,
 )
@@ -66,7 +90,7 @@ CLUBS_DB = {
         "Spain", "Portugal", "Netherlands", "Germany", "Argentina", "France", "England",
         "Italy", "Japan", "South Korea", "Morocco", "Croatia", "Norway", "Sweden", "Denmark"
     ],
-    "Other (Europe)": ["Olympiacos FC", "AEK Athens", "Celtic", "SK Slavia Praha", "Sparta Praha"
+    "Other (Europe)": ["Olympiacos FC", "AEK Athens", "Celtic", "SK Slavia Praha", "Sparta Praha",
         "Rangers FC", "Club Brugge", "RSC Anderlecht", "FC København", "PAOK", "Panathinaikos FC"
     ]
 }
@@ -124,10 +148,237 @@ DB_PATH = os.getenv("LEAGUE_DB", "/app/data/league_v3.db")
 os.makedirs(os.path.dirname(DB_PATH), exist_ok=True)
 
 def db():
-    conn = sqlite3.connect(DB_PATH, timeout=10, check_same_thread=False)
+    conn = sqlite3.connect(DB_PATH, timeout=10, check_same_thread=False,
+                           factory=TracedConnection if QUERY_TRACE else sqlite3.Connection)
     conn.row_factory = sqlite3.Row
     return conn
 
+# -------------------------
+# Трассировка SQL: медленные запросы
+# -------------------------
+# Каждый запрос через db() замеряется (выполнение и выборка fetch*) и учитывается
+# по форме - тексту без литералов и без длины списков IN (...). Для новой формы
+# один раз снимается EXPLAIN QUERY PLAN, так полные сканирования таблиц видны
+# сразу, а не когда таблица вырастет. Запросы дольше SLOW_QUERY_MS пишутся в
+# журнал с параметрами и вызывающей функцией. Статистика своя у каждого процесса.
+QUERY_TRACE = os.getenv("QUERY_TRACE", "1") == "1"
+SLOW_QUERY_MS = float(os.getenv("SLOW_QUERY_MS", "50"))
+SLOW_QUERY_FILE = os.getenv("SLOW_QUERY_FILE", "")  # JSON-строка на каждый медленный запрос
+SLOW_LOG_SIZE = 200
+QUERY_SHAPES_MAX = 1000
+
+_query_stats: Dict[str, dict] = {}
+_slow_log: deque = deque(maxlen=SLOW_LOG_SIZE)
+_shape_cache: Dict[str, str] = {}
+_trace_lock = threading.Lock()
+
+def query_shape(sql: str) -> str:
+    shape = _shape_cache.get(sql)
+    if shape is None:
+        shape = re.sub(r"\s+", " ", sql).strip()
+        shape = re.sub(r"'(?:[^']|'')*'", "?", shape)
+        shape = re.sub(r"\b\d+\b", "?", shape)
+        shape = re.sub(r"\(\s*\?(?:\s*,\s*\?)+\s*\)", "(?, ...)", shape)
+        if len(_shape_cache) < QUERY_SHAPES_MAX * 4:
+            _shape_cache[sql] = shape
+    return shape
+
+def explain_query(conn: sqlite3.Connection, sql: str, params) -> tuple:
+    """(план текстом, таблицы с полным сканированием) или (None, [])"""
+    if not sql.lstrip().upper().startswith(("SELECT", "INSERT", "UPDATE", "DELETE", "REPLACE", "WITH")):
+        return None, []
+    try:
+        rows = sqlite3.Connection.execute(conn, "EXPLAIN QUERY PLAN " + sql, params).fetchall()
+    except sqlite3.Error:
+        return None, []
+    # SCAN по CTE и подзапросам - не таблицы, их не считаем
+    tables = {r[0] for r in sqlite3.Connection.execute(conn, "SELECT name FROM sqlite_master WHERE type='table'")}
+    depth, lines, scans = {0: -1}, [], []
+    for node_id, parent, _, detail in rows:
+        depth[node_id] = depth.get(parent, -1) + 1
+        lines.append("  " * depth[node_id] + detail)
+        m = re.match(r"SCAN (\w+)", detail)
+        if m and "USING" not in detail and m.group(1) in tables:
+            scans.append(m.group(1))
+    return "\n".join(lines), scans
+
+def _query_caller() -> str:
+    f = sys._getframe(1)
+    while f is not None and f.f_code in _TRACE_CODES:
+        f = f.f_back
+    return f"{f.f_code.co_name}:{f.f_lineno}" if f is not None else "?"
+
+def _observe(conn: sqlite3.Connection, sql: str, params, seconds: float, caller: str):
+    ms = seconds * 1000
+    shape = query_shape(sql)
+    with _trace_lock:
+        stat = _query_stats.get(shape)
+        new = stat is None
+        if new:
+            if len(_query_stats) >= QUERY_SHAPES_MAX:
+                return
+            stat = _query_stats[shape] = {"count": 0, "total_ms": 0.0, "max_ms": 0.0, "slow": 0,
+                                          "caller": caller, "plan": None, "scans": []}
+        stat["count"] += 1
+        stat["total_ms"] += ms
+        stat["max_ms"] = max(stat["max_ms"], ms)
+    if new:
+        stat["plan"], stat["scans"] = explain_query(conn, sql, params)
+    if ms < SLOW_QUERY_MS:
+        return
+    stat["slow"] += 1
+    entry = {"at": datetime.now().isoformat(timespec="seconds"), "ms": round(ms, 1), "caller": caller,
+             "sql": shape, "params": repr(params)[:300], "plan": stat["plan"]}
+    _slow_log.append(entry)
+    print(f"🐢 SQL {ms:.0f} мс в {entry['caller']}: {shape[:200]} {entry['params']}")
+    if SLOW_QUERY_FILE:
+        try:
+            with open(SLOW_QUERY_FILE, "a", encoding="utf-8") as f:
+                f.write(json.dumps(entry, ensure_ascii=False) + "\n")
+        except OSError as e:
+            print(f"Ошибка записи журнала медленных запросов: {e}")
+
+class TracedCursor(sqlite3.Cursor):
+    """Курсор, замеряющий свои запросы; итог учитывается, когда выборка закончена"""
+    _trace = None  # [sql, параметры, секунды, вызывающая функция]
+
+    def execute(self, sql, parameters=()):
+        self._finish()
+        # Вызывающего ищем сейчас: учтен запрос будет позже, из следующего execute или close
+        caller = _query_caller()
+        t0 = time.perf_counter()
+        try:
+            super().execute(sql, parameters)
+        except sqlite3.Error:
+            _observe(self.connection, sql, parameters, time.perf_counter() - t0, caller)
+            raise
+        self._trace = [sql, parameters, time.perf_counter() - t0, caller]
+        if self.description is None:
+            self._finish()
+        else:
+            self.connection._pending[id(self)] = self  # досчитаем при fetchall/закрытии
+        return self
+
+    def executemany(self, sql, seq_of_parameters):
+        self._finish()
+        if not isinstance(seq_of_parameters, (list, tuple)):
+            seq_of_parameters = list(seq_of_parameters)
+        caller = _query_caller()
+        t0 = time.perf_counter()
+        super().executemany(sql, seq_of_parameters)
+        _observe(self.connection, sql, seq_of_parameters[0] if seq_of_parameters else (),
+                 time.perf_counter() - t0, caller)
+        return self
+
+    def fetchone(self):
+        t0 = time.perf_counter()
+        row = super().fetchone()
+        if self._trace:
+            self._trace[2] += time.perf_counter() - t0
+        return row
+
+    def fetchmany(self, size: int = 1):
+        t0 = time.perf_counter()
+        rows = super().fetchmany(size)
+        if self._trace:
+            self._trace[2] += time.perf_counter() - t0
+        return rows
+
+    def fetchall(self):
+        t0 = time.perf_counter()
+        rows = super().fetchall()
+        if self._trace:
+            self._trace[2] += time.perf_counter() - t0
+        self._finish()
+        return rows
+
+    def close(self):
+        self._finish()
+        super().close()
+
+    def _finish(self):
+        trace, self._trace = self._trace, None
+        if trace:
+            self.connection._pending.pop(id(self), None)
+            _observe(self.connection, *trace)
+
+class TracedConnection(sqlite3.Connection):
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._pending: Dict[int, TracedCursor] = {}
+
+    def cursor(self, factory=TracedCursor):
+        return super().cursor(factory)
+
+    def execute(self, sql, parameters=()):
+        return self.cursor().execute(sql, parameters)
+
+    def executemany(self, sql, seq_of_parameters):
+        return self.cursor().executemany(sql, seq_of_parameters)
+
+    def close(self):
+        for cursor in list(self._pending.values()):
+            cursor._finish()
+        super().close()
+
+# Кадры самой трассировки - вызывающую функцию ищем выше них
+_TRACE_CODES = {f.__code__ for cls in (TracedCursor, TracedConnection) for f in vars(cls).values()
+                if callable(f)} | {_query_caller.__code__}
+
+def query_stats_info() -> dict:
+    with _trace_lock:
+        stats = list(_query_stats.values())
+    return {"shapes": len(stats), "statements": sum(s["count"] for s in stats),
+            "slow": sum(s["slow"] for s in stats), "scans": sum(1 for s in stats if s["scans"])}
+
+def query_stats_dump() -> dict:
+    with _trace_lock:
+        shapes = [{"sql": sql, **stat} for sql, stat in _query_stats.items()]
+    shapes.sort(key=lambda s: -s["total_ms"])
+    return {"threshold_ms": SLOW_QUERY_MS, "shard": list(WORKER_SHARD) if WORKER_SHARD else None,
+            "shapes": shapes, "slow": list(_slow_log)}
+
+def reset_query_stats():
+    with _trace_lock:
+        _query_stats.clear()
+        _slow_log.clear()
+
+def format_query_report(top: int = 8) -> str:
+    """Текст для /slowqueries: самые затратные формы, полные сканирования, последние медленные"""
+    dump = query_stats_dump()
+    info = query_stats_info()
+    lines = [f"🐢 SQL: {info['statements']} запросов, {info['shapes']} видов, "
+             f"медленных (от {SLOW_QUERY_MS:.0f} мс): {info['slow']}"]
+    if WORKER_SHARD:
+        lines.append(f"Воркер {WORKER_SHARD[0] + 1} из {WORKER_SHARD[1]}")
+    if not dump["shapes"]:
+        return lines[0] + "\nЗапросов еще не было."
+    lines.append("\nПо суммарному времени:")
+    for i, s in enumerate(dump["shapes"][:top], 1):
+        scan = f" · ⚠️ SCAN {', '.join(s['scans'])}" if s["scans"] else ""
+        lines.append(f"{i}. {s['total_ms']:.0f} мс = {s['count']} × {s['total_ms'] / s['count']:.1f} "
+                     f"(макс {s['max_ms']:.0f}) · {s['caller']}{scan}")
+        lines.append(f"   {s['sql'][:160]}")
+    scanned: Dict[str, list] = {}
+    for s in dump["shapes"]:
+        for table in s["scans"]:
+            scanned.setdefault(table, []).append(s)
+    if scanned:
+        lines.append("\nПолные сканирования таблиц:")
+        for table, shapes in sorted(scanned.items(), key=lambda kv: -sum(s["count"] for s in kv[1])):
+            callers = ", ".join(sorted({s["caller"].split(":")[0] for s in shapes})[:4])
+            lines.append(f"• {table}: видов {len(shapes)}, выполнений {sum(s['count'] for s in shapes)} ({callers})")
+    if dump["slow"]:
+        lines.append("\nПоследние медленные:")
+        for e in dump["slow"][-5:]:
+            lines.append(f"• {e['at'][11:]} {e['ms']:.0f} мс {e['caller']} {e['params'][:60]}")
+    text = "\n".join(lines)
+    return text if len(text) <= 4000 else text[:3990] + "\n…"
+
+# Номер схемы в PRAGMA user_version: совпал - база уже мигрирована и init_db
+# не гоняет DDL и проверки колонок. Увеличивать при любом изменении init_db
+SCHEMA_VERSION = 1
+
 def init_db():
     conn = db()
     c = conn.cursor()
@@ -135,6 +386,9 @@ def init_db():
     c.execute("PRAGMA journal_mode=WAL;")
     c.execute("PRAGMA synchronous=NORMAL;")
     c.execute("PRAGMA foreign_keys=ON;")
+    if c.execute("PRAGMA user_version").fetchone()[0] == SCHEMA_VERSION:
+        conn.close()
+        return
 
     # Создаем основные таблицы
     c.execute("""
@@ -181,11 +435,99 @@ def init_db():
     );
     """)
 
+    # Закрепленная "живая" таблица турнира, обновляемая на месте
+    c.execute("""
+    CREATE TABLE IF NOT EXISTS live_tables (
+        tournament_id INTEGER PRIMARY KEY,
+        chat_id INTEGER NOT NULL,
+        message_id INTEGER NOT NULL,
+        FOREIGN KEY(tournament_id) REFERENCES tournaments(id) ON DELETE CASCADE
+    );
+    """)
+
+    # Журнал результатов (только добавление) и периодические снимки для его перемотки
+    c.execute("""
+    CREATE TABLE IF NOT EXISTS match_events (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        tournament_id INTEGER NOT NULL,
+        seq INTEGER NOT NULL,
+        match_id INTEGER NOT NULL,
+        kind TEXT NOT NULL,
+        home_goals INTEGER,
+        away_goals INTEGER,
+        prev_home_goals INTEGER,
+        prev_away_goals INTEGER,
+        user_id INTEGER,
+        undoes_seq INTEGER,
+        created_at TEXT NOT NULL,
+        FOREIGN KEY(tournament_id) REFERENCES tournaments(id) ON DELETE CASCADE
+    );
+    """)
+
+    c.execute("""
+    CREATE TABLE IF NOT EXISTS standings_snapshots (
+        tournament_id INTEGER NOT NULL,
+        seq INTEGER NOT NULL,
+        state TEXT NOT NULL,
+        PRIMARY KEY(tournament_id, seq),
+        FOREIGN KEY(tournament_id) REFERENCES tournaments(id) ON DELETE CASCADE
+    );
+    """)
+
+    # Версия данных турнира для инвалидации кэшей (статистика, таблицы)
+    c.execute("""
+    CREATE TABLE IF NOT EXISTS data_versions (
+        tournament_id INTEGER PRIMARY KEY,
+        version INTEGER NOT NULL DEFAULT 0,
+        FOREIGN KEY(tournament_id) REFERENCES tournaments(id) ON DELETE CASCADE
+    );
+    """)
+
+    # Сроки туров: напоминание заранее и (по желанию) техническая ничья после срока
+    c.execute("""
+    CREATE TABLE IF NOT EXISTS deadlines (
+        tournament_id INTEGER NOT NULL,
+        round_no INTEGER NOT NULL,
+        due_at TEXT NOT NULL,
+        reminded INTEGER DEFAULT 0,
+        expired INTEGER DEFAULT 0,
+        PRIMARY KEY(tournament_id, round_no),
+        FOREIGN KEY(tournament_id) REFERENCES tournaments(id) ON DELETE CASCADE
+    );
+    """)
+
+    # Чаты, где пользователь общался с ботом - для инлайн-запросов (ключ начинается с user_id)
+    c.execute("""
+    CREATE TABLE IF NOT EXISTS chat_users (
+        user_id INTEGER NOT NULL,
+        chat_id INTEGER NOT NULL,
+        last_seen TEXT NOT NULL,
+        PRIMARY KEY(user_id, chat_id)
+    );
+    """)
+
+    # Результаты, заявленные игроком и ждущие подтверждения соперника (один на матч)
+    c.execute("""
+    CREATE TABLE IF NOT EXISTS pending_results (
+        match_id INTEGER PRIMARY KEY,
+        tournament_id INTEGER NOT NULL,
+        home_goals INTEGER NOT NULL,
+        away_goals INTEGER NOT NULL,
+        reporter_id INTEGER NOT NULL,
+        chat_id INTEGER NOT NULL,
+        due_at TEXT NOT NULL,
+        FOREIGN KEY(tournament_id) REFERENCES tournaments(id) ON DELETE CASCADE
+    );
+    """)
+
     # Создаем индексы
     c.execute("CREATE INDEX IF NOT EXISTS idx_tournaments_chat ON tournaments(chat_id, created_at DESC);")
     c.execute("CREATE INDEX IF NOT EXISTS idx_players_tid ON players(tournament_id);")
     c.execute("CREATE INDEX IF NOT EXISTS idx_matches_tid ON matches(tournament_id);")
     c.execute("CREATE INDEX IF NOT EXISTS idx_matches_tid_played ON matches(tournament_id, played, match_number);")
+    c.execute("CREATE INDEX IF NOT EXISTS idx_matches_pair ON matches(home, away);")
+    c.execute("CREATE UNIQUE INDEX IF NOT EXISTS idx_events_tid_seq ON match_events(tournament_id, seq);")
+    c.execute("CREATE INDEX IF NOT EXISTS idx_events_undoes ON match_events(tournament_id, undoes_seq);")
     
     # Проверяем и добавляем колонку match_number если её нет
     c.execute("PRAGMA table_info(matches)")
@@ -198,9 +540,37 @@ def init_db():
         WHERE match_number IS NULL OR match_number = 0
         """)
 
+    # Форматы турниров: группы, сетки плей-офф со ссылками на следующий матч
+    ensure_column(c, "tournaments", "format", "TEXT DEFAULT 'league'")
+    ensure_column(c, "tournaments", "group_size", "INTEGER DEFAULT 4")
+    ensure_column(c, "tournaments", "group_advance", "INTEGER DEFAULT 2")
+    ensure_column(c, "tournaments", "swiss_rounds", "INTEGER")
+    ensure_column(c, "tournaments", "tiebreaks", "TEXT")
+    ensure_column(c, "tournaments", "auto_forfeit", "INTEGER DEFAULT 0")
+    ensure_column(c, "players", "fair_play", "INTEGER DEFAULT 0")
+    ensure_column(c, "live_tables", "version", "INTEGER DEFAULT 0")  # версия данных в закрепе
+    ensure_column(c, "players", "group_name", "TEXT")
+    ensure_column(c, "players", "user_id", "INTEGER")  # привязка к аккаунту Telegram
+    ensure_column(c, "matches", "stage", "TEXT DEFAULT 'league'")
+    ensure_column(c, "matches", "round_no", "INTEGER")
+    ensure_column(c, "matches", "group_name", "TEXT")
+    ensure_column(c, "matches", "next_match_id", "INTEGER")
+    ensure_column(c, "matches", "next_slot", "TEXT")
+    ensure_column(c, "matches", "loser_match_id", "INTEGER")
+    ensure_column(c, "matches", "loser_slot", "TEXT")
+    c.execute("CREATE INDEX IF NOT EXISTS idx_matches_tid_stage ON matches(tournament_id, stage, round_no);")
+    c.execute("CREATE INDEX IF NOT EXISTS idx_players_user ON players(user_id, tournament_id);")
+
+    c.execute(f"PRAGMA user_version={SCHEMA_VERSION}")
     conn.commit()
     conn.close()
 
+def ensure_column(c: sqlite3.Cursor, table: str, column: str, ddl: str):
+    """Добавляет колонку в таблицу, если её еще нет (миграция старых БД)"""
+    c.execute(f"PRAGMA table_info({table})")
+    if column not in [row[1] for row in c.fetchall()]:
+        c.execute(f"ALTER TABLE {table} ADD COLUMN {column} {ddl}")
+
 async def is_admin(update: Update, context: ContextTypes.DEFAULT_TYPE) -> bool:
     """Проверяет, является ли пользователь администратором"""
     chat = update.effective_chat
@@ -211,32 +581,181 @@ async def is_admin(update: Update, context: ContextTypes.DEFAULT_TYPE) -> bool:
     if not user:
         return False
     
+    listed = _chat_admins.get(chat.id)
+    if listed and time.monotonic() - listed[0] < ADMIN_LIST_TTL:
+        return user.id in listed[1]
+
+    key = (chat.id, user.id)
+    cached = _admin_cache.get(key)
+    if cached and time.monotonic() - cached[0] < ADMIN_CACHE_TTL:
+        return cached[1]
+
     try:
         member = await context.bot.get_chat_member(chat.id, user.id)
-        return member.status in (ChatMemberStatus.OWNER, ChatMemberStatus.ADMINISTRATOR)
+        result = member.status in (ChatMemberStatus.OWNER, ChatMemberStatus.ADMINISTRATOR)
     except Exception as e:
         print(f"Ошибка проверки прав администратора: {e}")
-        return False   
+        return False
+    _admin_cache[key] = (time.monotonic(), result)
+    return result
+
+async def load_chat_admins(bot, chat_id: int) -> bool:
+    """Один запрос списка админов отвечает is_admin для всех участников чата"""
+    try:
+        members = await bot.get_chat_administrators(chat_id)
+    except Exception as e:
+        print(f"Ошибка загрузки админов чата {chat_id}: {e}")
+        return False
+    _chat_admins[chat_id] = (time.monotonic(), frozenset(m.user.id for m in members))
+    return True
+
+# -------------------------
+# Защита от повторных нажатий и флуда
+# -------------------------
+# Фильтр стоит первым (группа -2): дубль нажатия той же кнопки тем же
+# пользователем и превышение лимита отсекаются до похода в Telegram и базу.
+# Лимиты - корзины токенов на пользователя и на чат.
+INPUT_GUARD = os.getenv("INPUT_GUARD", "1") == "1"
+DEDUP_WINDOW = float(os.getenv("DEDUP_WINDOW", "1.5"))  # сек
+USER_RATE, USER_BURST = 1.0, 6    # токенов в секунду / запас
+CHAT_RATE, CHAT_BURST = 5.0, 20
+ADMIN_CACHE_TTL = 30              # сек - статус админа почти не меняется
+ADMIN_LIST_TTL = 120              # сек - список админов чата, загруженный прогревом
+GUARD_SWEEP_EVERY = 60
+
+class TokenBucket:
+    __slots__ = ("tokens", "stamp", "warned")
+
+    def __init__(self, burst: int):
+        self.tokens = float(burst)
+        self.stamp = time.monotonic()
+        self.warned = False
+
+    def take(self, rate: float, burst: int, now: float) -> bool:
+        self.tokens = min(burst, self.tokens + (now - self.stamp) * rate)
+        self.stamp = now
+        if self.tokens >= 1:
+            self.tokens -= 1
+            self.warned = False
+            return True
+        return False
+
+_user_buckets: Dict[int, TokenBucket] = {}
+_chat_buckets: Dict[int, TokenBucket] = {}
+_recent_presses: Dict[tuple, float] = {}   # (чат, пользователь, данные кнопки) -> время
+_admin_cache: Dict[tuple, tuple] = {}      # (чат, пользователь) -> (время, админ ли)
+_chat_admins: Dict[int, tuple] = {}        # чат -> (время, id админов)
+_guard_stats = {"deduped": 0, "limited": 0}
+_guard_swept = 0.0
+
+def _sweep_guard(now: float):
+    global _guard_swept
+    if now - _guard_swept < GUARD_SWEEP_EVERY:
+        return
+    _guard_swept = now
+    for key in [k for k, t in _recent_presses.items() if now - t > DEDUP_WINDOW]:
+        del _recent_presses[key]
+    # Полная корзина ничем не отличается от новой
+    for buckets, rate, burst in ((_user_buckets, USER_RATE, USER_BURST), (_chat_buckets, CHAT_RATE, CHAT_BURST)):
+        for key in [k for k, b in buckets.items() if now - b.stamp > burst / rate]:
+            del buckets[key]
+    for key in [k for k, (t, _) in _admin_cache.items() if now - t > ADMIN_CACHE_TTL]:
+        del _admin_cache[key]
+    for key in [k for k, (t, _) in _chat_admins.items() if now - t > ADMIN_LIST_TTL]:
+        del _chat_admins[key]
+    # Отметка старше CHAT_USER_REFRESH уже не избавляет от записи в chat_users
+    for key in [k for k, t in _chat_users_seen.items() if now - t >= CHAT_USER_REFRESH]:
+        del _chat_users_seen[key]
+
+def is_repeated_press(chat_id: int, user_id: int, data: str) -> bool:
+    now = time.monotonic()
+    _sweep_guard(now)
+    key = (chat_id, user_id, data)
+    last = _recent_presses.get(key)
+    _recent_presses[key] = now
+    return last is not None and now - last < DEDUP_WINDOW
+
+def take_token(chat_id: int, user_id: int) -> Optional[TokenBucket]:
+    """Списывает токен; возвращает исчерпанную корзину или None, если можно"""
+    now = time.monotonic()
+    bucket = _user_buckets.setdefault(user_id, TokenBucket(USER_BURST))
+    if not bucket.take(USER_RATE, USER_BURST, now):
+        return bucket
+    bucket = _chat_buckets.setdefault(chat_id, TokenBucket(CHAT_BURST))
+    if not bucket.take(CHAT_RATE, CHAT_BURST, now):
+        return bucket
+    return None
+
+def guard_info() -> dict:
+    return {**_guard_stats, "users": len(_user_buckets), "chats": len(_chat_buckets)}
+
+async def input_guard(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Отсекает повторные нажатия и флуд кнопками и командами"""
+    user, chat, query = update.effective_user, update.effective_chat, update.callback_query
+    if not user or not chat:
+        return
+    if query:
+        if is_repeated_press(chat.id, user.id, query.data or ""):
+            _guard_stats["deduped"] += 1
+            await query.answer()
+            raise ApplicationHandlerStop
+    elif not (update.message and update.message.text and update.message.text.startswith("/")):
+        return
+
+    exhausted = take_token(chat.id, user.id)
+    if exhausted is None:
+        return
+    _guard_stats["limited"] += 1
+    # Просим притормозить один раз, дальше молча
+    text = None if exhausted.warned else "⏳ Слишком часто. Подождите пару секунд."
+    exhausted.warned = True
+    if query:
+        await query.answer(text)
+    elif text:
+        await update.message.reply_text(text)
+    raise ApplicationHandlerStop
+
+# Текущий турнир чата: chat_id -> строка турнира (или None, если турнир не выбран).
+# Запросы к нему идут по нескольку раз на каждое обновление, поэтому держим в памяти.
+_current_tournament_cache: Dict[int, Optional[sqlite3.Row]] = {}
+_current_tournament_stats = {"hits": 0, "misses": 0}
+
+def _load_current_tournament(c: sqlite3.Cursor, chat_id: int) -> Optional[sqlite3.Row]:
+    c.execute("""
+        SELECT t.* FROM tournaments t
+        JOIN chat_current_tournament cct ON t.id = cct.tournament_id
+        WHERE cct.chat_id = ?
+    """, (chat_id,))
+    return c.fetchone()
 
 def get_current_tournament(chat_id: int) -> Optional[sqlite3.Row]:
     """Получает текущий выбранный турнир для чата"""
+    if chat_id in _current_tournament_cache:
+        _current_tournament_stats["hits"] += 1
+        return _current_tournament_cache[chat_id]
+    _current_tournament_stats["misses"] += 1
     try:
         conn = db()
-        c = conn.cursor()
-        c.execute("""
-            SELECT t.* FROM tournaments t
-            JOIN chat_current_tournament cct ON t.id = cct.tournament_id
-            WHERE cct.chat_id = ?
-        """, (chat_id,))
-        row = c.fetchone()
+        row = _load_current_tournament(conn.cursor(), chat_id)
         conn.close()
+        _current_tournament_cache[chat_id] = row
         return row
     except Exception as e:
         print(f"Ошибка получения текущего турнира: {e}")
         return None
 
+def forget_tournament(tournament_id: int):
+    """Сбрасывает кэш чатов, где этот турнир текущий (после изменения его настроек)"""
+    for chat_id, row in list(_current_tournament_cache.items()):
+        if row is not None and row["id"] == tournament_id:
+            del _current_tournament_cache[chat_id]
+
+def current_tournament_cache_info() -> dict:
+    return {**_current_tournament_stats, "size": len(_current_tournament_cache)}
+
 def set_current_tournament(chat_id: int, tournament_id: int):
     """Устанавливает текущий турнир для чата"""
+    _current_tournament_cache.pop(chat_id, None)
     try:
         conn = db()
         c = conn.cursor()
@@ -245,10 +764,20 @@ def set_current_tournament(chat_id: int, tournament_id: int):
             VALUES (?, ?)
         """, (chat_id, tournament_id))
         conn.commit()
+        _current_tournament_cache[chat_id] = _load_current_tournament(c, chat_id)
         conn.close()
     except Exception as e:
         print(f"Ошибка установки текущего турнира: {e}")
 
+def clear_current_tournament(chat_id: int):
+    """Снимает выбор текущего турнира (после завершения)"""
+    conn = db()
+    c = conn.cursor()
+    c.execute("DELETE FROM chat_current_tournament WHERE chat_id=?", (chat_id,))
+    conn.commit()
+    conn.close()
+    _current_tournament_cache[chat_id] = None
+
 def get_chat_tournaments(chat_id: int) -> List[sqlite3.Row]:
     """Получает все турниры для чата"""
     try:
@@ -266,6 +795,52 @@ def get_chat_tournaments(chat_id: int) -> List[sqlite3.Row]:
         print(f"Ошибка получения турниров чата: {e}")
         return []
 
+def get_tournament(tournament_id: int) -> Optional[sqlite3.Row]:
+    conn = db()
+    c = conn.cursor()
+    c.execute("SELECT * FROM tournaments WHERE id=?", (tournament_id,))
+    row = c.fetchone()
+    conn.close()
+    return row
+
+def _bump_data_version(c: sqlite3.Cursor, tournament_id: int):
+    """Версия данных турнира растет при каждом изменении; по ней сбрасываются кэши"""
+    c.execute("""
+        INSERT INTO data_versions (tournament_id, version) VALUES (?, 1)
+        ON CONFLICT(tournament_id) DO UPDATE SET version = version + 1
+    """, (tournament_id,))
+
+def get_data_version(tournament_id: int) -> int:
+    conn = db()
+    c = conn.cursor()
+    c.execute("SELECT version FROM data_versions WHERE tournament_id=?", (tournament_id,))
+    row = c.fetchone()
+    conn.close()
+    return row["version"] if row else 0
+
+# Готовые тексты таблиц, расписаний и клавиатуры. Ключ включает версию данных турнира,
+# поэтому после любой записи старые элементы просто перестают запрашиваться и вытесняются.
+RENDER_CACHE_SIZE = int(os.getenv("RENDER_CACHE_SIZE", "256"))
+_render_cache: "OrderedDict[tuple, object]" = OrderedDict()
+_render_stats = {"hits": 0, "misses": 0}
+
+def cached_render(tournament_id: int, kind: str, build, *args):
+    """Результат build() для текущей версии турнира. Кэшированное значение не изменять"""
+    key = (tournament_id, get_data_version(tournament_id), kind) + args
+    if key in _render_cache:
+        _render_stats["hits"] += 1
+        _render_cache.move_to_end(key)
+        return _render_cache[key]
+    _render_stats["misses"] += 1
+    value = build()
+    _render_cache[key] = value
+    if len(_render_cache) > RENDER_CACHE_SIZE:
+        _render_cache.popitem(last=False)
+    return value
+
+def render_cache_info() -> dict:
+    return {**_render_stats, "size": len(_render_cache)}
+
 def match_no(row: sqlite3.Row) -> int:
     try:
         n = row['match_number']
@@ -297,6 +872,7 @@ def add_player(tournament_id: int, name: str):
     conn = db()
     c = conn.cursor()
     c.execute("INSERT INTO players (tournament_id, name) VALUES (?, ?)", (tournament_id, name))
+    _bump_data_version(c, tournament_id)
     conn.commit()
     conn.close()
 
@@ -304,6 +880,7 @@ def assign_club(tournament_id: int, name: str, club: str):
     conn = db()
     c = conn.cursor()
     c.execute("UPDATE players SET club=? WHERE tournament_id=? AND name=?", (club, tournament_id, name))
+    _bump_data_version(c, tournament_id)
     conn.commit()
     conn.close()
 
@@ -340,1205 +917,5878 @@ def get_player_club(tournament_id: int, name: str) -> Optional[str]:
     conn.close()
     return row["club"] if row and row["club"] else None
 
-def assign_random_clubs(tournament_id: int):
-    players = get_players(tournament_id)
-    all_clubs = [club for clubs in CLUBS_DB.values() for club in clubs]
-    random.shuffle(all_clubs)
+# Сила клубов: 1 - топ, 4 - аутсайдеры; кого нет в списке - уровень 3
+CLUB_TIERS = {
+    1: ["Real Madrid", "Barcelona", "Manchester City", "Liverpool", "Arsenal", "Chelsea",
+        "Manchester United", "Bayern Munich", "Bayer Leverkusen", "Borussia Dortmund",
+        "Paris Saint-Germain", "Inter Milan", "AC Milan", "Juventus", "Napoli", "Atletico Madrid",
+        "Spain", "France", "England", "Portugal", "Argentina", "Germany", "Netherlands", "Italy"],
+    2: ["Tottenham Hotspur", "Newcastle United", "Aston Villa", "Brighton", "West Ham United",
+        "Atalanta", "Roma", "Fiorentina", "Bologna", "Leipzig", "Stuttgart", "Frankfurt",
+        "Athletic Bilbao", "Real Sociedad", "Villarreal", "Sevilla", "Real Betis", "Girona",
+        "Lyon", "Olympique de Marseille", "AS Monaco", "Lille", "Benfica", "Sporting", "PSV",
+        "Ajax", "Feyenoord", "Galatasaray", "Fenerbahçe", "Al Hilal", "Al Nassr",
+        "Croatia", "Morocco", "Denmark"],
+    4: ["Ipswich Town", "Southampton", "Leicester", "Como", "Monza", "Lecce", "Cagliari", "Parma",
+        "Hellas Verona FC", "FC Augsburg", "Las Palmas", "CD Leganés", "Deportivo Alavés",
+        "RCD Espanyol", "Getafe", "Montpellier", "Stade Brestois", "FC Nantes", "SK Slavia Praha",
+        "Sparta Praha", "PAOK", "Panathinaikos FC", "AEK Athens", "Al Ahli", "Al Ittihad",
+        "Japan", "South Korea", "Norway", "Sweden"],
+}
+TIER_COUNT = 4
+_club_tier = {club: tier for tier, clubs in CLUB_TIERS.items() for club in clubs}
+
+DRAW_MODES = {
+    "balanced": "⚖️ Равная корзина",
+    "handicap": "🎯 С гандикапом",
+    "random": "🎲 Случайно",
+}
+
+def club_tier(club: str) -> int:
+    return _club_tier.get(club, 3)
+
+def _max_assignment(options: Dict[int, List[str]], country_of: Dict[str, str], cap: int) -> Dict[int, str]:
+    """Максимальное паросочетание игрок -> клуб, не больше cap клубов одной страны.
+    Поток Эдмондса-Карпа: исток -> игрок -> клуб -> страна (емкость cap) -> сток"""
+    graph: Dict[object, Dict[object, int]] = {"s": {}, "t": {}}
+
+    def edge(u, v, capacity: int):
+        graph.setdefault(u, {})[v] = capacity
+        graph.setdefault(v, {}).setdefault(u, 0)
+
+    for pid, clubs in options.items():
+        edge("s", ("p", pid), 1)
+        for club in clubs:
+            edge(("p", pid), ("c", club), 1)
+            edge(("c", club), ("k", country_of[club]), 1)
+            edge(("k", country_of[club]), "t", cap)
+
+    while True:
+        parent = {"s": None}
+        queue = deque(["s"])
+        while queue and "t" not in parent:
+            u = queue.popleft()
+            for v, capacity in graph[u].items():
+                if capacity > 0 and v not in parent:
+                    parent[v] = u
+                    queue.append(v)
+        if "t" not in parent:
+            break
+        v = "t"
+        while parent[v] is not None:
+            u = parent[v]
+            graph[u][v] -= 1
+            graph[v][u] += 1
+            v = u
+    # Поток по ребру игрок -> клуб виден как остаток на обратном ребре
+    return {pid: club for pid, clubs in options.items() for club in clubs if graph[("c", club)][("p", pid)]}
+
+def _previous_clubs(c: sqlite3.Cursor, chat_id: int, tournament_id: int) -> Dict[str, set]:
+    c.execute("""
+        SELECT p.name, p.club FROM players p JOIN tournaments t ON t.id = p.tournament_id
+        WHERE t.chat_id=? AND p.tournament_id<>? AND p.club IS NOT NULL AND p.club<>''
+    """, (chat_id, tournament_id))
+    previous: Dict[str, set] = {}
+    for name, club in c.fetchall():
+        previous.setdefault(_name_key(name), set()).add(club)
+    return previous
+
+def _player_ratings(c: sqlite3.Cursor, chat_id: int, tournament_id: int) -> Dict[str, float]:
+    """Очки за матч в прошлых турнирах чата"""
+    c.execute("""
+        WITH sides AS (
+            SELECT m.home AS name, m.home_goals AS gf, m.away_goals AS ga
+            FROM matches m JOIN tournaments t ON t.id = m.tournament_id
+            WHERE t.chat_id=? AND m.tournament_id<>? AND m.played=1 AND m.away<>'' AND m.home_goals IS NOT NULL
+            UNION ALL
+            SELECT m.away, m.away_goals, m.home_goals
+            FROM matches m JOIN tournaments t ON t.id = m.tournament_id
+            WHERE t.chat_id=? AND m.tournament_id<>? AND m.played=1 AND m.away<>'' AND m.home_goals IS NOT NULL
+        )
+        SELECT name, AVG(CASE WHEN gf>ga THEN 3.0 WHEN gf=ga THEN 1.0 ELSE 0.0 END) FROM sides GROUP BY name
+    """, (chat_id, tournament_id, chat_id, tournament_id))
+    ratings: Dict[str, float] = {}
+    for name, rating in c.fetchall():
+        ratings[_name_key(name)] = rating
+    return ratings
+
+def _draw_clubs(c: sqlite3.Cursor, tournament_id: int, mode: str = "balanced",
+                rnd: random.Random = random) -> tuple:
+    """Жеребьевка клубов: ({id игрока: клуб}, заметки об ослабленных условиях).
+
+    balanced - всем клубы из одной корзины (сильнейшей, какой хватает);
+    handicap - игроки по рейтингу делятся на корзины, сильным достаются слабые клубы.
+    Условия: не больше ceil(N / стран) клубов одной страны и без клубов, которые у
+    игрока уже были в этом чате. Если так не выходит, корзина расширяется на соседние
+    уровни, а затем условия снимаются по одному.
+    """
+    c.execute("SELECT id, name FROM players WHERE tournament_id=? ORDER BY id", (tournament_id,))
+    players = c.fetchall()
+    country_of = {club: country for country, clubs in CLUBS_DB.items() for club in clubs}
+    if mode == "random" or not players:
+        chosen = rnd.sample(list(country_of), min(len(players), len(country_of)))
+        return {p["id"]: club for p, club in zip(players, chosen)}, []
+
+    c.execute("SELECT chat_id FROM tournaments WHERE id=?", (tournament_id,))
+    chat_id = c.fetchone()["chat_id"]
+    previous = _previous_clubs(c, chat_id, tournament_id)
+    players = list(players)
+    rnd.shuffle(players)
+
+    target = {p["id"]: 1 for p in players}
+    notes = []
+    if mode == "handicap":
+        ratings = _player_ratings(c, chat_id, tournament_id)
+        known = list(ratings.values())
+        default = sum(known) / len(known) if known else 0.0
+        score = {p["id"]: ratings.get(_name_key(p["name"]), default) for p in players}
+        if len(set(score.values())) < 2:
+            mode = "balanced"
+            notes.append("рейтинга по прошлым турнирам нет - всем одна корзина")
+    if mode == "handicap":
+        ranked = sorted(players, key=lambda p: -score[p["id"]])
+        pots = min(TIER_COUNT, len(ranked))
+        for i, p in enumerate(ranked):
+            target[p["id"]] = pots - i * pots // len(ranked)  # первая корзина - самый слабый уровень
+
+    clubs = list(country_of)
+    levels = ((True, True, None),
+              (True, False, "клубов одной страны больше обычного"),
+              (False, False, "кому-то выпал прошлый клуб"))
+    if len(players) > len(clubs):
+        levels = levels[-1:]  # всем не хватит при любых условиях
+    for no_repeat, country_cap, note in levels:
+        for slack in range(TIER_COUNT):
+            options = {}
+            for p in players:
+                seen = previous.get(_name_key(p["name"]), set()) if no_repeat else set()
+                allowed = [cl for cl in clubs if abs(club_tier(cl) - target[p["id"]]) <= slack and cl not in seen]
+                rnd.shuffle(allowed)
+                options[p["id"]] = allowed
+            countries = {country_of[cl] for allowed in options.values() for cl in allowed}
+            cap = -(-len(players) // max(len(countries), 1)) if country_cap else len(players)
+            assigned = _max_assignment(options, country_of, cap)
+            if len(assigned) == len(players):
+                if note:
+                    notes.append(note)
+                if slack:
+                    notes.append(f"корзина расширена на {slack} ур.")
+                return assigned, notes
+    # Клубов меньше, чем игроков: раздаем сколько есть
+    return assigned, notes + ["клубов на всех не хватило"]
+
+def assign_random_clubs(tournament_id: int, mode: str = "balanced") -> tuple:
+    """Жеребьевка клубов одной транзакцией. Возвращает ({имя: клуб}, заметки)"""
     conn = db()
-    c = conn.cursor()
-    for i, player in enumerate(players):
-        if i < len(all_clubs):
-            c.execute("UPDATE players SET club=? WHERE id=?", (all_clubs[i], player["id"]))
-    conn.commit()
-    conn.close()
+    try:
+        with conn:
+            c = conn.cursor()
+            assigned, notes = _draw_clubs(c, tournament_id, mode)
+            c.executemany("UPDATE players SET club=? WHERE id=?", [(club, pid) for pid, club in assigned.items()])
+            _bump_data_version(c, tournament_id)
+            c.execute("SELECT id, name FROM players WHERE tournament_id=?", (tournament_id,))
+            names = {r["id"]: r["name"] for r in c.fetchall()}
+    finally:
+        conn.close()
+    return {names[pid]: club for pid, club in assigned.items()}, notes
 
-def generate_schedule(tournament_id: int, rounds: int):
+TOURNAMENT_FORMATS = {
+    "league": "🔄 Круговой турнир",
+    "single_elim": "🥊 Олимпийка (на вылет)",
+    "double_elim": "⚔️ Double elimination",
+    "groups_playoff": "🏟 Группы + плей-офф",
+    "swiss": "♟ Швейцарская система",
+}
+
+# Стадии, в которых ничья невозможна и победитель проходит дальше
+KNOCKOUT_STAGES = ("winners", "losers", "final", "playoff")
+
+class ResultError(Exception):
+    """Результат нельзя записать (ничья в плей-офф, не определены соперники и т.п.)"""
+
+def set_tournament_format(tournament_id: int, fmt: str):
     conn = db()
     c = conn.cursor()
-    
-    c.execute("DELETE FROM matches WHERE tournament_id=?", (tournament_id,))
-    
-    players = get_players(tournament_id)
-    names = [p["name"] for p in players]
-    matches = []
-    
-    # Генерируем все пары для каждого круга
-    for r in range(rounds):
-        for i in range(len(names)):
-            for j in range(i + 1, len(names)):  
-                if r % 2 == 0:
-                    matches.append((names[i], names[j]))
-                else:
-                    matches.append((names[j], names[i]))
-    
-    random.shuffle(matches)
-    
-    # Добавляем матчи с правильной нумерацией начиная с 1
-    for match_num, (home, away) in enumerate(matches, start=1):
-        c.execute("INSERT INTO matches (tournament_id, match_number, home, away) VALUES (?, ?, ?, ?)",
-                  (tournament_id, match_num, home, away))
+    c.execute("UPDATE tournaments SET format=? WHERE id=?", (fmt, tournament_id))
+    _bump_data_version(c, tournament_id)
     conn.commit()
     conn.close()
+    forget_tournament(tournament_id)
 
-def get_schedule(tournament_id: int, limit: int = None) -> List[sqlite3.Row]:
+def set_group_settings(tournament_id: int, group_size: int, group_advance: int):
     conn = db()
     c = conn.cursor()
-    c.execute("""
-    SELECT * FROM matches
-    WHERE tournament_id=? ORDER BY played ASC, match_number ASC
-    """ + ("LIMIT ?" if limit else ""), (tournament_id,) + ((limit,) if limit else ()))
-    rows = c.fetchall()
+    c.execute("UPDATE tournaments SET group_size=?, group_advance=? WHERE id=?",
+              (group_size, group_advance, tournament_id))
+    _bump_data_version(c, tournament_id)
+    conn.commit()
     conn.close()
-    return rows
+    forget_tournament(tournament_id)
 
-def record_result(tournament_id: int, match_id: int, hg: int, ag: int):
+def set_swiss_rounds(tournament_id: int, swiss_rounds: Optional[int]):
     conn = db()
     c = conn.cursor()
-    c.execute("""
-    UPDATE matches
-    SET home_goals=?, away_goals=?, played=1
-    WHERE tournament_id=? AND id=?
-    """, (hg, ag, tournament_id, match_id))
+    c.execute("UPDATE tournaments SET swiss_rounds=? WHERE id=?", (swiss_rounds, tournament_id))
+    _bump_data_version(c, tournament_id)
     conn.commit()
     conn.close()
+    forget_tournament(tournament_id)
 
-def get_standings(tournament_id: int) -> List[tuple]:
-    players = get_players(tournament_id)
-    table = {p["name"]: {"P":0, "W":0, "D":0, "L":0, "GF":0, "GA":0, "GD":0, "PTS":0} for p in players}
+def _round_robin_pairs(names: List[str], rounds: int) -> List[tuple]:
+    """Пары по турам круговым методом: (хозяин, гость, номер тура).
 
-    conn = db()
-    c = conn.cursor()
-    c.execute("SELECT home, away, home_goals, away_goals, played FROM matches WHERE tournament_id=?", (tournament_id,))
-    for home, away, hg, ag, played in c.fetchall():
-        if not played or hg is None or ag is None:
-            continue
-        table[home]["P"] += 1
-        table[away]["P"] += 1
-        table[home]["GF"] += hg; table[home]["GA"] += ag
-        table[away]["GF"] += ag; table[away]["GA"] += hg
-        if hg > ag:
-            table[home]["W"] += 1; table[away]["L"] += 1
-            table[home]["PTS"] += 3
-        elif hg < ag:
-            table[away]["W"] += 1; table[home]["L"] += 1
-            table[away]["PTS"] += 3
-        else:
-            table[home]["D"] += 1; table[away]["D"] += 1
-            table[home]["PTS"] += 1; table[away]["PTS"] += 1
-    for n in table:
-        table[n]["GD"] = table[n]["GF"] - table[n]["GA"]
-    conn.close()
+    В туре каждый играет не больше одного матча (при нечетном числе один
+    отдыхает), туры сквозные по всем кругам, в четных кругах поля меняются.
+    """
+    ring = list(names) + ([None] if len(names) % 2 else [])
+    n = len(ring)
+    days = n - 1
+    pairs = []
+    for r in range(rounds):
+        order = ring[:]
+        for d in range(days):
+            for i in range(n // 2):
+                home, away = order[i], order[n - 1 - i]
+                if home is None or away is None:
+                    continue
+                # Поля чередует только закрепленный участник - так у всех дома поровну (±1)
+                if (i == 0 and d % 2) != bool(r % 2):
+                    home, away = away, home
+                pairs.append((home, away, r * days + d + 1))
+            order = [order[0], order[-1]] + order[1:-1]
+    return pairs
 
-    ordered = sorted(table.items(), key=lambda kv: (-kv[1]["PTS"], -kv[1]["GD"], -kv[1]["GF"], kv[0]))
-    return ordered
+def _seed_order(size: int) -> List[int]:
+    """Классическая расстановка посевов в сетке: 1-8, 4-5, 2-7, 3-6 ..."""
+    order = [1]
+    while len(order) < size:
+        n = len(order) * 2
+        order = [x for seed in order for x in (seed, n + 1 - seed)]
+    return order
 
-def _html_escape(s: str) -> str:
-    return (s.replace("&", "&amp;")
-             .replace("<", "&lt;")
-             .replace(">", "&gt;"))
+def _build_bracket(names: List[str], double: bool = False, stage: str = "winners") -> List[tuple]:
+    """Строит сетку плей-офф в памяти.
 
-def format_table(tournament_id: int, ordered: List[tuple]) -> str:
-    # ширины колонок, все числа вправо
-    # #  Игрок         И  В  Н  П   ±   О
-    header = f"{'#':<2}{'Игрок':<12}{'И':>3}{'В':>3}{'Н':>3}{'П':>3}{'±':>5}{'О':>4}"
-    lines = [header, "─" * len(header)]
+    Узел: (ключ, стадия, раунд, [источник, источник]), источник - ('player', имя),
+    ('bye',), ('winner', ключ) или ('loser', ключ). Узлы идут в топологическом порядке.
+    """
+    size = 1
+    while size < len(names):
+        size *= 2
+    prev = [('player', names[s - 1]) if s <= len(names) else ('bye',) for s in _seed_order(size)]
 
-    for i, (name, st) in enumerate(ordered, start=1):
-        club = get_player_club(tournament_id, name)
-        short = get_short_club_name(club) if club else ""
-        display = f"{name[:8]}({short})" if club else name[:12]
-        if len(display) > 12:
-            display = display[:11] + "…"
+    nodes, wb_losers, r = [], {}, 1
+    while len(prev) > 1:
+        cur, losers = [], []
+        for i in range(0, len(prev), 2):
+            key = ('W', r, i // 2)
+            nodes.append((key, stage, r, [prev[i], prev[i + 1]]))
+            cur.append(('winner', key))
+            losers.append(('loser', key))
+        wb_losers[r] = losers
+        prev, r = cur, r + 1
+    if not double:
+        return nodes
 
-        lines.append(
-            f"{i:<2}"
-            f"{display:<12}"
-            f"{st['P']:>3}{st['W']:>3}{st['D']:>3}{st['L']:>3}"
-            f"{st['GD']:>5}{st['PTS']:>4}"
-        )
+    # Нижняя сетка: проигравшие первого раунда играют между собой, дальше
+    # чередуются раунды "выжившие против выбывших сверху" и "выжившие между собой"
+    wb_champion, k = prev[0], r - 1
+    if k == 1:
+        lb_champion = wb_losers[1][0]
+    else:
+        lb_round, cur = 1, []
+        first = wb_losers[1]
+        for i in range(0, len(first), 2):
+            key = ('L', lb_round, i // 2)
+            nodes.append((key, "losers", lb_round, [first[i], first[i + 1]]))
+            cur.append(('winner', key))
+        for j in range(2, k + 1):
+            lb_round += 1
+            drop = wb_losers[j][::-1] if j % 2 == 0 else wb_losers[j]
+            nxt = []
+            for i, (survivor, dropped) in enumerate(zip(cur, drop)):
+                key = ('L', lb_round, i)
+                nodes.append((key, "losers", lb_round, [survivor, dropped]))
+                nxt.append(('winner', key))
+            cur = nxt
+            if j < k:
+                lb_round += 1
+                nxt = []
+                for i in range(0, len(cur), 2):
+                    key = ('L', lb_round, i // 2)
+                    nodes.append((key, "losers", lb_round, [cur[i], cur[i + 1]]))
+                    nxt.append(('winner', key))
+                cur = nxt
+        lb_champion = cur[0]
+    nodes.append((('F', 1, 0), "final", 1, [wb_champion, lb_champion]))
+    return nodes
 
-    table = "\n".join(lines)
-    return f"<pre>{_html_escape(table)}</pre>"
+def _resolve_byes(nodes: List[tuple]) -> List[tuple]:
+    """Схлопывает узлы с пропуском (bye): соперник проходит дальше без матча"""
+    passed = {}
+    real = []
 
-def get_current_tournament_prize(tournament_id: int) -> str:
-    conn = db()
-    c = conn.cursor()
-    c.execute("SELECT prize FROM tournaments WHERE id=?", (tournament_id,))
-    row = c.fetchone()
-    conn.close()
-    return row["prize"] if row and row["prize"] else "приз"
+    def sub(src):
+        if src[0] in ('winner', 'loser') and src[1] in passed:
+            winner, loser = passed[src[1]]
+            return winner if src[0] == 'winner' else loser
+        return src
 
-def get_short_club_name(club: str) -> str:
-    """Сокращает название клуба для компактного отображения"""
-    short_names = {
-        # England
-        "Newcastle United": "NEW", "Tottenham Hotspur": "TOT", "Chelsea": "CHE", 
-        "Arsenal": "ARS", "Liverpool": "LIV", "Manchester United": "MUN", 
-        "Manchester City": "MCI", "Aston Villa": "AVL", "Crystal Palace": "CRY",
-        "Brighton": "BRI", "West Ham": "WHU", "Nottingham Forest": "NFO",
-        # Italy  
-        "AC Milan": "MIL", "Inter Milan": "INT", "Juventus": "JUV", 
-        "Napoli": "NAP", "Roma": "ROM", "Atalanta": "ATA",
-        # Germany
-        "Leipzig": "LEI", "Bayer Leverkusen": "LEV", "Borussia Dortmund": "BVB",
-        "Bayern Munich": "BAY", "Frankfurt": "FRA", "Stuttgart": "STU",
-        # Spain
-        "Real Madrid": "RMA", "Barcelona": "BAR", "Atletico Madrid": "ATM",
-        "Athletic Bilbao": "ATH", "Sevilla": "SEV", "Real Betis": "BET",
-        "Real Sociedad": "RSO", "Girona": "GIR", "Villarreal": "VIL",
-        # France
-        "Lyon": "LYO", "Paris Saint-Germain": "PSG", "Olympique de Marseille": "MAR",
-        "AS Monaco": "MON", "OGC Nice": "NIC",
-        # Other
-        "Ajax": "AJX", "PSV": "PSV", "Galatasaray": "GAL", "Fenerbahçe": "FEN",
-        "Beşiktaş": "BES", "Benfica": "BEN", "Sporting": "SPO",
-        "Al Nassr": "NAS", "Al Hilal": "HIL", "Al Ittihad": "ITT",
-        # National teams
-        "Spain": "ESP", "Portugal": "POR", "Netherlands": "NED", "Germany": "GER",
-        "Argentina": "ARG", "France": "FRA", "England": "ENG", "Italy": "ITA",
-        "Japan": "JPN", "South Korea": "KOR", "Morocco": "MAR", "Croatia": "CRO",
-        "Norway": "NOR", "Sweden": "SWE", "Denmark": "DEN"
-    }
-    return short_names.get(club, club[:3].upper())
+    for key, stage, rnd, inputs in nodes:
+        a, b = sub(inputs[0]), sub(inputs[1])
+        if a[0] == 'bye' or b[0] == 'bye':
+            passed[key] = (b if a[0] == 'bye' else a, ('bye',))
+        else:
+            real.append((key, stage, rnd, [a, b]))
+    return real
 
-def get_match_by_id(tournament_id: int, match_id: int) -> Optional[sqlite3.Row]:
-    conn = db()
-    c = conn.cursor()
-    c.execute("SELECT * FROM matches WHERE tournament_id=? AND id=?", (tournament_id, match_id))
+def _insert_bracket(c: sqlite3.Cursor, tournament_id: int, nodes: List[tuple], start_no: int) -> int:
+    """Сохраняет сетку: участники первого раунда сразу, остальные - ссылками на матчи"""
+    nodes = _resolve_byes(nodes)
+
+    # Номер "волны": матч можно играть, когда сыграны все матчи-источники
+    wave = {}
+    for key, _, _, inputs in nodes:
+        wave[key] = 1 + max((wave[src[1]] for src in inputs if src[0] in ('winner', 'loser')), default=0)
+    stage_order = {"group": 0, "winners": 1, "playoff": 1, "losers": 2, "final": 3}
+    nodes = sorted(nodes, key=lambda n: (wave[n[0]], stage_order.get(n[1], 9), n[0]))
+
+    ids = {}
+    for no, (key, stage, rnd, inputs) in enumerate(nodes, start=start_no):
+        home, away = [src[1] if src[0] == 'player' else "" for src in inputs]
+        c.execute("""
+        INSERT INTO matches (tournament_id, match_number, home, away, stage, round_no)
+        VALUES (?, ?, ?, ?, ?, ?)
+        """, (tournament_id, no, home, away, stage, rnd))
+        ids[key] = c.lastrowid
+
+    links = []
+    for key, _, _, inputs in nodes:
+        for slot, src in zip(("home", "away"), inputs):
+            if src[0] == 'winner':
+                links.append(("UPDATE matches SET next_match_id=?, next_slot=? WHERE id=?", (ids[key], slot, ids[src[1]])))
+            elif src[0] == 'loser':
+                links.append(("UPDATE matches SET loser_match_id=?, loser_slot=? WHERE id=?", (ids[key], slot, ids[src[1]])))
+    for sql, params in links:
+        c.execute(sql, params)
+    return start_no + len(nodes)
+
+def _build_schedule(c: sqlite3.Cursor, tournament_id: int, rounds: int):
+    c.execute("SELECT format, group_size FROM tournaments WHERE id=?", (tournament_id,))
     row = c.fetchone()
-    conn.close()
-    return row
+    fmt = row["format"] if row and row["format"] else "league"
 
-def get_funny_match_comment(home_goals: int, away_goals: int) -> str:
-    """Генерирует смешной комментарий по результату матча"""
-    total_goals = home_goals + away_goals
-    
-    if home_goals == away_goals:
-        return random.choice(DRAW_COMMENTS)
-    elif total_goals >= 6:
-        return random.choice(HIGH_SCORE_COMMENTS)
-    elif total_goals <= 1:
-        return random.choice(LOW_SCORE_COMMENTS)
-    else:
-        return random.choice(MATCH_COMMENTS)
+    # Новое расписание - новая история: журнал ссылается на удаляемые матчи
+    c.execute("SELECT 1 FROM matches WHERE tournament_id=? AND played=1 LIMIT 1", (tournament_id,))
+    if c.fetchone():
+        invalidate_h2h()
+    c.execute("DELETE FROM matches WHERE tournament_id=?", (tournament_id,))
+    c.execute("DELETE FROM match_events WHERE tournament_id=?", (tournament_id,))
+    c.execute("DELETE FROM standings_snapshots WHERE tournament_id=?", (tournament_id,))
+    c.execute("DELETE FROM pending_results WHERE tournament_id=?", (tournament_id,))
+    c.execute("UPDATE players SET group_name=NULL WHERE tournament_id=?", (tournament_id,))
+    _bump_data_version(c, tournament_id)
 
-def get_funny_message(ordered: List[tuple], prize: str) -> Optional[str]:
-    """Обновленная функция с более интересными комментариями"""
-    if not ordered:
-        return None
-    
-    top_score = ordered[0][1]['PTS']
-    leaders = [name for name, st in ordered if st['PTS'] == top_score]
-    
-    leader_messages = [
-        f"👑 {leaders[0]} правит балом! {prize} уже пахнет победой!",
-        f"🔥 {leaders[0]} в огне! Остальные курят в сторонке!",
-        f"⚡ {leaders[0]} на коне! {prize} почти в кармане!",
-        f"🚀 {leaders[0]} летит к {prize} как ракета!",
-        f"👏 {leaders[0]} показывает класс! {prize} ждет своего героя!"
-    ]
-    
-    tie_messages = [
-        f"🤝 {leaders[0]} и {leaders[1]} не могут определиться! {prize} в подвешенном состоянии!",
-        f"⚔️ {leaders[0]} против {leaders[1]}! Битва за {prize} накаляется!",
-        f"🎭 {' VS '.join(leaders)} - драма достойная Оскара! {prize} ждет!",
-        f"🔥 Дуэль века: {' и '.join(leaders)}! {prize} дрожит от напряжения!"
-    ]
-    
-    chaos_messages = [
-        f"🌪️ Полный хаос в турнире! {len(leaders)} претендентов на {prize}!",
-        f"🎪 Цирк продолжается! {len(leaders)} клоунов борются за {prize}!",
-        f"🍯 {prize} привлекает {len(leaders)} пчел! Кто первый доберется?",
-        f"🎲 Кубик брошен! {len(leaders)} игроков в игре за {prize}!"
-    ]
-    
-    if len(leaders) == 1:
-        return random.choice(leader_messages)
-    elif len(leaders) == 2:
-        return random.choice(tie_messages)
-    else:
-        return random.choice(chaos_messages)
+    c.execute("SELECT name FROM players WHERE tournament_id=? ORDER BY id", (tournament_id,))
+    names = [p["name"] for p in c.fetchall()]
 
-def get_main_menu_keyboard(is_admin: bool = True, has_tournament: bool = False):
-    """Клавиатура с учетом прав пользователя и наличия турнира"""
-    keyboard = []
-    
-    # Кнопки для работы с турнирами
-    keyboard.append([InlineKeyboardButton("🏆 Выбрать турнир", callback_data="select_tournament")])
-    
-    if is_admin:
-        keyboard.append([InlineKeyboardButton("🆕 Создать турнир", callback_data="new_tournament")])
-    
-    # Кнопки для работы с текущим турниром (показываем только если турнир выбран)
-    if has_tournament:
-        keyboard.extend([
-            [InlineKeyboardButton("👥 Добавить игрока", callback_data="add_player"),
-             InlineKeyboardButton("👥+ Добавить списком", callback_data="add_players_list")],
-            [InlineKeyboardButton("⚽ Назначить клубы", callback_data="assign_clubs_menu")],
-            [InlineKeyboardButton("📊 Таблица", callback_data="show_table"),
-             InlineKeyboardButton("📋 Расписание", callback_data="show_schedule")],
-            [InlineKeyboardButton("⚽ Записать результат", callback_data="record_result"),
-             InlineKeyboardButton("✏️ Изменить результат", callback_data="edit_result")]
-        ])
-        
-        if is_admin:
-            keyboard.append([InlineKeyboardButton("📅 Генерировать расписание", callback_data="generate_schedule")])
-            keyboard.append([InlineKeyboardButton("🏁 Завершить турнир", callback_data="finish_tournament")])
-    
-    return InlineKeyboardMarkup(keyboard)
+    if fmt in ("single_elim", "double_elim"):
+        if len(names) < 2:
+            return
+        random.shuffle(names)
+        _insert_bracket(c, tournament_id, _build_bracket(names, double=(fmt == "double_elim")), 1)
+        return
 
-def get_tournaments_keyboard(tournaments: List[sqlite3.Row], current_tournament_id: int = None):
-    """Клавиатура для выбора турнира"""
-    keyboard = []
-    
-    if not tournaments:
-        keyboard.append([InlineKeyboardButton("❌ Нет турниров", callback_data="no_tournaments")])
-    else:
-        for tournament in tournaments:
-            # Показываем статус текущего турнира
-            status = "🟢" if tournament['id'] == current_tournament_id else "⚪"
-            text = f"{status} {tournament['name'][:20]}"
-            keyboard.append([InlineKeyboardButton(text, callback_data=f"choose_tournament_{tournament['id']}")])
-    
-    keyboard.append([InlineKeyboardButton("◀️ Назад", callback_data="main_menu")])
-    return InlineKeyboardMarkup(keyboard)
+    if fmt == "swiss":
+        # Первый тур по жребию, следующие - по таблице после завершения тура
+        if len(names) >= 2:
+            _pair_next_swiss_round(c, tournament_id, shuffle=True)
+        return
 
-def get_players_keyboard(tournament_id: int):
-    """Клавиатура для выбора игрока для назначения клуба"""
-    keyboard = []
-    players_without_clubs = get_players_without_clubs(tournament_id)
-    
-    for i in range(0, len(players_without_clubs), 2):
-        row = []
-        for j in range(i, min(i + 2, len(players_without_clubs))):
-            player = players_without_clubs[j]
-            row.append(InlineKeyboardButton(f"👤 {player['name']}", callback_data=f"select_player_{player['id']}"))
-        keyboard.append(row)
-    
-    keyboard.append([InlineKeyboardButton("🎲 Случайно всем", callback_data="assign_random")])
-    keyboard.append([InlineKeyboardButton("◀️ Назад", callback_data="main_menu")])
-    return InlineKeyboardMarkup(keyboard)
+    if fmt == "groups_playoff":
+        random.shuffle(names)
+        group_size = max(row["group_size"] or 4, 2)
+        groups_count = max((len(names) + group_size - 1) // group_size, 1)
+        groups = {chr(ord('A') + g): names[g::groups_count] for g in range(groups_count)}
+        matches = []
+        for group_name, members in groups.items():
+            c.executemany("UPDATE players SET group_name=? WHERE tournament_id=? AND name=?",
+                          [(group_name, tournament_id, n) for n in members])
+            matches += [(h, a, r, group_name) for h, a, r in _round_robin_pairs(members, rounds)]
+        random.shuffle(matches)
+        # Группы играют по турам: сначала все матчи 1-го тура, потом 2-го
+        matches.sort(key=lambda m: m[2])
+        c.executemany("""
+        INSERT INTO matches (tournament_id, match_number, home, away, stage, round_no, group_name)
+        VALUES (?, ?, ?, ?, 'group', ?, ?)
+        """, [(tournament_id, no, h, a, r, g) for no, (h, a, r, g) in enumerate(matches, start=1)])
+        return
 
-def get_countries_keyboard():
-    keyboard = []
-    countries = list(CLUBS_DB.keys())
-    
-    for i in range(0, len(countries), 2):
-        row = []
-        for j in range(i, min(i + 2, len(countries))):
-            country = countries[j]
-            flag_emoji = get_country_flag(country)
-            row.append(InlineKeyboardButton(f"{flag_emoji} {country}", callback_data=f"country_{country}"))
-        keyboard.append(row)
-    keyboard.append([InlineKeyboardButton("◀️ Назад к игрокам", callback_data="assign_clubs_menu")])
-    return InlineKeyboardMarkup(keyboard)
+    # Круговой турнир: жребий мест в круге, матчи по порядку туров
+    random.shuffle(names)
+    matches = _round_robin_pairs(names, rounds)
+    random.shuffle(matches)
+    matches.sort(key=lambda m: m[2])
 
-def get_clubs_keyboard(country: str, player_name: str):
-    keyboard = []
-    clubs = CLUBS_DB.get(country, [])
-    
-    for i in range(0, len(clubs), 2):
-        row = []
-        for j in range(i, min(i + 2, len(clubs))):
-            club = clubs[j]
-            row.append(InlineKeyboardButton(club, callback_data=f"assign_club_{country}_{club}"))
-        keyboard.append(row)
-    keyboard.append([InlineKeyboardButton("◀️ Назад к странам", callback_data="select_country")])
-    return InlineKeyboardMarkup(keyboard)
+    # Добавляем матчи с правильной нумерацией начиная с 1
+    c.executemany("""
+    INSERT INTO matches (tournament_id, match_number, home, away, stage, round_no)
+    VALUES (?, ?, ?, ?, 'league', ?)
+    """, [(tournament_id, no, h, a, r) for no, (h, a, r) in enumerate(matches, start=1)])
 
-def get_matches_keyboard(tournament_id: int, unplayed_only: bool = True, for_edit: bool = False):
-    keyboard = []
-    matches = get_schedule(tournament_id, 100)
+def generate_schedule(tournament_id: int, rounds: int):
+    conn = db()
+    try:
+        with conn:
+            _build_schedule(conn.cursor(), tournament_id, rounds)
+    finally:
+        conn.close()
 
-    if unplayed_only:
-        matches = [m for m in matches if not m['played']]
-    elif for_edit:
-        matches = [m for m in matches if m['played']]  # Для редактирования только сыгранные
+SEASON_CLUB_MODES = {
+    "keep": "⚽ С теми же клубами",
+    "redraw": "🎲 Клубы заново (жребий)",
+    "none": "🚫 Без клубов",
+}
 
-    if not matches:
-        return InlineKeyboardMarkup([[InlineKeyboardButton("◀️ Назад", callback_data="main_menu")]])
+def next_season_name(name: str) -> str:
+    """'Лига 2' -> 'Лига 3', 'Лига' -> 'Лига 2'"""
+    m = re.match(r"^(.*?)(\d+)$", name.strip())
+    if m:
+        return f"{m.group(1)}{int(m.group(2)) + 1}"
+    return f"{name.strip()} 2"
 
-    for match in matches:
-        status = "⚽" if not match['played'] else "✅"
-        hg = match['home_goals'] if match['home_goals'] is not None else "-"
-        ag = match['away_goals'] if match['away_goals'] is not None else "-"
-        no = match_no(match)
+def clone_tournament(source_id: int, chat_id: int, name: str, clubs: str = "keep") -> int:
+    """Новый сезон: копия настроек и состава турнира с расписанием, одной транзакцией"""
+    conn = db()
+    try:
+        with conn:
+            c = conn.cursor()
+            c.execute("""
+                INSERT INTO tournaments (chat_id, name, prize, rounds, format, group_size, group_advance,
+                                         swiss_rounds, tiebreaks, created_at)
+                SELECT ?, ?, prize, rounds, format, group_size, group_advance, swiss_rounds, tiebreaks, ?
+                FROM tournaments WHERE id=?
+            """, (chat_id, name, datetime.now().isoformat(), source_id))
+            tid = c.lastrowid
 
-        text_full = f"{status} #{no}: {match['home']} vs {match['away']} [{hg}:{ag}]"
-        if len(text_full) > 40:
-            home_short = match['home'][:7] if len(match['home']) > 7 else match['home']
-            away_short = match['away'][:7] if len(match['away']) > 7 else match['away']
-            text_full = f"{status} #{no}: {home_short}-{away_short} [{hg}:{ag}]"
+            c.execute("""
+                INSERT INTO players (tournament_id, name, club, user_id)
+                SELECT ?, name, CASE WHEN ?='keep' THEN club END, user_id
+                FROM players WHERE tournament_id=? ORDER BY id
+            """, (tid, clubs, source_id))
 
-        callback_prefix = "edit_match_" if for_edit else "select_match_"
-        keyboard.append([InlineKeyboardButton(text_full, callback_data=f"{callback_prefix}{match['id']}")])
+            if clubs == "redraw":
+                assigned, _ = _draw_clubs(c, tid)
+                c.executemany("UPDATE players SET club=? WHERE id=?", [(club, pid) for pid, club in assigned.items()])
 
-    keyboard.append([InlineKeyboardButton("◀️ Назад", callback_data="main_menu")])
-    return InlineKeyboardMarkup(keyboard)
+            c.execute("SELECT rounds FROM tournaments WHERE id=?", (tid,))
+            _build_schedule(c, tid, c.fetchone()["rounds"] or 2)
+    finally:
+        conn.close()
 
-def get_score_keyboard(match_id: int, player_name: str, is_edit: bool = False):
-    """Клавиатура для выбора количества голов"""
-    keyboard = []
-    
-    for i in range(0, 21, 5): 
-        row = []
-        for j in range(i, min(i + 5, 11)):
-            callback_prefix = "edit_score_" if is_edit else "score_"
-            row.append(InlineKeyboardButton(str(j), callback_data=f"{callback_prefix}{match_id}_{player_name}_{j}"))
-        keyboard.append(row)
-    
-    back_callback = "edit_result" if is_edit else "record_result"
-    keyboard.append([InlineKeyboardButton("◀️ Назад", callback_data=back_callback)])
-    return InlineKeyboardMarkup(keyboard)
+    set_current_tournament(chat_id, tid)
+    return tid
 
-def get_country_flag(country: str) -> str:
-    flags = {
-        "England": "🏴󠁧󠁢󠁥󠁮󠁧󠁿",
-        "Italy": "🇮🇹",
-        "Germany": "🇩🇪", 
-        "Spain": "🇪🇸",
-        "France": "🇫🇷",
-        "Netherlands": "🇳🇱",
-        "Turkey": "🇹🇷",
-        "Portugal": "🇵🇹",
-        "Saudi Arabia": "🇸🇦",
-        "National teams": "🌍"
-    }
-    return flags.get(country, "⚽")
+def _start_playoff_if_ready(c: sqlite3.Cursor, tournament_id: int) -> List[str]:
+    """После группового этапа формирует сетку плей-офф из лучших в группах"""
+    c.execute("""
+        SELECT
+            SUM(CASE WHEN stage='group' AND played=0 THEN 1 ELSE 0 END) AS pending,
+            SUM(CASE WHEN stage='playoff' THEN 1 ELSE 0 END) AS playoff
+        FROM matches WHERE tournament_id=?
+    """, (tournament_id,))
+    row = c.fetchone()
+    if row["pending"] or row["playoff"]:
+        return []
 
-async def send_new_menu(update: Update, context: ContextTypes.DEFAULT_TYPE, text: str, **kwargs):
-    """Отправляет новое меню (удаляет старое сообщение и отправляет новое)"""
-    chat_id = update.effective_chat.id
-    user_is_admin = await is_admin(update, context)
-    current_tournament = get_current_tournament(chat_id)
-    
-    # Определяем клавиатуру по умолчанию
-    default_markup = get_main_menu_keyboard(user_is_admin, bool(current_tournament))
-    reply_markup = kwargs.get('reply_markup', default_markup)
-    parse_mode = kwargs.get('parse_mode', None)
-    
+    c.execute("SELECT group_advance FROM tournaments WHERE id=?", (tournament_id,))
+    advance = max(c.fetchone()["group_advance"] or 2, 1)
+    c.execute("SELECT DISTINCT group_name FROM players WHERE tournament_id=? AND group_name IS NOT NULL ORDER BY group_name",
+              (tournament_id,))
+    groups = [r["group_name"] for r in c.fetchall()]
+
+    # Посев: сначала победители групп, потом вторые места и т.д. - так
+    # классическая расстановка разводит соперников из одной группы
+    tables = {g: _standings(c, tournament_id, g) for g in groups}
+    seeds = [tables[g][place][0] for place in range(advance) for g in groups if place < len(tables[g])]
+    if len(seeds) < 2:
+        return []
+
+    c.execute("SELECT COALESCE(MAX(match_number), 0) FROM matches WHERE tournament_id=?", (tournament_id,))
+    start_no = c.fetchone()[0] + 1
+    _insert_bracket(c, tournament_id, _build_bracket(seeds, stage="playoff"), start_no)
+    return [f"🏁 Групповой этап завершен! Плей-офф: {', '.join(seeds)}"]
+
+def _apply_result(c: sqlite3.Cursor, tournament_id: int, match_id: int, hg: int, ag: int,
+                  user_id: Optional[int] = None, undoes_seq: Optional[int] = None) -> List[str]:
+    """Записывает результат в рамках открытой транзакции и продвигает победителя по сетке"""
+    c.execute("SELECT * FROM matches WHERE tournament_id=? AND id=?", (tournament_id, match_id))
+    match = c.fetchone()
+    if not match:
+        raise ResultError("Матч не найден.")
+    if not match["home"] or not match["away"]:
+        raise ResultError(f"Соперники в матче #{match_no(match)} еще не определены.")
+
+    knockout = match["stage"] in KNOCKOUT_STAGES
+    if knockout and hg == ag:
+        raise ResultError(f"Матч #{match_no(match)} - плей-офф, ничьи не бывает. Укажите счет с учетом пенальти.")
+    # Счет записан (админом, тех. ничьей или подтверждением) - заявка игрока больше не нужна,
+    # иначе ее таймер после /undo перезаписал бы результат
+    c.execute("DELETE FROM pending_results WHERE match_id=?", (match_id,))
+
+    seq = _begin_event(c, tournament_id)
+    notes = []
+    if knockout:
+        winner, loser = (match["home"], match["away"]) if hg > ag else (match["away"], match["home"])
+        for target, slot, name in ((match["next_match_id"], match["next_slot"], winner),
+                                   (match["loser_match_id"], match["loser_slot"], loser)):
+            if not target or slot not in ("home", "away"):
+                continue
+            c.execute("SELECT * FROM matches WHERE id=?", (target,))
+            nxt = c.fetchone()
+            if nxt["played"] and nxt[slot] != name:
+                raise ResultError(f"Нельзя сменить победителя: матч #{match_no(nxt)} уже сыгран.")
+            c.execute(f"UPDATE matches SET {slot}=? WHERE id=?", (name, target))
+        if not match["next_match_id"] and match["stage"] in ("final", "playoff", "winners"):
+            notes.append(f"🏆 {winner} выигрывает турнир!")
+
+    c.execute("""
+    UPDATE matches
+    SET home_goals=?, away_goals=?, played=1
+    WHERE tournament_id=? AND id=?
+    """, (hg, ag, tournament_id, match_id))
+    invalidate_h2h(match["home"], match["away"])
+    _bump_data_version(c, tournament_id)
+    if match["played"]:
+        _log_event(c, tournament_id, seq, match_id, "edited", hg, ag,
+                   (match["home_goals"], match["away_goals"]), user_id, undoes_seq)
+    else:
+        _log_event(c, tournament_id, seq, match_id, "recorded", hg, ag, user_id=user_id, undoes_seq=undoes_seq)
+
+    if match["stage"] == "group":
+        notes += _start_playoff_if_ready(c, tournament_id)
+    elif match["stage"] == "swiss":
+        notes += _advance_swiss_if_ready(c, tournament_id)
+    return notes
+
+def record_result(tournament_id: int, match_id: int, hg: int, ag: int, user_id: Optional[int] = None) -> List[str]:
+    """Записывает результат. Возвращает заметки о продвижении по турниру"""
+    conn = db()
     try:
-        # Удаляем старое сообщение если это callback query
-        if hasattr(update, 'callback_query') and update.callback_query and update.callback_query.message:
-            await update.callback_query.message.delete()
-    except Exception as e:
-        print(f"Ошибка удаления сообщения: {e}")
-    
-    # Отправляем новое сообщение
+        with conn:
+            return _apply_result(conn.cursor(), tournament_id, match_id, hg, ag, user_id)
+    finally:
+        conn.close()
+
+# -------------------------
+# Журнал результатов
+# -------------------------
+SNAPSHOT_EVERY = 50  # раз в сколько событий сохранять снимок результатов
+
+EVENT_TITLES = {"recorded": "✅ записан", "edited": "✏️ изменен", "voided": "🗑 отменен"}
+
+def _results_state(c: sqlite3.Cursor, tournament_id: int) -> Dict[int, list]:
+    c.execute("SELECT id, home_goals, away_goals FROM matches WHERE tournament_id=? AND played=1", (tournament_id,))
+    return {r["id"]: [r["home_goals"], r["away_goals"]] for r in c.fetchall()}
+
+def _save_snapshot(c: sqlite3.Cursor, tournament_id: int, seq: int):
+    c.execute("""
+        INSERT OR REPLACE INTO standings_snapshots (tournament_id, seq, state)
+        VALUES (?, ?, ?)
+    """, (tournament_id, seq, json.dumps(_results_state(c, tournament_id))))
+
+def _begin_event(c: sqlite3.Cursor, tournament_id: int) -> int:
+    """Номер следующего события. Перед самым первым сохраняет исходное состояние"""
+    c.execute("SELECT COALESCE(MAX(seq), 0) FROM match_events WHERE tournament_id=?", (tournament_id,))
+    seq = c.fetchone()[0] + 1
+    if seq == 1:
+        _save_snapshot(c, tournament_id, 0)
+    return seq
+
+def _log_event(c: sqlite3.Cursor, tournament_id: int, seq: int, match_id: int, kind: str,
+               hg: Optional[int], ag: Optional[int], prev: tuple = (None, None),
+               user_id: Optional[int] = None, undoes_seq: Optional[int] = None):
+    c.execute("""
+        INSERT INTO match_events (tournament_id, seq, match_id, kind, home_goals, away_goals,
+                                  prev_home_goals, prev_away_goals, user_id, undoes_seq, created_at)
+        VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+    """, (tournament_id, seq, match_id, kind, hg, ag, prev[0], prev[1], user_id, undoes_seq,
+          datetime.now().isoformat()))
+    if seq % SNAPSHOT_EVERY == 0:
+        _save_snapshot(c, tournament_id, seq)
+
+def _void_result(c: sqlite3.Cursor, tournament_id: int, match_id: int,
+                 user_id: Optional[int] = None, undoes_seq: Optional[int] = None):
+    """Отменяет результат матча, убирая победителя из следующих матчей сетки"""
+    c.execute("SELECT * FROM matches WHERE tournament_id=? AND id=?", (tournament_id, match_id))
+    match = c.fetchone()
+    if not match or not match["played"]:
+        raise ResultError("Матч еще не сыгран.")
+
+    for target, slot in ((match["next_match_id"], match["next_slot"]),
+                         (match["loser_match_id"], match["loser_slot"])):
+        if not target or slot not in ("home", "away"):
+            continue
+        c.execute("SELECT * FROM matches WHERE id=?", (target,))
+        nxt = c.fetchone()
+        if nxt["played"]:
+            raise ResultError(f"Нельзя отменить: следующий матч #{match_no(nxt)} уже сыгран.")
+        c.execute(f"UPDATE matches SET {slot}='' WHERE id=?", (target,))
+
+    if match["stage"] == "group":
+        c.execute("SELECT 1 FROM matches WHERE tournament_id=? AND stage='playoff' LIMIT 1", (tournament_id,))
+        if c.fetchone():
+            raise ResultError("Нельзя отменить: плей-офф уже сформирован.")
+    elif match["stage"] == "swiss":
+        c.execute("SELECT 1 FROM matches WHERE tournament_id=? AND stage='swiss' AND round_no>? LIMIT 1",
+                  (tournament_id, match["round_no"]))
+        if c.fetchone():
+            raise ResultError("Нельзя отменить: следующий тур уже сформирован.")
+
+    seq = _begin_event(c, tournament_id)
+    c.execute("UPDATE matches SET home_goals=NULL, away_goals=NULL, played=0 WHERE id=?", (match_id,))
+    invalidate_h2h(match["home"], match["away"])
+    _bump_data_version(c, tournament_id)
+    _log_event(c, tournament_id, seq, match_id, "voided", None, None,
+               (match["home_goals"], match["away_goals"]), user_id, undoes_seq)
+
+def undo_last_result(tournament_id: int, user_id: Optional[int] = None) -> Optional[sqlite3.Row]:
+    """Откатывает последнее еще не отмененное событие. Возвращает это событие"""
+    conn = db()
     try:
-        if hasattr(update, 'callback_query') and update.callback_query:
-            await context.bot.send_message(
-                chat_id=chat_id,
-                text=text,
-                reply_markup=reply_markup,
-                parse_mode=parse_mode
-            )
-        else:
-            await update.message.reply_text(
-                text,
-                reply_markup=reply_markup,
-                parse_mode=parse_mode
-            )
-    except Exception as e:
-        print(f"Ошибка отправки сообщения: {e}")
-        # Попробуем отправить базовое сообщение без клавиатуры
-        try:
-            if hasattr(update, 'callback_query') and update.callback_query:
-                await context.bot.send_message(chat_id=chat_id, text="⚠️ Ошибка отображения меню. Попробуйте /start")
+        with conn:
+            c = conn.cursor()
+            c.execute("""
+                SELECT e.* FROM match_events e
+                WHERE e.tournament_id=? AND e.undoes_seq IS NULL
+                  AND e.kind IN ('recorded', 'edited') AND e.home_goals IS NOT NULL
+                  AND NOT EXISTS (SELECT 1 FROM match_events u
+                                  WHERE u.tournament_id=e.tournament_id AND u.undoes_seq=e.seq)
+                ORDER BY e.seq DESC LIMIT 1
+            """, (tournament_id,))
+            event = c.fetchone()
+            if not event:
+                return None
+            if event["prev_home_goals"] is None:
+                _void_result(c, tournament_id, event["match_id"], user_id, event["seq"])
             else:
-                await update.message.reply_text("⚠️ Ошибка отображения меню. Попробуйте /start")
-        except Exception:
-            pass
+                _apply_result(c, tournament_id, event["match_id"], event["prev_home_goals"],
+                              event["prev_away_goals"], user_id, event["seq"])
+            return event
+    finally:
+        conn.close()
 
-async def cmd_start(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    """Команда /start - показывает главное меню"""
-    try:
+def _results_as_of(c: sqlite3.Cursor, tournament_id: int, seq: int) -> Dict[int, list]:
+    """Состояние результатов после события seq: ближайший снимок + хвост журнала"""
+    c.execute("""
+        SELECT seq, state FROM standings_snapshots
+        WHERE tournament_id=? AND seq<=? ORDER BY seq DESC LIMIT 1
+    """, (tournament_id, seq))
+    row = c.fetchone()
+    state = {int(k): v for k, v in json.loads(row["state"]).items()} if row else {}
+    base = row["seq"] if row else 0
+
+    c.execute("""
+        SELECT match_id, kind, home_goals, away_goals FROM match_events
+        WHERE tournament_id=? AND seq>? AND seq<=? ORDER BY seq
+    """, (tournament_id, base, seq))
+    for match_id, kind, hg, ag in c.fetchall():
+        if kind == "voided":
+            state.pop(match_id, None)
+        else:
+            state[match_id] = [hg, ag]
+    return state
+
+def get_standings_as_of(tournament_id: int, seq: int) -> List[tuple]:
+    conn = db()
+    try:
+        c = conn.cursor()
+        state = _results_as_of(c, tournament_id, seq)
+        c.execute("SELECT id, home, away FROM matches WHERE tournament_id=?", (tournament_id,))
+        sides = {r["id"]: (r["home"], r["away"]) for r in c.fetchall()}
+        results = []
+        for match_id, (hg, ag) in state.items():
+            if match_id not in sides:
+                continue
+            home, away = sides[match_id]
+            if not away or (hg is not None and ag is not None):
+                results.append((home, away, hg, ag))
+
+        c.execute("SELECT name, fair_play FROM players WHERE tournament_id=?", (tournament_id,))
+        players = c.fetchall()
+        c.execute("SELECT tiebreaks FROM tournaments WHERE id=?", (tournament_id,))
+        row = c.fetchone()
+        return compute_standings(
+            tournament_id,
+            [p["name"] for p in players],
+            results,
+            parse_tiebreaks(row["tiebreaks"] if row else None),
+            {p["name"]: p["fair_play"] or 0 for p in players},
+        )
+    finally:
+        conn.close()
+
+def get_event_log(tournament_id: int, limit: int = 15) -> List[sqlite3.Row]:
+    conn = db()
+    c = conn.cursor()
+    c.execute("""
+        SELECT e.*, m.match_number, m.home, m.away FROM match_events e
+        LEFT JOIN matches m ON m.id = e.match_id
+        WHERE e.tournament_id=? ORDER BY e.seq DESC LIMIT ?
+    """, (tournament_id, limit))
+    rows = c.fetchall()
+    conn.close()
+    return rows
+
+def get_last_event_seq(tournament_id: int) -> int:
+    conn = db()
+    c = conn.cursor()
+    c.execute("SELECT COALESCE(MAX(seq), 0) FROM match_events WHERE tournament_id=?", (tournament_id,))
+    seq = c.fetchone()[0]
+    conn.close()
+    return seq
+
+# -------------------------
+# Личные встречи (за все турниры чата)
+# -------------------------
+H2H_LAST = 10          # сколько последних встреч показывать
+H2H_CACHE_SIZE = 512   # пар в кэше
+
+# (chat_id, ключ1, ключ2) -> встречи пары; ключи - casefold имен, отсортированы
+_h2h_cache: Dict[tuple, List[tuple]] = {}
+
+def _name_key(name: str) -> str:
+    return " ".join(name.split()).casefold()
+
+def _h2h_key(chat_id: int, a: str, b: str) -> tuple:
+    return (chat_id,) + tuple(sorted((_name_key(a), _name_key(b))))
+
+def invalidate_h2h(a: Optional[str] = None, b: Optional[str] = None):
+    """Сбрасывает кэш пары (во всех чатах) или весь кэш целиком"""
+    if a is None or b is None:
+        _h2h_cache.clear()
+        return
+    pair = tuple(sorted((_name_key(a), _name_key(b))))
+    for key in [k for k in _h2h_cache if k[1:] == pair]:
+        del _h2h_cache[key]
+
+def resolve_player_names(chat_id: int, name: str) -> List[str]:
+    """Все написания имени игрока в турнирах чата (без учета регистра и лишних пробелов)"""
+    conn = db()
+    c = conn.cursor()
+    c.execute("""
+        SELECT DISTINCT p.name FROM players p
+        JOIN tournaments t ON t.id = p.tournament_id
+        WHERE t.chat_id=?
+    """, (chat_id,))
+    key = _name_key(name)
+    names = [r["name"] for r in c.fetchall() if _name_key(r["name"]) == key]
+    conn.close()
+    return names
+
+def _load_h2h(chat_id: int, names_a: List[str], names_b: List[str]) -> List[tuple]:
+    """Встречи пары, от новых к старым: (турнир, №, хозяева, гости, голы, голы)"""
+    conn = db()
+    c = conn.cursor()
+    qa = ",".join("?" * len(names_a))
+    qb = ",".join("?" * len(names_b))
+    # CROSS JOIN фиксирует порядок: сначала пара по idx_matches_pair (оба направления),
+    # потом турнир по первичному ключу. Иначе планировщик перебирает все матчи чата.
+    c.execute(f"""
+        SELECT t.name AS tournament, m.match_number, m.home, m.away, m.home_goals, m.away_goals
+        FROM matches m CROSS JOIN tournaments t ON t.id = m.tournament_id
+        WHERE m.played=1 AND t.chat_id=?
+          AND ((m.home IN ({qa}) AND m.away IN ({qb})) OR (m.home IN ({qb}) AND m.away IN ({qa})))
+        ORDER BY t.created_at DESC, m.match_number DESC
+    """, [chat_id] + names_a + names_b + names_b + names_a)
+    rows = [tuple(r) for r in c.fetchall()]
+    conn.close()
+    return rows
+
+def get_h2h(chat_id: int, a: str, b: str) -> Optional[List[tuple]]:
+    """Встречи двух игроков за все турниры чата. None - если игрок не найден"""
+    key = _h2h_key(chat_id, a, b)
+    if key in _h2h_cache:
+        return _h2h_cache[key]
+    names_a = resolve_player_names(chat_id, a)
+    names_b = resolve_player_names(chat_id, b)
+    if not names_a or not names_b:
+        return None
+    rows = _load_h2h(chat_id, names_a, names_b)
+    if len(_h2h_cache) >= H2H_CACHE_SIZE:
+        del _h2h_cache[next(iter(_h2h_cache))]
+    _h2h_cache[key] = rows
+    return rows
+
+def format_h2h(a: str, b: str, rows: List[tuple]) -> str:
+    ka = _name_key(a)
+    wins = draws = losses = gf = ga = 0
+    lines = []
+    for tournament, number, home, away, hg, ag in rows:
+        mine, theirs = (hg, ag) if _name_key(home) == ka else (ag, hg)
+        gf += mine
+        ga += theirs
+        if mine > theirs:
+            wins += 1
+        elif mine == theirs:
+            draws += 1
+        else:
+            losses += 1
+        if len(lines) < H2H_LAST:
+            lines.append(f"{_html_escape(tournament)} #{number}: {_html_escape(home)} {hg}:{ag} {_html_escape(away)}")
+
+    text = (
+        f"⚔️ <b>{_html_escape(a)}</b> vs <b>{_html_escape(b)}</b>\n"
+        f"Встреч: {len(rows)} | В {wins} - Н {draws} - П {losses}\n"
+        f"Голы: {gf}:{ga}"
+    )
+    if lines:
+        text += f"\n\nПоследние встречи:\n" + "\n".join(lines)
+    return text
+
+# -------------------------
+# Статистика
+# -------------------------
+STATS_FORM = 5   # матчей в форме
+STATS_TOP = 3    # строк в топах
+
+# Матчи глазами каждого участника (без пропусков тура). Порядок по match_number
+# берется из idx_matches_tid_played(tournament_id, played, match_number).
+_SIDES_SQL = """
+    sides AS (
+        SELECT match_number AS n, home AS player, away AS opp, home_goals AS gf, away_goals AS ga
+        FROM matches WHERE tournament_id=:tid AND played=1 AND away<>'' AND home_goals IS NOT NULL
+        UNION ALL
+        SELECT match_number, away, home, away_goals, home_goals
+        FROM matches WHERE tournament_id=:tid AND played=1 AND away<>'' AND home_goals IS NOT NULL
+    ),
+    res AS (
+        SELECT *, CASE WHEN gf>ga THEN 'W' WHEN gf=ga THEN 'D' ELSE 'L' END AS r,
+               ROW_NUMBER() OVER (PARTITION BY player ORDER BY n DESC) AS back
+        FROM sides
+    )
+"""
+
+# Серии - "острова" подряд идущих матчей: разность сквозного номера матча
+# и номера внутри (игрок, признак) постоянна в пределах серии.
+_STREAKS_SQL = """
+WITH """ + _SIDES_SQL + """,
+    flags AS (
+        SELECT player, n, back, r='W' AS w, r<>'L' AS u,
+               ROW_NUMBER() OVER (PARTITION BY player ORDER BY n) AS k
+        FROM res
+    ),
+    islands AS (
+        SELECT player, back, w, u,
+               k - ROW_NUMBER() OVER (PARTITION BY player, w ORDER BY n) AS gw,
+               k - ROW_NUMBER() OVER (PARTITION BY player, u ORDER BY n) AS gu
+        FROM flags
+    ),
+    runs AS (
+        SELECT player, 'win' AS kind, COUNT(*) AS len, MIN(back)=1 AS current
+        FROM islands WHERE w GROUP BY player, gw
+        UNION ALL
+        SELECT player, 'unbeaten', COUNT(*), MIN(back)=1
+        FROM islands WHERE u GROUP BY player, gu
+    )
+SELECT player, kind, MAX(len) AS best, COALESCE(MAX(CASE WHEN current THEN len END), 0) AS now
+FROM runs GROUP BY player, kind
+"""
+
+_stats_cache: Dict[int, tuple] = {}        # tournament_id -> (версия, статистика)
+_club_stats_cache: Dict[int, tuple] = {}   # chat_id -> (версия, статистика)
+
+def _compute_tournament_stats(c: sqlite3.Cursor, tournament_id: int) -> dict:
+    params = {"tid": tournament_id, "form": STATS_FORM, "top": STATS_TOP}
+
+    c.execute("WITH " + _SIDES_SQL + """
+        SELECT player, r FROM res WHERE back<=:form ORDER BY player, back DESC
+    """, params)
+    form: Dict[str, str] = {}
+    for player, r in c.fetchall():
+        form[player] = form.get(player, "") + r
+
+    c.execute(_STREAKS_SQL, params)
+    streaks: Dict[str, dict] = {}
+    for player, kind, best, now in c.fetchall():
+        streaks.setdefault(player, {})[kind] = (best, now)
+
+    c.execute("""
+        SELECT match_number, home, away, home_goals, away_goals FROM (
+            SELECT *, RANK() OVER (ORDER BY ABS(home_goals-away_goals) DESC, home_goals+away_goals DESC) AS rk
+            FROM matches
+            WHERE tournament_id=:tid AND played=1 AND away<>'' AND home_goals<>away_goals
+        ) WHERE rk<=:top ORDER BY rk, match_number
+    """, params)
+    biggest = [tuple(r) for r in c.fetchall()]
+
+    c.execute("""
+        SELECT match_number, home, away, home_goals, away_goals FROM (
+            SELECT *, RANK() OVER (ORDER BY home_goals+away_goals DESC) AS rk
+            FROM matches
+            WHERE tournament_id=:tid AND played=1 AND away<>'' AND home_goals IS NOT NULL
+        ) WHERE rk<=:top AND home_goals+away_goals>0 ORDER BY rk, match_number
+    """, params)
+    goal_fests = [tuple(r) for r in c.fetchall()]
+
+    c.execute("WITH " + _SIDES_SQL + """
+        SELECT player, SUM(ga=0) AS cs FROM sides GROUP BY player HAVING cs>0 ORDER BY cs DESC, player
+    """, params)
+    clean_sheets = [tuple(r) for r in c.fetchall()]
+
+    return {"form": form, "streaks": streaks, "biggest": biggest,
+            "goal_fests": goal_fests, "clean_sheets": clean_sheets}
+
+def get_tournament_stats(tournament_id: int) -> dict:
+    version = get_data_version(tournament_id)
+    cached = _stats_cache.get(tournament_id)
+    if cached and cached[0] == version:
+        return cached[1]
+    conn = db()
+    try:
+        stats = _compute_tournament_stats(conn.cursor(), tournament_id)
+    finally:
+        conn.close()
+    _stats_cache[tournament_id] = (version, stats)
+    return stats
+
+def get_club_stats(chat_id: int) -> List[tuple]:
+    """Выступления клубов за все турниры чата: (клуб, И, В, Н, П, ЗМ, ПМ)"""
+    conn = db()
+    try:
+        c = conn.cursor()
+        # Версии турниров только растут, поэтому их сумма - версия данных всего чата
+        c.execute("""
+            SELECT COALESCE(SUM(v.version), 0) FROM data_versions v
+            JOIN tournaments t ON t.id = v.tournament_id WHERE t.chat_id=?
+        """, (chat_id,))
+        version = c.fetchone()[0]
+        cached = _club_stats_cache.get(chat_id)
+        if cached and cached[0] == version:
+            return cached[1]
+
+        c.execute("""
+            WITH sides AS (
+                SELECT m.tournament_id AS tid, m.home AS player, m.home_goals AS gf, m.away_goals AS ga
+                FROM matches m JOIN tournaments t ON t.id = m.tournament_id
+                WHERE t.chat_id=? AND m.played=1 AND m.away<>'' AND m.home_goals IS NOT NULL
+                UNION ALL
+                SELECT m.tournament_id, m.away, m.away_goals, m.home_goals
+                FROM matches m JOIN tournaments t ON t.id = m.tournament_id
+                WHERE t.chat_id=? AND m.played=1 AND m.away<>'' AND m.home_goals IS NOT NULL
+            )
+            SELECT p.club, COUNT(*) AS games, SUM(s.gf>s.ga), SUM(s.gf=s.ga), SUM(s.gf<s.ga),
+                   SUM(s.gf), SUM(s.ga)
+            FROM sides s JOIN players p ON p.tournament_id = s.tid AND p.name = s.player
+            WHERE p.club IS NOT NULL AND p.club<>''
+            GROUP BY p.club
+            ORDER BY 1.0 * SUM(s.gf>s.ga) / COUNT(*) DESC, games DESC, p.club
+        """, (chat_id, chat_id))
+        rows = [tuple(r) for r in c.fetchall()]
+    finally:
+        conn.close()
+    _club_stats_cache[chat_id] = (version, rows)
+    return rows
+
+FORM_ICONS = {"W": "🟢", "D": "🟡", "L": "🔴"}
+
+def _format_match_line(row: tuple) -> str:
+    number, home, away, hg, ag = row
+    return f"#{number} {_html_escape(home)} {hg}:{ag} {_html_escape(away)}"
+
+def format_tournament_stats(tournament: sqlite3.Row) -> str:
+    tid = tournament['id']
+    stats = get_tournament_stats(tid)
+    if not stats["form"]:
+        return "📊 Статистики пока нет - не сыграно ни одного матча."
+
+    parts = [f"📊 <b>Статистика: {_html_escape(tournament['name'])}</b>"]
+
+    lines = []
+    for name, _ in get_standings(tid):
+        if name in stats["form"]:
+            icons = "".join(FORM_ICONS[r] for r in stats["form"][name])
+            lines.append(f"{icons} {_html_escape(name)}")
+    parts.append(f"Форма (последние {STATS_FORM}, старые слева):\n" + "\n".join(lines))
+
+    def leaders(kind: str, idx: int) -> str:
+        best = max((s[kind][idx] for s in stats["streaks"].values() if kind in s), default=0)
+        if not best:
+            return "—"
+        names = sorted(p for p, s in stats["streaks"].items() if kind in s and s[kind][idx] == best)
+        return f"{best} — " + ", ".join(_html_escape(n) for n in names)
+
+    parts.append(
+        "Серии:\n"
+        f"🔥 Побед подряд сейчас: {leaders('win', 1)}\n"
+        f"🛡 Без поражений сейчас: {leaders('unbeaten', 1)}\n"
+        f"🏅 Рекорд побед подряд: {leaders('win', 0)}\n"
+        f"🧱 Рекорд без поражений: {leaders('unbeaten', 0)}"
+    )
+
+    if stats["biggest"]:
+        parts.append("💥 Крупнейшие победы:\n" + "\n".join(_format_match_line(r) for r in stats["biggest"]))
+    if stats["goal_fests"]:
+        parts.append("⚽ Самые результативные:\n" + "\n".join(_format_match_line(r) for r in stats["goal_fests"]))
+    if stats["clean_sheets"]:
+        parts.append("🧤 Сухие матчи:\n" + "\n".join(
+            f"{_html_escape(p)} — {n}" for p, n in stats["clean_sheets"][:STATS_TOP * 2]))
+    return "\n\n".join(parts)
+
+def format_club_stats(chat_id: int, limit: int = 15) -> str:
+    rows = get_club_stats(chat_id)
+    if not rows:
+        return "📊 По клубам пока нет сыгранных матчей."
+    header = f"{'Клуб':<6}{'И':>4}{'В':>4}{'Н':>4}{'П':>4}{'Мячи':>8}{'%':>5}"
+    lines = [header, "─" * len(header)]
+    for club, games, w, d, l, gf, ga in rows[:limit]:
+        lines.append(f"{get_short_club_name(club):<6}{games:>4}{w:>4}{d:>4}{l:>4}{f'{gf}:{ga}':>8}{round(100 * w / games):>5}")
+    more = f"\n…и еще клубов: {len(rows) - limit}" if len(rows) > limit else ""
+    return f"🏟 Клубы за все турниры чата:\n<pre>{_html_escape(chr(10).join(lines))}</pre>{more}"
+
+# -------------------------
+# Экспорт и импорт
+# -------------------------
+EXPORT_FIELDS = [
+    "type", "tournament_id", "name", "prize", "rounds", "format", "tiebreaks", "created_at",
+    "club", "group_name", "fair_play",
+    "match_number", "home", "away", "home_goals", "away_goals", "played", "stage", "round_no",
+    "pos", "P", "W", "D", "L", "GF", "GA", "GD", "PTS",
+]
+MATCH_STAGES = ("league", "group", "swiss") + KNOCKOUT_STAGES
+IMPORT_MAX_BYTES = 5 * 1024 * 1024
+IMPORT_MAX_ERRORS = 15
+
+def iter_chat_export(chat_id: int):
+    """Записи турниров чата по одной: турнир, его игроки, матчи и итоговая таблица"""
+    conn = db()
+    try:
+        tournaments = conn.execute("SELECT * FROM tournaments WHERE chat_id=? ORDER BY created_at", (chat_id,))
+        for t in tournaments:
+            tid = t["id"]
+            yield {"type": "tournament", "tournament_id": tid, "name": t["name"], "prize": t["prize"],
+                   "rounds": t["rounds"], "format": t["format"], "tiebreaks": t["tiebreaks"],
+                   "created_at": t["created_at"]}
+            for p in conn.execute("""
+                SELECT name, club, group_name, fair_play FROM players WHERE tournament_id=? ORDER BY id
+            """, (tid,)):
+                yield {"type": "player", "tournament_id": tid, **dict(p)}
+            for m in conn.execute("""
+                SELECT match_number, home, away, home_goals, away_goals, played, stage, round_no, group_name
+                FROM matches WHERE tournament_id=? ORDER BY match_number, id
+            """, (tid,)):
+                yield {"type": "match", "tournament_id": tid, **dict(m)}
+            for pos, (name, st) in enumerate(_standings(conn.cursor(), tid), start=1):
+                yield {"type": "standing", "tournament_id": tid, "pos": pos, "name": name,
+                       **{k: st[k] for k in ("P", "W", "D", "L", "GF", "GA", "GD", "PTS")}}
+    finally:
+        conn.close()
+
+def _csv_lines(records):
+    buf = io.StringIO()
+    writer = csv.DictWriter(buf, fieldnames=EXPORT_FIELDS, extrasaction="ignore")
+    writer.writeheader()
+    for record in itertools.chain([None], records):
+        if record is not None:
+            writer.writerow(record)
+        yield buf.getvalue()
+        buf.seek(0)
+        buf.truncate()
+
+def _jsonl_lines(records):
+    for record in records:
+        yield json.dumps({k: v for k, v in record.items() if v is not None}, ensure_ascii=False) + "\n"
+
+def write_chat_export(chat_id: int, fmt: str, path: str) -> int:
+    """Пишет экспорт чата в файл построчно. Возвращает число записей"""
+    count = 0
+    def counted(records):
+        nonlocal count
+        for record in records:
+            count += 1
+            yield record
+    lines = (_csv_lines if fmt == "csv" else _jsonl_lines)(counted(iter_chat_export(chat_id)))
+    with open(path, "w", encoding="utf-8-sig" if fmt == "csv" else "utf-8", newline="") as f:
+        f.writelines(lines)
+    return count
+
+def iter_import_records(path: str):
+    """(номер строки, запись) из CSV или JSON lines; битая строка - запись None"""
+    with open(path, encoding="utf-8-sig", newline="") as f:
+        head = f.read(1)
+        f.seek(0)
+        if head == "{":
+            for line_no, line in enumerate(f, start=1):
+                if not line.strip():
+                    continue
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    record = None
+                yield line_no, record if isinstance(record, dict) else None
+        else:
+            reader = csv.DictReader(f)
+            for record in reader:
+                yield reader.line_num, record
+
+def _opt_int(value, lo: Optional[int] = None, hi: Optional[int] = None) -> Optional[int]:
+    if value is None or value == "":
+        return None
+    if isinstance(value, bool) or isinstance(value, float):
+        raise ValueError(value)
+    n = int(value)
+    if (lo is not None and n < lo) or (hi is not None and n > hi):
+        raise ValueError(value)
+    return n
+
+def _opt_str(value) -> Optional[str]:
+    value = "" if value is None else str(value).strip()
+    return value or None
+
+def validate_import(records) -> tuple:
+    """Проверяет записи импорта. Возвращает (турниры, игроки, матчи, ошибки)"""
+    tournaments: Dict[str, tuple] = {}
+    players: List[tuple] = []
+    matches: List[tuple] = []
+    names: Dict[str, set] = {}
+    numbers: Dict[str, set] = {}
+    errors: List[str] = []
+
+    for line_no, record in records:
+        if len(errors) >= IMPORT_MAX_ERRORS:
+            break
+        if record is None:
+            errors.append(f"Строка {line_no}: не разобрана")
+            continue
+        kind = _opt_str(record.get("type"))
+        src = _opt_str(record.get("tournament_id"))
+        try:
+            if kind == "tournament":
+                name = _opt_str(record.get("name"))
+                if not src or not name or src in tournaments:
+                    raise ValueError("нужны уникальный tournament_id и name")
+                fmt = _opt_str(record.get("format")) or "league"
+                if fmt not in TOURNAMENT_FORMATS:
+                    raise ValueError(f"неизвестный формат {fmt}")
+                created = _opt_str(record.get("created_at")) or datetime.now().isoformat()
+                datetime.fromisoformat(created)
+                tiebreaks = _opt_str(record.get("tiebreaks"))
+                if tiebreaks:
+                    tiebreaks = ",".join(parse_tiebreaks(tiebreaks)) or None
+                tournaments[src] = (name, _opt_str(record.get("prize")),
+                                    _opt_int(record.get("rounds"), 1, 10) or 2, fmt, tiebreaks, created)
+                names[src], numbers[src] = set(), set()
+            elif kind == "player":
+                name = _opt_str(record.get("name"))
+                if src not in tournaments:
+                    raise ValueError("турнир не объявлен выше")
+                if not name or name in names[src]:
+                    raise ValueError("пустое или повторное имя игрока")
+                names[src].add(name)
+                players.append((src, name, _opt_str(record.get("club")), _opt_str(record.get("group_name")),
+                                _opt_int(record.get("fair_play")) or 0))
+            elif kind == "match":
+                if src not in tournaments:
+                    raise ValueError("турнир не объявлен выше")
+                number = _opt_int(record.get("match_number"), 1)
+                if number is None or number in numbers[src]:
+                    raise ValueError("пустой или повторный match_number")
+                numbers[src].add(number)
+                home = _opt_str(record.get("home")) or ""
+                away = _opt_str(record.get("away")) or ""
+                if (home and home not in names[src]) or (away and away not in names[src]):
+                    raise ValueError("игрок матча не объявлен выше")
+                played = _opt_int(record.get("played"), 0, 1) or 0
+                hg = _opt_int(record.get("home_goals"), 0, MAX_GOALS)
+                ag = _opt_int(record.get("away_goals"), 0, MAX_GOALS)
+                if played and home and away and (hg is None or ag is None):
+                    raise ValueError("у сыгранного матча нет счета")
+                if not played and (hg is not None or ag is not None):
+                    raise ValueError("счет у несыгранного матча")
+                stage = _opt_str(record.get("stage")) or "league"
+                if stage not in MATCH_STAGES:
+                    raise ValueError(f"неизвестная стадия {stage}")
+                matches.append((src, number, home, away, hg, ag, played, stage,
+                                _opt_int(record.get("round_no"), 1), _opt_str(record.get("group_name"))))
+            elif kind == "standing":
+                continue  # таблица пересчитывается из матчей
+            else:
+                raise ValueError(f"неизвестный тип записи {kind}")
+        except ValueError as e:
+            errors.append(f"Строка {line_no}: {e}")
+
+    if not tournaments and not errors:
+        errors.append("В файле нет ни одного турнира")
+    return tournaments, players, matches, errors
+
+def import_tournaments(chat_id: int, tournaments: Dict[str, tuple], players: List[tuple],
+                       matches: List[tuple]) -> List[int]:
+    """Записывает проверенный импорт одной транзакцией. Возвращает id новых турниров"""
+    conn = db()
+    try:
+        with conn:
+            c = conn.cursor()
+            ids = {}
+            for src, (name, prize, rounds, fmt, tiebreaks, created) in tournaments.items():
+                c.execute("""
+                    INSERT INTO tournaments (chat_id, name, prize, rounds, format, tiebreaks, created_at)
+                    VALUES (?, ?, ?, ?, ?, ?, ?)
+                """, (chat_id, name, prize, rounds, fmt, tiebreaks, created))
+                ids[src] = c.lastrowid
+                _bump_data_version(c, ids[src])
+            c.executemany("""
+                INSERT INTO players (tournament_id, name, club, group_name, fair_play) VALUES (?, ?, ?, ?, ?)
+            """, ((ids[p[0]],) + p[1:] for p in players))
+            c.executemany("""
+                INSERT INTO matches (tournament_id, match_number, home, away, home_goals, away_goals,
+                                     played, stage, round_no, group_name)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+            """, ((ids[m[0]],) + m[1:] for m in matches))
+    finally:
+        conn.close()
+    invalidate_h2h()
+    return list(ids.values())
+
+# -------------------------
+# Швейцарская система
+# -------------------------
+def max_weight_matching(edges: List[tuple], maxcardinality: bool = False) -> List[int]:
+    """Паросочетание максимального веса в произвольном графе (алгоритм Эдмондса, O(n³)).
+
+    edges - список (i, j, вес) с целыми весами, вершины 0..n-1. Возвращает mate:
+    mate[v] - пара вершины v или -1. При maxcardinality=True сначала максимизируется
+    число пар, затем вес. Реализация следует классической mwmatching Й. ван Рантвейка.
+    """
+    if not edges:
+        return []
+
+    nedge = len(edges)
+    nvertex = 1 + max(max(i, j) for i, j, _ in edges)
+    maxweight = max(0, max(w for _, _, w in edges))
+
+    # endpoint[p] - вершина на конце p; ребро k имеет концы 2k и 2k+1
+    endpoint = [edges[p // 2][p % 2] for p in range(2 * nedge)]
+    weight2 = [2 * w for _, _, w in edges]
+    neighbend = [[] for _ in range(nvertex)]
+    for k, (i, j, _) in enumerate(edges):
+        neighbend[i].append(2 * k + 1)
+        neighbend[j].append(2 * k)
+
+    mate = nvertex * [-1]
+    label = (2 * nvertex) * [0]
+    labelend = (2 * nvertex) * [-1]
+    inblossom = list(range(nvertex))
+    blossomparent = (2 * nvertex) * [-1]
+    blossomchilds = (2 * nvertex) * [None]
+    blossombase = list(range(nvertex)) + nvertex * [-1]
+    blossomendps = (2 * nvertex) * [None]
+    bestedge = (2 * nvertex) * [-1]
+    blossombestedges = (2 * nvertex) * [None]
+    unusedblossoms = list(range(nvertex, 2 * nvertex))
+    dualvar = nvertex * [maxweight] + nvertex * [0]
+    allowedge = nedge * [False]
+    queue = []
+
+    # Быстрый старт: пока все двойственные переменные равны maxweight, ребра
+    # максимального веса "тугие", и жадно взять их - то же, что сделали бы первые стадии
+    for k, (i, j, w) in enumerate(edges):
+        if w == maxweight and i != j and mate[i] == -1 and mate[j] == -1:
+            mate[i] = 2 * k + 1
+            mate[j] = 2 * k
+
+    def slack(k):
+        return dualvar[endpoint[2 * k]] + dualvar[endpoint[2 * k + 1]] - weight2[k]
+
+    def blossom_leaves(b):
+        if b < nvertex:
+            yield b
+        else:
+            for t in blossomchilds[b]:
+                if t < nvertex:
+                    yield t
+                else:
+                    yield from blossom_leaves(t)
+
+    def assign_label(w, t, p):
+        b = inblossom[w]
+        label[w] = label[b] = t
+        labelend[w] = labelend[b] = p
+        bestedge[w] = bestedge[b] = -1
+        if t == 1:
+            queue.extend(blossom_leaves(b))
+        elif t == 2:
+            base = blossombase[b]
+            assign_label(endpoint[mate[base]], 1, mate[base] ^ 1)
+
+    def scan_blossom(v, w):
+        # Ищем общего предка v и w в дереве: новый цветок или путь увеличения
+        path = []
+        base = -1
+        while v != -1 or w != -1:
+            b = inblossom[v]
+            if label[b] & 4:
+                base = blossombase[b]
+                break
+            path.append(b)
+            label[b] = 5
+            if labelend[b] == -1:
+                v = -1
+            else:
+                v = endpoint[labelend[b]]
+                b = inblossom[v]
+                v = endpoint[labelend[b]]
+            if w != -1:
+                v, w = w, v
+        for b in path:
+            label[b] = 1
+        return base
+
+    def add_blossom(base, k):
+        v, w, _ = edges[k]
+        bb = inblossom[base]
+        bv = inblossom[v]
+        bw = inblossom[w]
+        b = unusedblossoms.pop()
+        blossombase[b] = base
+        blossomparent[b] = -1
+        blossomparent[bb] = b
+        blossomchilds[b] = path = []
+        blossomendps[b] = endps = []
+        while bv != bb:
+            blossomparent[bv] = b
+            path.append(bv)
+            endps.append(labelend[bv])
+            v = endpoint[labelend[bv]]
+            bv = inblossom[v]
+        path.append(bb)
+        path.reverse()
+        endps.reverse()
+        endps.append(2 * k)
+        while bw != bb:
+            blossomparent[bw] = b
+            path.append(bw)
+            endps.append(labelend[bw] ^ 1)
+            w = endpoint[labelend[bw]]
+            bw = inblossom[w]
+        label[b] = 1
+        labelend[b] = labelend[bb]
+        dualvar[b] = 0
+        for v in blossom_leaves(b):
+            if label[inblossom[v]] == 2:
+                queue.append(v)
+            inblossom[v] = b
+        bestedgeto = (2 * nvertex) * [-1]
+        for bv in path:
+            if blossombestedges[bv] is None:
+                nblists = [[p // 2 for p in neighbend[v]] for v in blossom_leaves(bv)]
+            else:
+                nblists = [blossombestedges[bv]]
+            for nblist in nblists:
+                for k in nblist:
+                    i, j, _ = edges[k]
+                    if inblossom[j] == b:
+                        i, j = j, i
+                    bj = inblossom[j]
+                    if bj != b and label[bj] == 1 and (bestedgeto[bj] == -1 or slack(k) < slack(bestedgeto[bj])):
+                        bestedgeto[bj] = k
+            blossombestedges[bv] = None
+            bestedge[bv] = -1
+        blossombestedges[b] = [k for k in bestedgeto if k != -1]
+        bestedge[b] = -1
+        for k in blossombestedges[b]:
+            if bestedge[b] == -1 or slack(k) < slack(bestedge[b]):
+                bestedge[b] = k
+
+    def expand_blossom(b, endstage):
+        for s in blossomchilds[b]:
+            blossomparent[s] = -1
+            if s < nvertex:
+                inblossom[s] = s
+            elif endstage and dualvar[s] == 0:
+                expand_blossom(s, endstage)
+            else:
+                for v in blossom_leaves(s):
+                    inblossom[v] = s
+        if not endstage and label[b] == 2:
+            # Перемечаем вершины на пути через раскрытый T-цветок
+            entrychild = inblossom[endpoint[labelend[b] ^ 1]]
+            j = blossomchilds[b].index(entrychild)
+            if j & 1:
+                j -= len(blossomchilds[b])
+                jstep, endptrick = 1, 0
+            else:
+                jstep, endptrick = -1, 1
+            p = labelend[b]
+            while j != 0:
+                label[endpoint[p ^ 1]] = 0
+                label[endpoint[blossomendps[b][j - endptrick] ^ endptrick ^ 1]] = 0
+                assign_label(endpoint[p ^ 1], 2, p)
+                allowedge[blossomendps[b][j - endptrick] // 2] = True
+                j += jstep
+                p = blossomendps[b][j - endptrick] ^ endptrick
+                allowedge[p // 2] = True
+                j += jstep
+            bv = blossomchilds[b][j]
+            label[endpoint[p ^ 1]] = label[bv] = 2
+            labelend[endpoint[p ^ 1]] = labelend[bv] = p
+            bestedge[bv] = -1
+            j += jstep
+            while blossomchilds[b][j] != entrychild:
+                bv = blossomchilds[b][j]
+                if label[bv] == 1:
+                    j += jstep
+                    continue
+                for v in blossom_leaves(bv):
+                    if label[v] != 0:
+                        break
+                if label[v] != 0:
+                    label[v] = 0
+                    label[endpoint[mate[blossombase[bv]]]] = 0
+                    assign_label(v, 2, labelend[v])
+                j += jstep
+        label[b] = labelend[b] = -1
+        blossomchilds[b] = blossomendps[b] = None
+        blossombase[b] = -1
+        blossombestedges[b] = None
+        bestedge[b] = -1
+        unusedblossoms.append(b)
+
+    def augment_blossom(b, v):
+        t = v
+        while blossomparent[t] != b:
+            t = blossomparent[t]
+        if t >= nvertex:
+            augment_blossom(t, v)
+        i = j = blossomchilds[b].index(t)
+        if i & 1:
+            j -= len(blossomchilds[b])
+            jstep, endptrick = 1, 0
+        else:
+            jstep, endptrick = -1, 1
+        while j != 0:
+            j += jstep
+            t = blossomchilds[b][j]
+            p = blossomendps[b][j - endptrick] ^ endptrick
+            if t >= nvertex:
+                augment_blossom(t, endpoint[p])
+            j += jstep
+            t = blossomchilds[b][j]
+            if t >= nvertex:
+                augment_blossom(t, endpoint[p ^ 1])
+            mate[endpoint[p]] = p ^ 1
+            mate[endpoint[p ^ 1]] = p
+        blossomchilds[b] = blossomchilds[b][i:] + blossomchilds[b][:i]
+        blossomendps[b] = blossomendps[b][i:] + blossomendps[b][:i]
+        blossombase[b] = blossombase[blossomchilds[b][0]]
+
+    def augment_matching(k):
+        v, w, _ = edges[k]
+        for s, p in ((v, 2 * k + 1), (w, 2 * k)):
+            while True:
+                bs = inblossom[s]
+                if bs >= nvertex:
+                    augment_blossom(bs, s)
+                mate[s] = p
+                if labelend[bs] == -1:
+                    break
+                t = endpoint[labelend[bs]]
+                bt = inblossom[t]
+                s = endpoint[labelend[bt]]
+                j = endpoint[labelend[bt] ^ 1]
+                if bt >= nvertex:
+                    augment_blossom(bt, j)
+                mate[j] = labelend[bt]
+                p = labelend[bt] ^ 1
+
+    for _ in range(nvertex):
+        # Очередная стадия: ищем путь увеличения от свободных вершин
+        label[:] = (2 * nvertex) * [0]
+        bestedge[:] = (2 * nvertex) * [-1]
+        blossombestedges[nvertex:] = nvertex * [None]
+        allowedge[:] = nedge * [False]
+        queue[:] = []
+        for v in range(nvertex):
+            if mate[v] == -1 and label[inblossom[v]] == 0:
+                assign_label(v, 1, -1)
+
+        augmented = False
+        while True:
+            while queue and not augmented:
+                v = queue.pop()
+                for p in neighbend[v]:
+                    k = p // 2
+                    w = endpoint[p]
+                    if inblossom[v] == inblossom[w]:
+                        continue
+                    if not allowedge[k]:
+                        kslack = dualvar[v] + dualvar[w] - weight2[k]
+                        if kslack <= 0:
+                            allowedge[k] = True
+                    if allowedge[k]:
+                        if label[inblossom[w]] == 0:
+                            assign_label(w, 2, p ^ 1)
+                        elif label[inblossom[w]] == 1:
+                            base = scan_blossom(v, w)
+                            if base >= 0:
+                                add_blossom(base, k)
+                            else:
+                                augment_matching(k)
+                                augmented = True
+                                break
+                        elif label[w] == 0:
+                            label[w] = 2
+                            labelend[w] = p ^ 1
+                    elif label[inblossom[w]] == 1:
+                        b = inblossom[v]
+                        if bestedge[b] == -1 or kslack < slack(bestedge[b]):
+                            bestedge[b] = k
+                    elif label[w] == 0:
+                        if bestedge[w] == -1 or kslack < slack(bestedge[w]):
+                            bestedge[w] = k
+            if augmented:
+                break
+
+            # Путь не найден - меняем двойственные переменные
+            deltatype, delta, deltaedge, deltablossom = -1, None, None, None
+            if not maxcardinality:
+                deltatype, delta = 1, min(dualvar[:nvertex])
+            for v in range(nvertex):
+                k = bestedge[v]
+                if k != -1 and label[inblossom[v]] == 0:
+                    d = dualvar[endpoint[2 * k]] + dualvar[endpoint[2 * k + 1]] - weight2[k]
+                    if deltatype == -1 or d < delta:
+                        delta, deltatype, deltaedge = d, 2, k
+            for b in range(2 * nvertex):
+                if blossomparent[b] == -1 and label[b] == 1 and bestedge[b] != -1:
+                    d = slack(bestedge[b]) // 2
+                    if deltatype == -1 or d < delta:
+                        delta, deltatype, deltaedge = d, 3, bestedge[b]
+            for b in range(nvertex, 2 * nvertex):
+                if (blossombase[b] >= 0 and blossomparent[b] == -1 and label[b] == 2
+                        and (deltatype == -1 or dualvar[b] < delta)):
+                    delta, deltatype, deltablossom = dualvar[b], 4, b
+            if deltatype == -1:
+                deltatype, delta = 1, max(0, min(dualvar[:nvertex]))
+
+            for v in range(nvertex):
+                t = label[inblossom[v]]
+                if t == 1:
+                    dualvar[v] -= delta
+                elif t == 2:
+                    dualvar[v] += delta
+            for b in range(nvertex, 2 * nvertex):
+                if blossombase[b] >= 0 and blossomparent[b] == -1:
+                    if label[b] == 1:
+                        dualvar[b] += delta
+                    elif label[b] == 2:
+                        dualvar[b] -= delta
+
+            if deltatype == 1:
+                break
+            elif deltatype == 2:
+                allowedge[deltaedge] = True
+                i, j, _ = edges[deltaedge]
+                if label[inblossom[i]] == 0:
+                    i, j = j, i
+                queue.append(i)
+            elif deltatype == 3:
+                allowedge[deltaedge] = True
+                i, j, _ = edges[deltaedge]
+                queue.append(i)
+            else:
+                expand_blossom(deltablossom, False)
+
+        if not augmented:
+            break
+        for b in range(nvertex, 2 * nvertex):
+            if blossomparent[b] == -1 and blossombase[b] >= 0 and label[b] == 1 and dualvar[b] == 0:
+                expand_blossom(b, True)
+
+    for v in range(nvertex):
+        if mate[v] >= 0:
+            mate[v] = endpoint[mate[v]]
+    return mate
+
+SWISS_NEIGHBOURS = 10       # соседей по таблице, с которыми сначала пробуем составить пары
+SWISS_SCORE_WEIGHT = 1000   # штраф за квадрат разницы очков
+SWISS_COLOR_WEIGHT = 300    # штраф, если оба хотят играть дома (или оба в гостях)
+SWISS_REMATCH_PENALTY = 10 ** 7
+
+def pair_swiss(ranked: List[str], scores: Dict[str, int], met: set, balance: Dict[str, int],
+               had_bye: set, round_no: int = 1):
+    """Пары тура по швейцарской системе.
+
+    ranked - игроки в порядке таблицы, met - множество frozenset уже сыгранных пар,
+    balance - (домашних - гостевых) матчей. Возвращает ([(хозяин, гость), ...], пропускающий или None).
+    """
+    n = len(ranked)
+    if n < 2:
+        return [], (ranked[0] if ranked else None)
+    bye_vertex = n if n % 2 else None
+    lowest = min(scores.get(p, 0) for p in ranked)
+
+    def pair_weight(i, j):
+        a, b = ranked[i], ranked[j]
+        w = -SWISS_SCORE_WEIGHT * (scores.get(a, 0) - scores.get(b, 0)) ** 2
+        ba, bb = balance.get(a, 0), balance.get(b, 0)
+        if (ba > 0 and bb > 0) or (ba < 0 and bb < 0):
+            w -= SWISS_COLOR_WEIGHT * min(abs(ba), abs(bb))
+        return w
+
+    def bye_weight(i):
+        # Пропуск достается слабейшему: считаем его "соперником" ниже последнего
+        return -SWISS_SCORE_WEIGHT * (scores.get(ranked[i], 0) - lowest + 3) ** 2 - (n - i)
+
+    mate = []
+    for neighbours, allow_rematch in ((SWISS_NEIGHBOURS, False), (n, False), (n, True)):
+        edges = []
+        for i in range(n):
+            for j in range(i + 1, min(n, i + 1 + neighbours)):
+                rematch = frozenset((ranked[i], ranked[j])) in met
+                if rematch and not allow_rematch:
+                    continue
+                edges.append((i, j, pair_weight(i, j) - (SWISS_REMATCH_PENALTY if rematch else 0)))
+        if bye_vertex is not None:
+            candidates = [i for i in range(n) if ranked[i] not in had_bye] or list(range(n))
+            edges += [(i, bye_vertex, bye_weight(i)) for i in candidates]
+        mate = max_weight_matching(edges, maxcardinality=True)
+        total = n + (1 if bye_vertex is not None else 0)
+        if len(mate) == total and all(m >= 0 for m in mate):
+            break
+
+    pairs, bye = [], None
+    for i in range(n):
+        j = mate[i] if i < len(mate) else -1
+        if j == bye_vertex and bye_vertex is not None:
+            bye = ranked[i]
+        elif j > i:
+            a, b = ranked[i], ranked[j]
+            # Дома играет тот, у кого меньше домашних матчей; при равенстве - чередуем по турам
+            ba, bb = balance.get(a, 0), balance.get(b, 0)
+            if ba > bb or (ba == bb and round_no % 2 == 0):
+                a, b = b, a
+            pairs.append((a, b))
+    return pairs, bye
+
+def _swiss_total_rounds(c: sqlite3.Cursor, tournament_id: int) -> int:
+    c.execute("SELECT swiss_rounds FROM tournaments WHERE id=?", (tournament_id,))
+    row = c.fetchone()
+    if row and row["swiss_rounds"]:
+        return row["swiss_rounds"]
+    c.execute("SELECT COUNT(*) FROM players WHERE tournament_id=?", (tournament_id,))
+    return max(math.ceil(math.log2(max(c.fetchone()[0], 2))), 1)
+
+def _pair_next_swiss_round(c: sqlite3.Cursor, tournament_id: int, shuffle: bool = False) -> int:
+    """Формирует следующий тур швейцарки по текущей таблице. Возвращает номер тура"""
+    ordered = _standings(c, tournament_id)
+    ranked = [name for name, _ in ordered]
+    if shuffle:
+        random.shuffle(ranked)
+    scores = {name: st["PTS"] for name, st in ordered}
+
+    c.execute("SELECT home, away, round_no FROM matches WHERE tournament_id=? AND stage='swiss'", (tournament_id,))
+    met, balance, had_bye, last_round = set(), {}, set(), 0
+    for home, away, rnd in c.fetchall():
+        last_round = max(last_round, rnd or 0)
+        if not away:
+            had_bye.add(home)
+            continue
+        met.add(frozenset((home, away)))
+        balance[home] = balance.get(home, 0) + 1
+        balance[away] = balance.get(away, 0) - 1
+
+    round_no = last_round + 1
+    pairs, bye = pair_swiss(ranked, scores, met, balance, had_bye, round_no)
+
+    c.execute("SELECT COALESCE(MAX(match_number), 0) FROM matches WHERE tournament_id=?", (tournament_id,))
+    start_no = c.fetchone()[0] + 1
+    c.executemany("""
+    INSERT INTO matches (tournament_id, match_number, home, away, stage, round_no)
+    VALUES (?, ?, ?, ?, 'swiss', ?)
+    """, [(tournament_id, no, h, a, round_no) for no, (h, a) in enumerate(pairs, start=start_no)])
+    if bye:
+        # Пропуск тура засчитывается как победа (см. compute_standings)
+        seq = _begin_event(c, tournament_id)
+        c.execute("""
+        INSERT INTO matches (tournament_id, match_number, home, away, stage, round_no, played)
+        VALUES (?, ?, ?, '', 'swiss', ?, 1)
+        """, (tournament_id, start_no + len(pairs), bye, round_no))
+        _log_event(c, tournament_id, seq, c.lastrowid, "recorded", None, None)
+    return round_no
+
+def _advance_swiss_if_ready(c: sqlite3.Cursor, tournament_id: int) -> List[str]:
+    """Новый тур создается только когда сыграны все матчи предыдущего"""
+    c.execute("""
+        SELECT COALESCE(MAX(round_no), 0) AS last_round,
+               SUM(CASE WHEN played=0 THEN 1 ELSE 0 END) AS pending
+        FROM matches WHERE tournament_id=? AND stage='swiss'
+    """, (tournament_id,))
+    row = c.fetchone()
+    if row["pending"]:
+        return []
+    total = _swiss_total_rounds(c, tournament_id)
+    if row["last_round"] >= total:
+        return [f"🏁 Швейцарка завершена, сыграно туров: {total}."]
+    round_no = _pair_next_swiss_round(c, tournament_id)
+    return [f"🆕 Сформирован тур {round_no} из {total}."]
+
+def bench_swiss(players: int = 256, rounds: int = 9):
+    """Замер скорости жеребьевки: python bot_py.py --bench-swiss [игроков]"""
+    names = [f"P{i}" for i in range(players)]
+    scores = {p: 0 for p in names}
+    met, balance, had_bye = set(), {}, set()
+    for round_no in range(1, rounds + 1):
+        ranked = sorted(names, key=lambda p: (-scores[p], p))
+        started = time.perf_counter()
+        pairs, bye = pair_swiss(ranked, scores, met, balance, had_bye, round_no)
+        elapsed = (time.perf_counter() - started) * 1000
+        rematches = sum(1 for h, a in pairs if frozenset((h, a)) in met)
+        print(f"Тур {round_no}: {len(pairs)} пар за {elapsed:.1f} мс, повторных встреч: {rematches}")
+        for h, a in pairs:
+            met.add(frozenset((h, a)))
+            balance[h] = balance.get(h, 0) + 1
+            balance[a] = balance.get(a, 0) - 1
+            r = random.random()
+            if r < 0.45:
+                scores[h] += 3
+            elif r < 0.9:
+                scores[a] += 3
+            else:
+                scores[h] += 1
+                scores[a] += 1
+        if bye:
+            had_bye.add(bye)
+            scores[bye] += 3
+
+def get_schedule(tournament_id: int, limit: int = None) -> List[sqlite3.Row]:
+    conn = db()
+    c = conn.cursor()
+    c.execute("""
+    SELECT * FROM matches
+    WHERE tournament_id=? ORDER BY played ASC, match_number ASC
+    """ + ("LIMIT ?" if limit else ""), (tournament_id,) + ((limit,) if limit else ()))
+    rows = c.fetchall()
+    conn.close()
+    return rows
+
+# Строка пакетного ввода: "12 2-1" (ID матча) или "#12 2:1" (номер матча).
+# Допускается вставка строк из расписания: "✅ #3: Амир vs Диас [2:1]"
+BULK_RESULT_RE = re.compile(
+    r"^(?P<hash>#)?(?P<no>\d+)[:.)]?(?:\s+.*?)?\s+\[?(?P<hg>\d+)\s*[-:]\s*(?P<ag>\d+)\]?$"
+)
+MAX_GOALS = 99
+
+def parse_bulk_results(tournament_id: int, text: str):
+    """Разбирает и проверяет пакет результатов. Возвращает (строки, ошибки)"""
+    conn = db()
+    c = conn.cursor()
+    c.execute("SELECT * FROM matches WHERE tournament_id=?", (tournament_id,))
+    matches = c.fetchall()
+    conn.close()
+
+    by_id = {m['id']: m for m in matches}
+    by_no = {match_no(m): m for m in matches}
+
+    rows, errors, seen = [], [], set()
+    for line_no, raw in enumerate(text.splitlines(), start=1):
+        if not raw.strip():
+            continue
+        # Убираем эмодзи статуса и прочий мусор в начале строки
+        line = re.sub(r"^[^\d#]+", "", raw.strip())
+        m = BULK_RESULT_RE.match(line)
+        if not m:
+            errors.append(f"Строка {line_no}: не понял «{raw.strip()[:40]}»")
+            continue
+
+        no = int(m.group('no'))
+        match = by_no.get(no) if m.group('hash') else by_id.get(no)
+        if not match:
+            label = f"#{no}" if m.group('hash') else f"ID {no}"
+            errors.append(f"Строка {line_no}: матч {label} не найден")
+            continue
+        if match['id'] in seen:
+            errors.append(f"Строка {line_no}: матч #{match_no(match)} указан дважды")
+            continue
+
+        hg, ag = int(m.group('hg')), int(m.group('ag'))
+        if hg > MAX_GOALS or ag > MAX_GOALS:
+            errors.append(f"Строка {line_no}: слишком большой счёт {hg}:{ag}")
+            continue
+
+        seen.add(match['id'])
+        rows.append((match, hg, ag))
+
+    return rows, errors
+
+def record_results_bulk(tournament_id: int, rows: List[tuple], user_id: Optional[int] = None) -> List[str]:
+    """Записывает пачку результатов одной транзакцией: либо все, либо ничего"""
+    conn = db()
+    notes = []
+    try:
+        with conn:
+            c = conn.cursor()
+            for match, hg, ag in rows:
+                notes += _apply_result(c, tournament_id, match['id'], hg, ag, user_id)
+    finally:
+        conn.close()
+    return notes
+
+# -------------------------
+# Таблица и тай-брейки
+# -------------------------
+TIEBREAK_RULES = {
+    "h2h": "личные встречи (мини-таблица, рекурсивно)",
+    "gd": "разница мячей",
+    "gf": "забитые мячи",
+    "away_goals": "голы в гостях",
+    "wins": "победы",
+    "fair_play": "фейр-плей (меньше штрафных очков)",
+    "lot": "жребий (детерминированный)",
+}
+DEFAULT_TIEBREAKS = "h2h,gd,gf,away_goals,wins,fair_play,lot"
+
+def parse_tiebreaks(value: Optional[str]) -> List[str]:
+    rules = [r.strip().lower() for r in (value or DEFAULT_TIEBREAKS).split(",") if r.strip()]
+    return [r for r in rules if r in TIEBREAK_RULES]
+
+def set_tiebreaks(tournament_id: int, rules: List[str]):
+    conn = db()
+    c = conn.cursor()
+    c.execute("UPDATE tournaments SET tiebreaks=? WHERE id=?", (",".join(rules), tournament_id))
+    _bump_data_version(c, tournament_id)
+    conn.commit()
+    conn.close()
+    forget_tournament(tournament_id)
+
+def add_fair_play_points(tournament_id: int, name: str, points: int) -> bool:
+    conn = db()
+    c = conn.cursor()
+    c.execute("UPDATE players SET fair_play=COALESCE(fair_play, 0)+? WHERE tournament_id=? AND name=?",
+              (points, tournament_id, name))
+    found = c.rowcount > 0
+    if found:
+        _bump_data_version(c, tournament_id)
+    conn.commit()
+    conn.close()
+    return found
+
+def _lot_key(tournament_id: int, name: str) -> str:
+    # Жребий не должен меняться от перезапуска к перезапуску
+    return hashlib.sha1(f"{tournament_id}:{name}".encode("utf-8")).hexdigest()
+
+def compute_standings(tournament_id: int, names: List[str], results: List[tuple],
+                      rules: Optional[List[str]] = None, fair_play: Optional[Dict[str, int]] = None) -> List[tuple]:
+    """Таблица по списку результатов (хозяин, гость, голы, голы).
+
+    Гость "" - пропуск тура (победа без голов). Равенство очков разбивается
+    правилами rules по порядку; мини-таблицы считаются только для групп равных.
+    """
+    rules = DEFAULT_TIEBREAKS.split(",") if rules is None else rules
+    fair_play = fair_play or {}
+    table = {n: {"P":0, "W":0, "D":0, "L":0, "GF":0, "GA":0, "GD":0, "PTS":0, "AG":0} for n in names}
+
+    # Индекс результатов по игроку - для мини-таблиц личных встреч
+    by_player = {n: [] for n in names}
+    for idx, (home, away, hg, ag) in enumerate(results):
+        if not away:
+            # Пропуск тура в швейцарке засчитывается победой без голов
+            table[home]["P"] += 1; table[home]["W"] += 1
+            table[home]["PTS"] += 3
+            continue
+        table[home]["P"] += 1
+        table[away]["P"] += 1
+        table[home]["GF"] += hg; table[home]["GA"] += ag
+        table[away]["GF"] += ag; table[away]["GA"] += hg
+        table[away]["AG"] += ag
+        if hg > ag:
+            table[home]["W"] += 1; table[away]["L"] += 1
+            table[home]["PTS"] += 3
+        elif hg < ag:
+            table[away]["W"] += 1; table[home]["L"] += 1
+            table[away]["PTS"] += 3
+        else:
+            table[home]["D"] += 1; table[away]["D"] += 1
+            table[home]["PTS"] += 1; table[away]["PTS"] += 1
+        by_player[home].append(idx)
+        by_player[away].append(idx)
+    for n in table:
+        table[n]["GD"] = table[n]["GF"] - table[n]["GA"]
+
+    def mini_table_key(cluster):
+        members = set(cluster)
+        mini = {n: [0, 0, 0] for n in cluster}  # очки, разница, забитые
+        seen = set()
+        for n in cluster:
+            for idx in by_player[n]:
+                if idx in seen:
+                    continue
+                seen.add(idx)
+                home, away, hg, ag = results[idx]
+                if home not in members or away not in members:
+                    continue
+                mini[home][1] += hg - ag; mini[home][2] += hg
+                mini[away][1] += ag - hg; mini[away][2] += ag
+                if hg > ag:
+                    mini[home][0] += 3
+                elif hg < ag:
+                    mini[away][0] += 3
+                else:
+                    mini[home][0] += 1; mini[away][0] += 1
+        return lambda n: tuple(-v for v in mini[n])
+
+    simple_keys = {
+        "gd": lambda n: -table[n]["GD"],
+        "gf": lambda n: -table[n]["GF"],
+        "away_goals": lambda n: -table[n]["AG"],
+        "wins": lambda n: -table[n]["W"],
+        "fair_play": lambda n: fair_play.get(n, 0),
+        "lot": lambda n: _lot_key(tournament_id, n),
+    }
+
+    def split(cluster, key):
+        groups = {}
+        for n in cluster:
+            groups.setdefault(key(n), []).append(n)
+        return [groups[k] for k in sorted(groups)]
+
+    def break_ties(cluster, rest):
+        if len(cluster) < 2:
+            return cluster
+        if not rest:
+            return sorted(cluster)
+        rule = rest[0]
+        if rule == "h2h":
+            parts = split(cluster, mini_table_key(cluster))
+            if len(parts) == 1:
+                return break_ties(cluster, rest[1:])
+            # Мини-таблица пересчитывается заново среди тех, кто остался равным
+            return [n for part in parts for n in break_ties(part, rest)]
+        return [n for part in split(cluster, simple_keys[rule]) for n in break_ties(part, rest[1:])]
+
+    ordered = []
+    for cluster in split(sorted(names), lambda n: -table[n]["PTS"]):
+        ordered += break_ties(cluster, rules)
+    return [(n, table[n]) for n in ordered]
+
+def _standings(c: sqlite3.Cursor, tournament_id: int, group_name: Optional[str] = None) -> List[tuple]:
+    if group_name:
+        c.execute("SELECT name, fair_play FROM players WHERE tournament_id=? AND group_name=?", (tournament_id, group_name))
+    else:
+        c.execute("SELECT name, fair_play FROM players WHERE tournament_id=?", (tournament_id,))
+    players = c.fetchall()
+
+    if group_name:
+        c.execute("""SELECT home, away, home_goals, away_goals FROM matches
+                     WHERE tournament_id=? AND played=1 AND stage='group' AND group_name=?""", (tournament_id, group_name))
+    else:
+        c.execute("SELECT home, away, home_goals, away_goals FROM matches WHERE tournament_id=? AND played=1", (tournament_id,))
+    results = [tuple(r) for r in c.fetchall() if not r[1] or (r[2] is not None and r[3] is not None)]
+
+    c.execute("SELECT tiebreaks FROM tournaments WHERE id=?", (tournament_id,))
+    row = c.fetchone()
+    rules = parse_tiebreaks(row["tiebreaks"] if row else None)
+
+    return compute_standings(
+        tournament_id,
+        [p["name"] for p in players],
+        results,
+        rules,
+        {p["name"]: p["fair_play"] or 0 for p in players},
+    )
+
+def _load_standings(tournament_id: int, group_name: Optional[str] = None) -> List[tuple]:
+    conn = db()
+    try:
+        return _standings(conn.cursor(), tournament_id, group_name)
+    finally:
+        conn.close()
+
+def get_standings(tournament_id: int, group_name: Optional[str] = None) -> List[tuple]:
+    return cached_render(tournament_id, "standings", lambda: _load_standings(tournament_id, group_name), group_name)
+
+def _html_escape(s: str) -> str:
+    return (s.replace("&", "&amp;")
+             .replace("<", "&lt;")
+             .replace(">", "&gt;"))
+
+def format_table(tournament_id: int, ordered: List[tuple]) -> str:
+    # ширины колонок, все числа вправо
+    # #  Игрок         И  В  Н  П   ±   О
+    header = f"{'#':<2}{'Игрок':<12}{'И':>3}{'В':>3}{'Н':>3}{'П':>3}{'±':>5}{'О':>4}"
+    lines = [header, "─" * len(header)]
+
+    for i, (name, st) in enumerate(ordered, start=1):
+        club = get_player_club(tournament_id, name)
+        short = get_short_club_name(club) if club else ""
+        display = f"{name[:8]}({short})" if club else name[:12]
+        if len(display) > 12:
+            display = display[:11] + "…"
+
+        lines.append(
+            f"{i:<2}"
+            f"{display:<12}"
+            f"{st['P']:>3}{st['W']:>3}{st['D']:>3}{st['L']:>3}"
+            f"{st['GD']:>5}{st['PTS']:>4}"
+        )
+
+    table = "\n".join(lines)
+    return f"<pre>{_html_escape(table)}</pre>"
+
+def format_knockout_round(stage: str, rnd: int, last_round: int) -> str:
+    if stage == "final":
+        return "🏆 Гранд-финал"
+    if stage == "losers":
+        return f"⬇️ Нижняя сетка, раунд {rnd}"
+    left = 2 ** (last_round - rnd)
+    return "🏆 Финал" if left == 1 else f"🥊 1/{left} финала"
+
+def format_bracket(tournament_id: int) -> str:
+    """Сетка плей-офф текстом (HTML). Пустая строка, если сетки нет"""
+    conn = db()
+    c = conn.cursor()
+    c.execute(f"""
+        SELECT * FROM matches
+        WHERE tournament_id=? AND stage IN ({",".join("?" * len(KNOCKOUT_STAGES))})
+        ORDER BY match_number
+    """, (tournament_id,) + KNOCKOUT_STAGES)
+    matches = c.fetchall()
+    c.execute("SELECT format FROM tournaments WHERE id=?", (tournament_id,))
+    row = c.fetchone()
+    conn.close()
+    if not matches:
+        return ""
+
+    double = bool(row) and row["format"] == "double_elim"
+    last_round = {}
+    for m in matches:
+        last_round[m['stage']] = max(last_round.get(m['stage'], 0), m['round_no'] or 1)
+
+    stage_order = {"winners": 0, "playoff": 0, "losers": 1, "final": 2}
+    rounds = {}
+    for m in matches:
+        rounds.setdefault((stage_order.get(m['stage'], 9), m['stage'], m['round_no'] or 1), []).append(m)
+
+    lines = []
+    for (_, stage, rnd), ms in sorted(rounds.items()):
+        title = format_knockout_round(stage, rnd, last_round[stage])
+        if double and stage == "winners":
+            title = f"⬆️ Верхняя сетка, раунд {rnd}"
+        lines.append(f"\n{title}")
+        for m in ms:
+            home = _html_escape(m['home']) if m['home'] else "?"
+            away = _html_escape(m['away']) if m['away'] else "?"
+            if m['played']:
+                lines.append(f"✅ #{match_no(m)}: {home} {m['home_goals']}:{m['away_goals']} {away}")
+            else:
+                lines.append(f"⏳ #{match_no(m)}: {home} vs {away}")
+    return "\n".join(lines).strip()
+
+def get_group_names(tournament_id: int) -> List[str]:
+    conn = db()
+    c = conn.cursor()
+    c.execute("""SELECT DISTINCT group_name FROM players
+                 WHERE tournament_id=? AND group_name IS NOT NULL ORDER BY group_name""", (tournament_id,))
+    rows = [r["group_name"] for r in c.fetchall()]
+    conn.close()
+    return rows
+
+def get_knockout_champion(tournament_id: int) -> Optional[str]:
+    """Победитель последнего матча сетки (финала), если он сыгран"""
+    conn = db()
+    c = conn.cursor()
+    c.execute(f"""
+        SELECT * FROM matches
+        WHERE tournament_id=? AND next_match_id IS NULL AND played=1
+          AND stage IN ({",".join("?" * len(KNOCKOUT_STAGES))})
+        ORDER BY match_number DESC LIMIT 1
+    """, (tournament_id,) + KNOCKOUT_STAGES)
+    m = c.fetchone()
+    conn.close()
+    if not m or m['stage'] == "losers":
+        return None
+    return m['home'] if m['home_goals'] > m['away_goals'] else m['away']
+
+def format_standings(tournament: sqlite3.Row) -> str:
+    """Таблица или сетка турнира в зависимости от формата (HTML)"""
+    return cached_render(tournament['id'], "standings_html", lambda: _render_standings(tournament['id']))
+
+def _render_standings(tid: int) -> str:
+    # Формат берем из базы: строка турнира у вызывающего могла устареть
+    fmt = get_tournament(tid)['format'] or "league"
+    if fmt in ("single_elim", "double_elim"):
+        return format_bracket(tid) or "Сетка еще не сформирована. Сгенерируйте расписание."
+    if fmt == "groups_playoff":
+        parts = [f"Группа {g}\n{format_table(tid, get_standings(tid, g))}" for g in get_group_names(tid)]
+        bracket = format_bracket(tid)
+        if bracket:
+            parts.append(bracket)
+        return "\n\n".join(parts) or "Группы еще не сформированы. Сгенерируйте расписание."
+    return format_table(tid, get_standings(tid))
+
+def format_schedule(tournament_id: int) -> str:
+    """Текст расписания; пустая строка, если матчей нет"""
+    return cached_render(tournament_id, "schedule", lambda: _render_schedule(tournament_id))
+
+def _render_schedule(tournament_id: int) -> str:
+    sched = get_schedule(tournament_id)
+    if not sched:
+        return ""
+
+    lines = ["📅 РАСПИСАНИЕ МАТЧЕЙ:\n"]
+    for m in sched:
+        status = "✅" if m['played'] else "⏳"
+        hg = m['home_goals'] if m['home_goals'] is not None else "-"
+        ag = m['away_goals'] if m['away_goals'] is not None else "-"
+        no = match_no(m)
+
+        home_short = m['home'][:8] if m['home'] else "?"
+        away_short = m['away'][:8] if m['away'] else "?"
+        if m['played'] and not m['away']:
+            lines.append(f"💤 #{no}: {home_short} пропускает тур (+3)")
+            continue
+
+        lines.append(f"{status} #{no}: {home_short} vs {away_short} [{hg}:{ag}]")
+    return "\n".join(lines)
+
+def get_current_tournament_prize(tournament_id: int) -> str:
+    conn = db()
+    c = conn.cursor()
+    c.execute("SELECT prize FROM tournaments WHERE id=?", (tournament_id,))
+    row = c.fetchone()
+    conn.close()
+    return row["prize"] if row and row["prize"] else "приз"
+
+CLUB_SHORT_NAMES = {
+    # England
+    "Newcastle United": "NEW", "Tottenham Hotspur": "TOT", "Chelsea": "CHE", 
+    "Arsenal": "ARS", "Liverpool": "LIV", "Manchester United": "MUN", 
+    "Manchester City": "MCI", "Aston Villa": "AVL", "Crystal Palace": "CRY",
+    "Brighton": "BRI", "West Ham": "WHU", "Nottingham Forest": "NFO",
+    # Italy  
+    "AC Milan": "MIL", "Inter Milan": "INT", "Juventus": "JUV", 
+    "Napoli": "NAP", "Roma": "ROM", "Atalanta": "ATA",
+    # Germany
+    "Leipzig": "LEI", "Bayer Leverkusen": "LEV", "Borussia Dortmund": "BVB",
+    "Bayern Munich": "BAY", "Frankfurt": "FRA", "Stuttgart": "STU",
+    # Spain
+    "Real Madrid": "RMA", "Barcelona": "BAR", "Atletico Madrid": "ATM",
+    "Athletic Bilbao": "ATH", "Sevilla": "SEV", "Real Betis": "BET",
+    "Real Sociedad": "RSO", "Girona": "GIR", "Villarreal": "VIL",
+    # France
+    "Lyon": "LYO", "Paris Saint-Germain": "PSG", "Olympique de Marseille": "MAR",
+    "AS Monaco": "MON", "OGC Nice": "NIC",
+    # Other
+    "Ajax": "AJX", "PSV": "PSV", "Galatasaray": "GAL", "Fenerbahçe": "FEN",
+    "Beşiktaş": "BES", "Benfica": "BEN", "Sporting": "SPO",
+    "Al Nassr": "NAS", "Al Hilal": "HIL", "Al Ittihad": "ITT",
+    # National teams
+    "Spain": "ESP", "Portugal": "POR", "Netherlands": "NED", "Germany": "GER",
+    "Argentina": "ARG", "France": "FRA", "England": "ENG", "Italy": "ITA",
+    "Japan": "JPN", "South Korea": "KOR", "Morocco": "MAR", "Croatia": "CRO",
+    "Norway": "NOR", "Sweden": "SWE", "Denmark": "DEN"
+}
+
+def get_short_club_name(club: str) -> str:
+    """Сокращает название клуба для компактного отображения"""
+    return CLUB_SHORT_NAMES.get(club, club[:3].upper())
+
+def get_match_by_id(tournament_id: int, match_id: int) -> Optional[sqlite3.Row]:
+    conn = db()
+    c = conn.cursor()
+    c.execute("SELECT * FROM matches WHERE tournament_id=? AND id=?", (tournament_id, match_id))
+    row = c.fetchone()
+    conn.close()
+    return row
+
+def get_funny_match_comment(home_goals: int, away_goals: int) -> str:
+    """Генерирует смешной комментарий по результату матча"""
+    total_goals = home_goals + away_goals
+    
+    if home_goals == away_goals:
+        return random.choice(DRAW_COMMENTS)
+    elif total_goals >= 6:
+        return random.choice(HIGH_SCORE_COMMENTS)
+    elif total_goals <= 1:
+        return random.choice(LOW_SCORE_COMMENTS)
+    else:
+        return random.choice(MATCH_COMMENTS)
+
+def get_funny_message(ordered: List[tuple], prize: str) -> Optional[str]:
+    """Обновленная функция с более интересными комментариями"""
+    if not ordered:
+        return None
+    
+    top_score = ordered[0][1]['PTS']
+    leaders = [name for name, st in ordered if st['PTS'] == top_score]
+    
+    # Тексты собираются только для нужного случая: leaders[1] есть лишь при дележе лидерства
+    if len(leaders) == 1:
+        return random.choice([
+            f"👑 {leaders[0]} правит балом! {prize} уже пахнет победой!",
+            f"🔥 {leaders[0]} в огне! Остальные курят в сторонке!",
+            f"⚡ {leaders[0]} на коне! {prize} почти в кармане!",
+            f"🚀 {leaders[0]} летит к {prize} как ракета!",
+            f"👏 {leaders[0]} показывает класс! {prize} ждет своего героя!"
+        ])
+    elif len(leaders) == 2:
+        return random.choice([
+            f"🤝 {leaders[0]} и {leaders[1]} не могут определиться! {prize} в подвешенном состоянии!",
+            f"⚔️ {leaders[0]} против {leaders[1]}! Битва за {prize} накаляется!",
+            f"🎭 {' VS '.join(leaders)} - драма достойная Оскара! {prize} ждет!",
+            f"🔥 Дуэль века: {' и '.join(leaders)}! {prize} дрожит от напряжения!"
+        ])
+    else:
+        return random.choice([
+            f"🌪️ Полный хаос в турнире! {len(leaders)} претендентов на {prize}!",
+            f"🎪 Цирк продолжается! {len(leaders)} клоунов борются за {prize}!",
+            f"🍯 {prize} привлекает {len(leaders)} пчел! Кто первый доберется?",
+            f"🎲 Кубик брошен! {len(leaders)} игроков в игре за {prize}!"
+        ])
+
+# -------------------------
+# Поиск клуба по части названия
+# -------------------------
+# Индекс строится один раз: нормализованные названия, короткие коды и
+# прозвища -> клуб. Запрос сравнивается по точному совпадению, префиксу
+# слова, подстроке и, для опечаток, по триграммам.
+CLUB_ALIASES = {
+    "Barcelona": ["barca", "барса", "барселона"],
+    "Real Madrid": ["real", "реал", "реал мадрид"],
+    "Atletico Madrid": ["atleti", "атлетико"],
+    "Manchester United": ["man utd", "man united", "mu", "манчестер юнайтед", "мю"],
+    "Manchester City": ["man city", "city", "ман сити", "манчестер сити"],
+    "Tottenham Hotspur": ["spurs", "тоттенхэм"],
+    "Newcastle United": ["magpies", "ньюкасл"],
+    "Wolverhampton": ["wolves", "вулверхэмптон"],
+    "Arsenal": ["gunners", "арсенал"],
+    "Chelsea": ["челси"],
+    "Liverpool": ["ливерпуль"],
+    "West Ham United": ["west ham", "вест хэм"],
+    "Fullham": ["fulham"],
+    "Paris Saint-Germain": ["psg", "пари сен жермен", "псж"],
+    "Olympique de Marseille": ["marseille", "om", "марсель"],
+    "Bayern Munich": ["bayern", "bayern munchen", "бавария"],
+    "Borussia Dortmund": ["dortmund", "боруссия дортмунд"],
+    "Borussia Mönchengladbach": ["gladbach", "гладбах"],
+    "Bayer Leverkusen": ["leverkusen", "байер"],
+    "Leipzig": ["rb leipzig", "лейпциг"],
+    "Juventus": ["juve", "ювентус", "юве"],
+    "Inter Milan": ["inter", "internazionale", "интер"],
+    "AC Milan": ["milan", "милан"],
+    "Napoli": ["наполи"],
+    "Roma": ["рома"],
+    "Hellas Verona FC": ["verona"],
+    "Benfica": ["бенфика"],
+    "Sporting": ["sporting cp", "спортинг"],
+    "Ajax": ["аякс"],
+    "Galatasaray": ["галатасарай"],
+    "Fenerbahçe": ["фенербахче"],
+    "Al Nassr": ["насср"],
+    "Al Hilal": ["хилал"],
+    "Boca Juniors": ["boca", "бока"],
+    "River Plate": ["river", "ривер"],
+}
+CLUB_SEARCH_LIMIT = 8
+# Буквы, которые NFKD не раскладывает на основу и диакритику
+_FOLD_EXTRA = str.maketrans({"ø": "o", "æ": "ae", "œ": "oe", "đ": "d", "ł": "l", "ı": "i", "ё": "е"})
+
+def fold_text(text: str) -> str:
+    """Нижний регистр без диакритики и знаков: «Mönchengladbach» -> «monchengladbach»"""
+    text = unicodedata.normalize("NFKD", text.casefold().translate(_FOLD_EXTRA))
+    text = "".join(ch for ch in text if not unicodedata.combining(ch))
+    return " ".join(re.sub(r"[^\w]+", " ", text).split())
+
+def _trigrams(key: str) -> set:
+    padded = f"  {key} "
+    return {padded[i:i + 3] for i in range(len(padded) - 2)}
+
+_club_index: Optional[dict] = None
+
+def get_club_index() -> dict:
+    """keys: [(ключ, клуб, страна)], grams: триграмма -> номера ключей"""
+    global _club_index
+    if _club_index is None:
+        keys = []
+        for country, clubs in CLUBS_DB.items():
+            for club in clubs:
+                names = {club, CLUB_SHORT_NAMES.get(club, "")} | set(CLUB_ALIASES.get(club, []))
+                keys += [(fold_text(n), club, country) for n in names if n]
+        grams: Dict[str, set] = {}
+        for i, (key, _, _) in enumerate(keys):
+            for g in _trigrams(key):
+                grams.setdefault(g, set()).add(i)
+        _club_index = {"keys": keys, "grams": grams}
+    return _club_index
+
+def _club_match_score(query: str, key: str, query_grams: set) -> float:
+    if key == query:
+        return 3.0
+    if key.startswith(query) or f" {query}" in f" {key}":
+        return 2.0 + len(query) / len(key)  # префикс слова; чем полнее, тем выше
+    if query in key:
+        return 1.5 + len(query) / len(key)
+    key_grams = _trigrams(key)
+    return 2 * len(query_grams & key_grams) / (len(query_grams) + len(key_grams))  # коэффициент Дайса
+
+def search_clubs(query: str, limit: int = CLUB_SEARCH_LIMIT) -> List[tuple]:
+    """Клубы по части названия, прозвищу или коду: [(клуб, страна)] по убыванию похожести"""
+    query = fold_text(query)
+    if not query:
+        return []
+    index = get_club_index()
+    query_grams = _trigrams(query)
+    candidates = set()
+    for g in query_grams:
+        candidates |= index["grams"].get(g, set())
+    best: Dict[str, tuple] = {}
+    for i in candidates:
+        key, club, country = index["keys"][i]
+        score = _club_match_score(query, key, query_grams)
+        if score >= 0.45 and score > best.get(club, (0,))[0]:
+            best[club] = (score, country)
+    ranked = sorted(best.items(), key=lambda item: (-item[1][0], item[0]))
+    return [(club, country) for club, (_, country) in ranked[:limit]]
+
+# -------------------------
+# Состояние диалогов
+# -------------------------
+FLOW_TTL = int(os.getenv("FLOW_TTL", "900"))  # брошенный диалог живет 15 минут
+FLOW_SWEEP_EVERY = 60
+
+class ScoreFlow:
+    """Ввод счета матча (новый результат или правка). Только id и введенные голы"""
+    __slots__ = ("tournament_id", "match_id", "edit", "home_goals", "away_goals", "touched")
+
+    def __init__(self, tournament_id: int, match_id: int, edit: bool = False):
+        self.tournament_id = tournament_id
+        self.match_id = match_id
+        self.edit = edit
+        self.home_goals: Optional[int] = None
+        self.away_goals: Optional[int] = None
+        self.touched = time.monotonic()
+
+    def set_goals(self, match: sqlite3.Row, player_name: str, goals: int):
+        if player_name == match['home']:
+            self.home_goals = goals
+        else:
+            self.away_goals = goals
+
+    def complete(self) -> bool:
+        return self.home_goals is not None and self.away_goals is not None
+
+    def reset(self):
+        self.home_goals = self.away_goals = None
+
+class ClubFlow:
+    """Ручное назначение клуба: выбранный игрок и страна"""
+    __slots__ = ("tournament_id", "player_id", "country", "touched")
+
+    def __init__(self, tournament_id: int, player_id: int):
+        self.tournament_id = tournament_id
+        self.player_id = player_id
+        self.country: Optional[str] = None
+        self.touched = time.monotonic()
+
+# (chat_id, user_id) -> объект диалога; у пользователя один активный диалог на чат
+_flows: Dict[tuple, object] = {}
+_flows_swept = 0.0
+
+def sweep_flows(now: Optional[float] = None) -> int:
+    """Удаляет диалоги, к которым не возвращались дольше FLOW_TTL"""
+    global _flows_swept
+    now = time.monotonic() if now is None else now
+    _flows_swept = now
+    expired = [key for key, flow in _flows.items() if now - flow.touched > FLOW_TTL]
+    for key in expired:
+        del _flows[key]
+    return len(expired)
+
+def start_flow(chat_id: int, user_id: int, flow):
+    if time.monotonic() - _flows_swept > FLOW_SWEEP_EVERY:
+        sweep_flows()
+    _flows[(chat_id, user_id)] = flow
+
+def get_flow(chat_id: int, user_id: int, kind: type):
+    """Активный диалог нужного типа или None (просроченный сразу удаляется)"""
+    flow = _flows.get((chat_id, user_id))
+    if not isinstance(flow, kind):
+        return None
+    now = time.monotonic()
+    if now - flow.touched > FLOW_TTL:
+        del _flows[(chat_id, user_id)]
+        return None
+    flow.touched = now
+    return flow
+
+def end_flow(chat_id: int, user_id: int):
+    _flows.pop((chat_id, user_id), None)
+
+def flow_memory_by_chat() -> Dict[int, int]:
+    """Байты, занятые состоянием диалогов, по чатам"""
+    usage: Dict[int, int] = {}
+    for (chat_id, _), flow in _flows.items():
+        size = sys.getsizeof(flow) + sum(sys.getsizeof(getattr(flow, slot)) for slot in flow.__slots__)
+        usage[chat_id] = usage.get(chat_id, 0) + size
+    return usage
+
+# -------------------------
+# Живая таблица
+# -------------------------
+LIVE_TABLE_DEBOUNCE = float(os.getenv("LIVE_TABLE_DEBOUNCE", "5"))
+
+def get_live_table(tournament_id: int) -> Optional[sqlite3.Row]:
+    conn = db()
+    c = conn.cursor()
+    c.execute("SELECT * FROM live_tables WHERE tournament_id=?", (tournament_id,))
+    row = c.fetchone()
+    conn.close()
+    return row
+
+def set_live_table(tournament_id: int, chat_id: int, message_id: int, version: int = 0):
+    conn = db()
+    c = conn.cursor()
+    c.execute("""
+        INSERT OR REPLACE INTO live_tables (tournament_id, chat_id, message_id, version)
+        VALUES (?, ?, ?, ?)
+    """, (tournament_id, chat_id, message_id, version))
+    conn.commit()
+    conn.close()
+
+def mark_live_table(tournament_id: int, version: int):
+    """Запоминает, какая версия данных сейчас в закрепе"""
+    conn = db()
+    conn.execute("UPDATE live_tables SET version=? WHERE tournament_id=?", (version, tournament_id))
+    conn.commit()
+    conn.close()
+
+def get_stale_live_tables() -> List[int]:
+    """Живые таблицы, отставшие от данных (обновление не успело до остановки)"""
+    conn = db()
+    c = conn.cursor()
+    c.execute("""
+        SELECT l.tournament_id, l.chat_id FROM live_tables l
+        LEFT JOIN data_versions v ON v.tournament_id = l.tournament_id
+        WHERE COALESCE(v.version, 0) > COALESCE(l.version, 0)
+    """)
+    rows = [r["tournament_id"] for r in c.fetchall() if owns_chat(r["chat_id"])]
+    conn.close()
+    return rows
+
+def delete_live_table(tournament_id: int):
+    conn = db()
+    c = conn.cursor()
+    c.execute("DELETE FROM live_tables WHERE tournament_id=?", (tournament_id,))
+    conn.commit()
+    conn.close()
+
+def format_live_table(tournament: sqlite3.Row) -> str:
+    msg = format_standings(tournament)
+    return (
+        f"📌 ТАБЛИЦА (обновляется автоматически)\n"
+        f"🏆 {_html_escape(tournament['name'])}\n\n"
+        f"{msg}\n\n"
+        f"🕒 Обновлено: {datetime.now().strftime('%d.%m %H:%M')}"
+    )
+
+def get_main_menu_keyboard(is_admin: bool = True, has_tournament: bool = False):
+    """Клавиатура с учетом прав пользователя и наличия турнира"""
+    keyboard = []
+    
+    # Кнопки для работы с турнирами
+    keyboard.append([InlineKeyboardButton("🏆 Выбрать турнир", callback_data="select_tournament")])
+    
+    if is_admin:
+        keyboard.append([InlineKeyboardButton("🆕 Создать турнир", callback_data="new_tournament")])
+    
+    # Кнопки для работы с текущим турниром (показываем только если турнир выбран)
+    if has_tournament:
+        keyboard.extend([
+            [InlineKeyboardButton("👥 Добавить игрока", callback_data="add_player"),
+             InlineKeyboardButton("👥+ Добавить списком", callback_data="add_players_list")],
+            [InlineKeyboardButton("⚽ Назначить клубы", callback_data="assign_clubs_menu")],
+            [InlineKeyboardButton("📊 Таблица", callback_data="show_table"),
+             InlineKeyboardButton("📋 Расписание", callback_data="show_schedule")],
+            [InlineKeyboardButton("⚽ Записать результат", callback_data="record_result"),
+             InlineKeyboardButton("✏️ Изменить результат", callback_data="edit_result")]
+        ])
+        
+        if is_admin:
+            keyboard.append([InlineKeyboardButton("🏟 Формат турнира", callback_data="tournament_format"),
+                             InlineKeyboardButton("📅 Генерировать расписание", callback_data="generate_schedule")])
+            keyboard.append([InlineKeyboardButton("📌 Живая таблица вкл/выкл", callback_data="toggle_live_table"),
+                             InlineKeyboardButton("🔁 Новый сезон", callback_data="new_season")])
+            keyboard.append([InlineKeyboardButton("🏁 Завершить турнир", callback_data="finish_tournament")])
+    
+    return InlineKeyboardMarkup(keyboard)
+
+def get_tournaments_keyboard(tournaments: List[sqlite3.Row], current_tournament_id: int = None):
+    """Клавиатура для выбора турнира"""
+    keyboard = []
+    
+    if not tournaments:
+        keyboard.append([InlineKeyboardButton("❌ Нет турниров", callback_data="no_tournaments")])
+    else:
+        for tournament in tournaments:
+            # Показываем статус текущего турнира
+            status = "🟢" if tournament['id'] == current_tournament_id else "⚪"
+            text = f"{status} {tournament['name'][:20]}"
+            keyboard.append([InlineKeyboardButton(text, callback_data=f"choose_tournament_{tournament['id']}")])
+    
+    keyboard.append([InlineKeyboardButton("◀️ Назад", callback_data="main_menu")])
+    return InlineKeyboardMarkup(keyboard)
+
+def get_season_keyboard():
+    """Клавиатура выбора клубов для нового сезона"""
+    keyboard = [[InlineKeyboardButton(title, callback_data=f"new_season_{mode}")]
+                for mode, title in SEASON_CLUB_MODES.items()]
+    keyboard.append([InlineKeyboardButton("◀️ Назад", callback_data="main_menu")])
+    return InlineKeyboardMarkup(keyboard)
+
+def get_formats_keyboard(current_format: str):
+    """Клавиатура выбора формата турнира"""
+    keyboard = []
+    for fmt, title in TOURNAMENT_FORMATS.items():
+        status = "🟢" if fmt == current_format else "⚪"
+        keyboard.append([InlineKeyboardButton(f"{status} {title}", callback_data=f"set_format_{fmt}")])
+    keyboard.append([InlineKeyboardButton("◀️ Назад", callback_data="main_menu")])
+    return InlineKeyboardMarkup(keyboard)
+
+def get_players_keyboard(tournament_id: int):
+    """Клавиатура для выбора игрока для назначения клуба"""
+    return cached_render(tournament_id, "players_kb", lambda: _build_players_keyboard(tournament_id))
+
+def _build_players_keyboard(tournament_id: int):
+    keyboard = []
+    players_without_clubs = get_players_without_clubs(tournament_id)
+    
+    for i in range(0, len(players_without_clubs), 2):
+        row = []
+        for j in range(i, min(i + 2, len(players_without_clubs))):
+            player = players_without_clubs[j]
+            row.append(InlineKeyboardButton(f"👤 {player['name']}", callback_data=f"select_player_{player['id']}"))
+        keyboard.append(row)
+    
+    keyboard.append([InlineKeyboardButton("🎲 Жребий всем", callback_data="assign_random"),
+                     InlineKeyboardButton("🎯 С гандикапом", callback_data="assign_random_handicap")])
+    keyboard.append([InlineKeyboardButton("◀️ Назад", callback_data="main_menu")])
+    return InlineKeyboardMarkup(keyboard)
+
+def get_countries_keyboard():
+    keyboard = []
+    countries = list(CLUBS_DB.keys())
+    
+    for i in range(0, len(countries), 2):
+        row = []
+        for j in range(i, min(i + 2, len(countries))):
+            country = countries[j]
+            flag_emoji = get_country_flag(country)
+            row.append(InlineKeyboardButton(f"{flag_emoji} {country}", callback_data=f"country_{country}"))
+        keyboard.append(row)
+    keyboard.append([InlineKeyboardButton("◀️ Назад к игрокам", callback_data="assign_clubs_menu")])
+    return InlineKeyboardMarkup(keyboard)
+
+def get_clubs_keyboard(country: str, player_name: str):
+    keyboard = []
+    clubs = CLUBS_DB.get(country, [])
+    
+    for i in range(0, len(clubs), 2):
+        row = []
+        for j in range(i, min(i + 2, len(clubs))):
+            club = clubs[j]
+            row.append(InlineKeyboardButton(club, callback_data=f"assign_club_{country}_{club}"))
+        keyboard.append(row)
+    keyboard.append([InlineKeyboardButton("◀️ Назад к странам", callback_data="select_country")])
+    return InlineKeyboardMarkup(keyboard)
+
+def get_club_search_keyboard(found: List[tuple]):
+    """Найденные клубы: одно нажатие - назначение"""
+    keyboard = [[InlineKeyboardButton(f"{get_country_flag(country)} {club}", callback_data=f"assign_club_{country}_{club}")]
+                for club, country in found]
+    keyboard.append([InlineKeyboardButton("🌍 Выбрать по странам", callback_data="select_country")])
+    return InlineKeyboardMarkup(keyboard)
+
+def get_matches_keyboard(tournament_id: int, unplayed_only: bool = True, for_edit: bool = False):
+    return cached_render(tournament_id, "matches_kb",
+                         lambda: _build_matches_keyboard(tournament_id, unplayed_only, for_edit),
+                         unplayed_only, for_edit)
+
+def _build_matches_keyboard(tournament_id: int, unplayed_only: bool, for_edit: bool):
+    keyboard = []
+    matches = get_schedule(tournament_id, 100)
+
+    if unplayed_only:
+        # Матчи сетки, где соперники еще не определены, пропускаем
+        matches = [m for m in matches if not m['played'] and m['home'] and m['away']]
+    elif for_edit:
+        matches = [m for m in matches if m['played'] and m['away']]  # Для редактирования только сыгранные
+
+    if not matches:
+        return InlineKeyboardMarkup([[InlineKeyboardButton("◀️ Назад", callback_data="main_menu")]])
+
+    for match in matches:
+        status = "⚽" if not match['played'] else "✅"
+        hg = match['home_goals'] if match['home_goals'] is not None else "-"
+        ag = match['away_goals'] if match['away_goals'] is not None else "-"
+        no = match_no(match)
+
+        text_full = f"{status} #{no}: {match['home']} vs {match['away']} [{hg}:{ag}]"
+        if len(text_full) > 40:
+            home_short = match['home'][:7] if len(match['home']) > 7 else match['home']
+            away_short = match['away'][:7] if len(match['away']) > 7 else match['away']
+            text_full = f"{status} #{no}: {home_short}-{away_short} [{hg}:{ag}]"
+
+        callback_prefix = "edit_match_" if for_edit else "select_match_"
+        keyboard.append([InlineKeyboardButton(text_full, callback_data=f"{callback_prefix}{match['id']}")])
+
+    keyboard.append([InlineKeyboardButton("◀️ Назад", callback_data="main_menu")])
+    return InlineKeyboardMarkup(keyboard)
+
+def get_score_keyboard(match_id: int, player_name: str, is_edit: bool = False):
+    """Клавиатура для выбора количества голов"""
+    keyboard = []
+    
+    for i in range(0, 21, 5): 
+        row = []
+        for j in range(i, min(i + 5, 11)):
+            callback_prefix = "edit_score_" if is_edit else "score_"
+            row.append(InlineKeyboardButton(str(j), callback_data=f"{callback_prefix}{match_id}_{player_name}_{j}"))
+        keyboard.append(row)
+    
+    back_callback = "edit_result" if is_edit else "record_result"
+    keyboard.append([InlineKeyboardButton("◀️ Назад", callback_data=back_callback)])
+    return InlineKeyboardMarkup(keyboard)
+
+def get_country_flag(country: str) -> str:
+    flags = {
+        "England": "🏴󠁧󠁢󠁥󠁮󠁧󠁿",
+        "Italy": "🇮🇹",
+        "Germany": "🇩🇪", 
+        "Spain": "🇪🇸",
+        "France": "🇫🇷",
+        "Netherlands": "🇳🇱",
+        "Turkey": "🇹🇷",
+        "Portugal": "🇵🇹",
+        "Saudi Arabia": "🇸🇦",
+        "National teams": "🌍"
+    }
+    return flags.get(country, "⚽")
+
+async def send_new_menu(update: Update, context: ContextTypes.DEFAULT_TYPE, text: str, **kwargs):
+    """Отправляет новое меню (удаляет старое сообщение и отправляет новое)"""
+    chat_id = update.effective_chat.id
+    user_is_admin = await is_admin(update, context)
+    current_tournament = get_current_tournament(chat_id)
+    
+    # Определяем клавиатуру по умолчанию
+    default_markup = get_main_menu_keyboard(user_is_admin, bool(current_tournament))
+    reply_markup = kwargs.get('reply_markup', default_markup)
+    parse_mode = kwargs.get('parse_mode', None)
+    
+    try:
+        # Удаляем старое сообщение если это callback query
+        if hasattr(update, 'callback_query') and update.callback_query and update.callback_query.message:
+            await update.callback_query.message.delete()
+    except Exception as e:
+        print(f"Ошибка удаления сообщения: {e}")
+    
+    # Отправляем новое сообщение
+    try:
+        if hasattr(update, 'callback_query') and update.callback_query:
+            await context.bot.send_message(
+                chat_id=chat_id,
+                text=text,
+                reply_markup=reply_markup,
+                parse_mode=parse_mode
+            )
+        else:
+            await update.message.reply_text(
+                text,
+                reply_markup=reply_markup,
+                parse_mode=parse_mode
+            )
+    except Exception as e:
+        print(f"Ошибка отправки сообщения: {e}")
+        # Попробуем отправить базовое сообщение без клавиатуры
+        try:
+            if hasattr(update, 'callback_query') and update.callback_query:
+                await context.bot.send_message(chat_id=chat_id, text="⚠️ Ошибка отображения меню. Попробуйте /start")
+            else:
+                await update.message.reply_text("⚠️ Ошибка отображения меню. Попробуйте /start")
+        except Exception:
+            pass
+
+_live_table_tasks: Dict[int, asyncio.Task] = {}
+_live_table_last_edit: Dict[int, float] = {}
+
+async def enable_live_table(application: Application, chat_id: int, tournament: sqlite3.Row):
+    """Публикует и закрепляет живую таблицу турнира"""
+    version = get_data_version(tournament['id'])
+    message = await application.bot.send_message(
+        chat_id=chat_id,
+        text=format_live_table(tournament),
+        parse_mode=ParseMode.HTML
+    )
+    try:
+        await application.bot.pin_chat_message(
+            chat_id=chat_id, message_id=message.message_id, disable_notification=True
+        )
+    except Exception as e:
+        print(f"Ошибка закрепления таблицы: {e}")
+    set_live_table(tournament['id'], chat_id, message.message_id, version)
+    _live_table_last_edit[tournament['id']] = time.monotonic()
+
+async def disable_live_table(application: Application, tournament_id: int):
+    """Отключает живую таблицу и открепляет сообщение"""
+    live = get_live_table(tournament_id)
+    if not live:
+        return
+    task = _live_table_tasks.pop(tournament_id, None)
+    if task:
+        task.cancel()
+    delete_live_table(tournament_id)
+    try:
+        await application.bot.unpin_chat_message(chat_id=live['chat_id'], message_id=live['message_id'])
+    except Exception as e:
+        print(f"Ошибка открепления таблицы: {e}")
+
+async def _refresh_live_table(application: Application, tournament_id: int, delay: float):
+    try:
+        while True:
+            await asyncio.sleep(delay)
+            live = get_live_table(tournament_id)
+            tournament = get_tournament(tournament_id)
+            if not live or not tournament:
+                return
+            _live_table_last_edit[tournament_id] = time.monotonic()
+            version = get_data_version(tournament_id)
+            try:
+                await application.bot.edit_message_text(
+                    chat_id=live['chat_id'],
+                    message_id=live['message_id'],
+                    text=format_live_table(tournament),
+                    parse_mode=ParseMode.HTML
+                )
+                mark_live_table(tournament_id, version)
+            except BadRequest as e:
+                if "not modified" in str(e).lower():
+                    mark_live_table(tournament_id, version)
+                elif "not found" in str(e).lower():
+                    # Сообщение удалили из чата - публикуем таблицу заново
+                    await enable_live_table(application, live['chat_id'], tournament)
+                else:
+                    raise
+            # Результат, записанный во время редактирования, застал эту задачу
+            # незавершенной и нового обновления не запланировал - догоняем сами
+            if get_data_version(tournament_id) == version:
+                return
+            delay = LIVE_TABLE_DEBOUNCE
+    except asyncio.CancelledError:
+        raise
+    except Exception as e:
+        print(f"Ошибка обновления живой таблицы: {e}")
+    finally:
+        if _live_table_tasks.get(tournament_id) is asyncio.current_task():
+            del _live_table_tasks[tournament_id]
+
+def schedule_live_table_update(application: Application, tournament_id: int) -> bool:
+    """Планирует обновление живой таблицы. Возвращает False, если она не включена.
+
+    Серия результатов за окно LIVE_TABLE_DEBOUNCE склеивается в одно редактирование.
+    """
+    if not get_live_table(tournament_id):
+        return False
+    task = _live_table_tasks.get(tournament_id)
+    if task and not task.done():
+        return True
+    since_last = time.monotonic() - _live_table_last_edit.get(tournament_id, 0.0)
+    delay = max(LIVE_TABLE_DEBOUNCE - since_last, 1.0)
+    _live_table_tasks[tournament_id] = application.create_task(
+        _refresh_live_table(application, tournament_id, delay)
+    )
+    return True
+
+# -------------------------
+# Инлайн-режим: @bot table, @bot next Амир
+# -------------------------
+# В инлайн-запросе нет чата, поэтому турниры пользователя находим по чатам,
+# где он уже писал боту: таблица chat_users с ключом (user_id, chat_id).
+INLINE_CACHE_TIME = int(os.getenv("INLINE_CACHE_TIME", "30"))  # секунд кэша на стороне Telegram
+INLINE_TOURNAMENTS = 5
+INLINE_FIXTURES = 5
+CHAT_USER_REFRESH = 3600  # не чаще раза в час обновляем last_seen пары
+INLINE_TABLE_WORDS = {"", "table", "t", "таблица", "табло"}
+INLINE_NEXT_WORDS = {"next", "n", "след", "матчи", "игры"}
+
+_chat_users_seen: Dict[tuple, float] = {}
+
+def remember_chat_user(chat_id: int, user_id: int):
+    now = time.monotonic()
+    _sweep_guard(now)
+    key = (user_id, chat_id)
+    if now - _chat_users_seen.get(key, -CHAT_USER_REFRESH) < CHAT_USER_REFRESH:
+        return
+    _chat_users_seen[key] = now
+    conn = db()
+    c = conn.cursor()
+    c.execute("""
+        INSERT INTO chat_users (user_id, chat_id, last_seen) VALUES (?, ?, ?)
+        ON CONFLICT(user_id, chat_id) DO UPDATE SET last_seen=excluded.last_seen
+    """, (user_id, chat_id, datetime.now().isoformat()))
+    conn.commit()
+    conn.close()
+
+async def track_chat_user(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Запоминает, в каких чатах бывает пользователь (группа -1, до остальных обработчиков)"""
+    if update.effective_chat and update.effective_user:
+        try:
+            remember_chat_user(update.effective_chat.id, update.effective_user.id)
+        except Exception as e:
+            print(f"Ошибка учета пользователя чата: {e}")
+
+def get_user_tournaments(user_id: int, limit: int = INLINE_TOURNAMENTS) -> List[sqlite3.Row]:
+    """Текущие турниры чатов пользователя, сначала недавние"""
+    conn = db()
+    c = conn.cursor()
+    c.execute("""
+        SELECT t.* FROM chat_users u
+        JOIN chat_current_tournament cc ON cc.chat_id = u.chat_id
+        JOIN tournaments t ON t.id = cc.tournament_id
+        WHERE u.user_id=? ORDER BY u.last_seen DESC LIMIT ?
+    """, (user_id, limit))
+    rows = c.fetchall()
+    conn.close()
+    return rows
+
+# Несыгранные матчи турнира: турнир -> (версия данных, матчи). Имя из запроса фильтруется
+# в памяти, иначе каждая набранная буква заводила бы свою запись кэша
+_unplayed_cache: Dict[int, tuple] = {}
+
+def get_unplayed_fixtures(tournament_id: int) -> List[sqlite3.Row]:
+    """Несыгранные матчи с известными соперниками по порядку; кэш на версию данных"""
+    version = get_data_version(tournament_id)
+    cached = _unplayed_cache.get(tournament_id)
+    if cached and cached[0] == version:
+        return cached[1]
+    conn = db()
+    c = conn.cursor()
+    c.execute("""
+        SELECT * FROM matches WHERE tournament_id=? AND played=0 AND home<>'' AND away<>''
+        ORDER BY match_number
+    """, (tournament_id,))
+    fixtures = c.fetchall()
+    conn.close()
+    _unplayed_cache[tournament_id] = (version, fixtures)
+    return fixtures
+
+def get_next_fixtures(tournament_id: int, name: str = "", limit: int = INLINE_FIXTURES) -> List[sqlite3.Row]:
+    """Ближайшие несыгранные матчи турнира; с name - только матчи игроков, чье имя его содержит"""
+    key = _name_key(name)
+    fixtures = []
+    for m in get_unplayed_fixtures(tournament_id):
+        if not key or key in _name_key(m["home"]) or key in _name_key(m["away"]):
+            fixtures.append(m)
+            if len(fixtures) == limit:
+                break
+    return fixtures
+
+def parse_inline_query(text: str) -> tuple:
+    """("table", "") или ("next", имя). Просто имя - это его ближайшие матчи"""
+    word, _, rest = text.strip().partition(" ")
+    if word.casefold() in INLINE_TABLE_WORDS:
+        return "table", ""
+    if word.casefold() in INLINE_NEXT_WORDS:
+        return "next", rest.strip()
+    return "next", text.strip()
+
+def _inline_table(t: sqlite3.Row) -> InlineQueryResultArticle:
+    ordered = get_standings(t["id"])
+    leader = f"Лидер: {ordered[0][0]}, {ordered[0][1]['PTS']} очк." if ordered and ordered[0][1]["P"] else "Матчей еще не было"
+    text = f"📊 {_html_escape(t['name'])}\n\n{format_standings(t)}"
+    return InlineQueryResultArticle(
+        id=f"t{t['id']}v{get_data_version(t['id'])}",
+        title=f"📊 {t['name']}",
+        description=leader,
+        input_message_content=InputTextMessageContent(text, parse_mode=ParseMode.HTML),
+    )
+
+def _inline_fixtures(t: sqlite3.Row, name: str) -> Optional[InlineQueryResultArticle]:
+    fixtures = get_next_fixtures(t["id"], name)
+    if not fixtures:
+        return None
+    title = f"⏭ {name}: ближайшие матчи" if name else "⏭ Ближайшие матчи"
+    lines = [f"{title} — {t['name']}"]
+    lines += [f"#{match_no(m)}: {m['home']} vs {m['away']}" for m in fixtures]
+    return InlineQueryResultArticle(
+        id=f"n{t['id']}v{get_data_version(t['id'])}-{hashlib.md5(_name_key(name).encode()).hexdigest()[:12]}",
+        title=f"{title} — {t['name']}",
+        description=", ".join(f"{m['home']} vs {m['away']}" for m in fixtures[:2]),
+        input_message_content=InputTextMessageContent("\n".join(lines)),
+    )
+
+async def inline_query(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Таблица или ближайшие матчи текущих турниров пользователя из любого чата"""
+    query = update.inline_query
+    try:
+        kind, name = parse_inline_query(query.query)
+        results = []
+        for t in get_user_tournaments(query.from_user.id):
+            if kind == "table":
+                results.append(cached_render(t["id"], "inline_table", lambda: _inline_table(t)))
+            else:
+                result = _inline_fixtures(t, name)
+                if result:
+                    results.append(result)
+        button = None
+        if not results:
+            button = InlineQueryResultsButton(text="Турниров не найдено — откройте бота", start_parameter="inline")
+        # Результаты зависят от пользователя, поэтому кэш Telegram - персональный
+        await query.answer(results, cache_time=INLINE_CACHE_TIME, is_personal=True, button=button)
+    except Exception as e:
+        print(f"Ошибка в inline_query: {e}")
+
+# -------------------------
+# Дедлайны и напоминания
+# -------------------------
+REMIND_BEFORE = float(os.getenv("REMIND_BEFORE_HOURS", "24")) * 3600
+DEADLINE_FORMAT = "%d.%m %H:%M"
+
+# Куча таймеров (время, вид, турнир, тур, срок). Один job в очереди приложения всегда
+# взведен на вершину кучи; запись со сроком, не совпадающим с базой, считается устаревшей.
+_timer_heap: List[tuple] = []
+_timer_job = None
+
+def set_deadline(tournament_id: int, round_no: int, due_at: datetime):
+    conn = db()
+    c = conn.cursor()
+    c.execute("""
+        INSERT OR REPLACE INTO deadlines (tournament_id, round_no, due_at, reminded, expired)
+        VALUES (?, ?, ?, 0, 0)
+    """, (tournament_id, round_no, due_at.isoformat(timespec="minutes")))
+    conn.commit()
+    conn.close()
+
+def delete_deadline(tournament_id: int, round_no: int) -> bool:
+    conn = db()
+    c = conn.cursor()
+    c.execute("DELETE FROM deadlines WHERE tournament_id=? AND round_no=?", (tournament_id, round_no))
+    found = c.rowcount > 0
+    conn.commit()
+    conn.close()
+    return found
+
+def get_deadlines(tournament_id: int) -> List[sqlite3.Row]:
+    conn = db()
+    c = conn.cursor()
+    c.execute("SELECT * FROM deadlines WHERE tournament_id=? ORDER BY round_no", (tournament_id,))
+    rows = c.fetchall()
+    conn.close()
+    return rows
+
+def set_auto_forfeit(tournament_id: int, enabled: bool):
+    conn = db()
+    c = conn.cursor()
+    c.execute("UPDATE tournaments SET auto_forfeit=? WHERE id=?", (int(enabled), tournament_id))
+    _bump_data_version(c, tournament_id)
+    conn.commit()
+    conn.close()
+    forget_tournament(tournament_id)
+
+def parse_deadline(text: str, now: Optional[datetime] = None) -> datetime:
+    """'25.10 21:00', '25.10' (до 23:59), '+48h' или '+3d'"""
+    now = now or datetime.now()
+    text = text.strip()
+    m = re.fullmatch(r"\+(\d+)\s*([hdчд])", text, re.IGNORECASE)
+    if m:
+        hours = int(m.group(1)) * (24 if m.group(2).lower() in "dд" else 1)
+        return (now + timedelta(hours=hours)).replace(second=0, microsecond=0)
+    for fmt in (DEADLINE_FORMAT, "%d.%m"):
+        try:
+            due = datetime.strptime(text, fmt).replace(year=now.year)
+        except ValueError:
+            continue
+        if fmt == "%d.%m":
+            due = due.replace(hour=23, minute=59)
+        if due < now - timedelta(days=1):
+            due = due.replace(year=now.year + 1)  # 05.01 в декабре - это следующий год
+        return due
+    raise ValueError(text)
+
+def _push_timers(deadline: sqlite3.Row):
+    due = datetime.fromisoformat(deadline["due_at"]).timestamp()
+    key = (deadline["tournament_id"], deadline["round_no"], deadline["due_at"])
+    if not deadline["reminded"] and due - REMIND_BEFORE > time.time():
+        heapq.heappush(_timer_heap, (due - REMIND_BEFORE, "remind") + key)
+    if not deadline["expired"]:
+        heapq.heappush(_timer_heap, (due, "expire") + key)
+
+def _arm_timers(application: Application):
+    """Перевзводит единственный job диспетчера на ближайший таймер"""
+    global _timer_job
+    if application.job_queue is None:
+        return
+    if _timer_job is not None:
+        _timer_job.schedule_removal()
+        _timer_job = None
+    if _timer_heap:
+        _timer_job = application.job_queue.run_once(
+            dispatch_timers, when=max(_timer_heap[0][0] - time.time(), 0), name="deadline_timers")
+
+def schedule_deadline(application: Application, tournament_id: int, round_no: int):
+    conn = db()
+    c = conn.cursor()
+    c.execute("SELECT * FROM deadlines WHERE tournament_id=? AND round_no=?", (tournament_id, round_no))
+    row = c.fetchone()
+    conn.close()
+    if row:
+        _push_timers(row)
+        _arm_timers(application)
+
+def load_timers(application: Application) -> int:
+    """При запуске поднимает таймеры из базы"""
+    if application.job_queue is None:
+        print("⚠️ Очередь задач недоступна (нужен python-telegram-bot[job-queue]), дедлайны отключены.")
+        return 0
+    conn = db()
+    c = conn.cursor()
+    c.execute("""
+        SELECT d.*, t.chat_id FROM deadlines d JOIN tournaments t ON t.id = d.tournament_id
+        WHERE d.reminded=0 OR d.expired=0
+    """)
+    rows = [r for r in c.fetchall() if owns_chat(r["chat_id"])]
+    conn.close()
+    for row in rows:
+        _push_timers(row)
+    conn = db()
+    reports = [r for r in conn.execute("SELECT * FROM pending_results") if owns_chat(r["chat_id"])]
+    conn.close()
+    for row in reports:
+        _push_report_timer(row)
+    _arm_timers(application)
+    return len(rows) + len(reports)
+
+def _pending_round_matches(c: sqlite3.Cursor, tournament_id: int, round_no: int) -> List[sqlite3.Row]:
+    c.execute("""
+        SELECT * FROM matches
+        WHERE tournament_id=? AND round_no=? AND played=0 AND home<>'' AND away<>''
+        ORDER BY match_number
+    """, (tournament_id, round_no))
+    return c.fetchall()
+
+def _mention(name: str, user_id: Optional[int]) -> str:
+    """Имя участника (HTML); привязанного к аккаунту - с упоминанием, чтобы пришло уведомление"""
+    if user_id:
+        return f'<a href="tg://user?id={user_id}">{_html_escape(name)}</a>'
+    return _html_escape(name)
+
+def _fire_timer(kind: str, tournament_id: int, round_no: int, due_at: str) -> Optional[tuple]:
+    """Обрабатывает один таймер. Возвращает (chat_id, строки сообщения в HTML) или None"""
+    if kind == "confirm":
+        return _auto_confirm_report(tournament_id, round_no, due_at)  # вместо тура - id матча
+    conn = db()
+    try:
+        with conn:
+            c = conn.cursor()
+            c.execute("""
+                SELECT d.*, t.chat_id, t.name, t.auto_forfeit FROM deadlines d
+                JOIN tournaments t ON t.id = d.tournament_id
+                WHERE d.tournament_id=? AND d.round_no=? AND d.due_at=?
+            """, (tournament_id, round_no, due_at))
+            deadline = c.fetchone()
+            if not deadline or deadline["reminded" if kind == "remind" else "expired"]:
+                return None  # срок перенесли или таймер уже сработал
+
+            pending = _pending_round_matches(c, tournament_id, round_no)
+            when = datetime.fromisoformat(due_at).strftime(DEADLINE_FORMAT)
+            title = _html_escape(deadline['name'])
+            c.execute("SELECT name, user_id FROM players WHERE tournament_id=? AND user_id IS NOT NULL", (tournament_id,))
+            linked = {p["name"]: p["user_id"] for p in c.fetchall()}
+            ping = lambda m: f"  #{match_no(m)} {_mention(m['home'], linked.get(m['home']))} vs {_mention(m['away'], linked.get(m['away']))}"
+            lines = []
+            # Условный UPDATE - заявка на таймер: сработает ровно один процесс
+            if kind == "remind":
+                c.execute("UPDATE deadlines SET reminded=1 WHERE tournament_id=? AND round_no=? AND reminded=0",
+                          (tournament_id, round_no))
+                if not c.rowcount:
+                    return None
+                if pending:
+                    lines.append(f"⏰ {title}, тур {round_no} — срок до {when}:")
+                    lines += [ping(m) for m in pending]
+            else:
+                c.execute("UPDATE deadlines SET reminded=1, expired=1 WHERE tournament_id=? AND round_no=? AND expired=0",
+                          (tournament_id, round_no))
+                if not c.rowcount:
+                    return None
+                if pending and deadline["auto_forfeit"]:
+                    forfeited = []
+                    for m in pending:
+                        # В сетке ничьих не бывает - такие матчи оставляем админам
+                        if m["stage"] in KNOCKOUT_STAGES:
+                            continue
+                        _apply_result(c, tournament_id, m["id"], 0, 0)
+                        forfeited.append(m)
+                    if forfeited:
+                        lines.append(f"⌛ {title}, тур {round_no}: срок вышел, засчитано 0:0:")
+                        lines += [f"  #{match_no(m)} {_html_escape(m['home'])} — {_html_escape(m['away'])}"
+                                  for m in forfeited]
+                    done = {m["id"] for m in forfeited}
+                    pending = [m for m in pending if m["id"] not in done]
+                if pending:
+                    lines.append(f"⌛ {title}, тур {round_no}: срок вышел, не сыграны:")
+                    lines += [ping(m) for m in pending]
+            return (deadline["chat_id"], lines) if lines else None
+    finally:
+        conn.close()
+
+async def dispatch_timers(context: ContextTypes.DEFAULT_TYPE):
+    """Снимает с кучи все созревшие таймеры и шлет по одному сообщению на чат"""
+    global _timer_job
+    _timer_job = None
+    application = context.application
+    by_chat: Dict[int, List[str]] = {}
+    touched = set()
+    now = time.time()
+    while _timer_heap and _timer_heap[0][0] <= now + 1:
+        _, kind, tid, round_no, due_at = heapq.heappop(_timer_heap)
+        try:
+            fired = _fire_timer(kind, tid, round_no, due_at)
+        except Exception as e:
+            print(f"Ошибка таймера дедлайна {tid}/{round_no}: {e}")
+            continue
+        if fired:
+            chat_id, lines = fired
+            by_chat.setdefault(chat_id, []).extend(lines)
+            touched.add(tid)
+
+    for chat_id, lines in by_chat.items():
+        try:
+            await application.bot.send_message(chat_id=chat_id, text="\n".join(lines), parse_mode=ParseMode.HTML)
+        except Exception as e:
+            print(f"Ошибка отправки напоминания в чат {chat_id}: {e}")
+    for tid in touched:
+        schedule_live_table_update(application, tid)
+    _arm_timers(application)
+
+# -------------------------
+# Результаты от игроков: заявка и подтверждение соперником
+# -------------------------
+# Игрок привязывает себя к участнику турнира (/iam), заявляет счет своего
+# матча (/report), соперник подтверждает одной кнопкой. Без ответа заявка
+# подтверждается сама через REPORT_CONFIRM_TIMEOUT - таймер живет в той же
+# куче, что и сроки туров.
+REPORT_CONFIRM_TIMEOUT = float(os.getenv("REPORT_CONFIRM_HOURS", "24")) * 3600
+
+def find_player(tournament_id: int, name: str) -> Optional[sqlite3.Row]:
+    key = _name_key(name)
+    for p in get_players(tournament_id):
+        if _name_key(p["name"]) == key:
+            return p
+    return None
+
+def get_linked_player(tournament_id: int, user_id: int) -> Optional[sqlite3.Row]:
+    conn = db()
+    c = conn.cursor()
+    c.execute("SELECT * FROM players WHERE user_id=? AND tournament_id=?", (user_id, tournament_id))
+    row = c.fetchone()
+    conn.close()
+    return row
+
+def link_player(tournament_id: int, name: str, user_id: int, force: bool = False) -> sqlite3.Row:
+    """Привязывает аккаунт к участнику турнира. force - перепривязка админом"""
+    player = find_player(tournament_id, name)
+    if not player:
+        raise ValueError(f"Игрока «{name}» нет в турнире.")
+    if player["user_id"] and player["user_id"] != user_id and not force:
+        raise ValueError(f"{player['name']} уже привязан к другому аккаунту. Перепривязать может админ.")
+    conn = db()
+    with conn:
+        # Один аккаунт - один участник турнира
+        conn.execute("UPDATE players SET user_id=NULL WHERE tournament_id=? AND user_id=?", (tournament_id, user_id))
+        conn.execute("UPDATE players SET user_id=? WHERE id=?", (user_id, player["id"]))
+    conn.close()
+    return player
+
+def get_match_players(match_id: int) -> tuple:
+    conn = db()
+    c = conn.cursor()
+    c.execute("SELECT home, away FROM matches WHERE id=?", (match_id,))
+    row = c.fetchone()
+    conn.close()
+    return (row["home"], row["away"]) if row else ()
+
+def _report_due(row: sqlite3.Row) -> float:
+    return datetime.fromisoformat(row["due_at"]).timestamp()
+
+def _push_report_timer(row: sqlite3.Row):
+    heapq.heappush(_timer_heap, (_report_due(row), "confirm", row["tournament_id"], row["match_id"], row["due_at"]))
+
+def report_result(tournament_id: int, match_id: int, hg: int, ag: int, user_id: int, chat_id: int) -> tuple:
+    """Заявка игрока на счет своего матча. Возвращает (матч, соперник)"""
+    conn = db()
+    try:
+        with conn:
+            c = conn.cursor()
+            c.execute("SELECT * FROM matches WHERE tournament_id=? AND id=?", (tournament_id, match_id))
+            match = c.fetchone()
+            if not match:
+                raise ResultError("Матч не найден.")
+            if match["played"]:
+                raise ResultError(f"Матч #{match_no(match)} уже записан. Исправить может админ.")
+            if not match["home"] or not match["away"]:
+                raise ResultError(f"Соперники в матче #{match_no(match)} еще не определены.")
+            if match["stage"] in KNOCKOUT_STAGES and hg == ag:
+                raise ResultError(f"Матч #{match_no(match)} - плей-офф, ничьи не бывает. Укажите счет с учетом пенальти.")
+            c.execute("SELECT name FROM players WHERE user_id=? AND tournament_id=?", (user_id, tournament_id))
+            me = c.fetchone()
+            if not me or me["name"] not in (match["home"], match["away"]):
+                raise ResultError("Заявить счет может только участник матча (привязка: /iam Имя).")
+            opponent = match["away"] if me["name"] == match["home"] else match["home"]
+            due_at = datetime.fromtimestamp(time.time() + REPORT_CONFIRM_TIMEOUT).isoformat(timespec="seconds")
+            c.execute("""
+                INSERT OR REPLACE INTO pending_results
+                    (match_id, tournament_id, home_goals, away_goals, reporter_id, chat_id, due_at)
+                VALUES (?, ?, ?, ?, ?, ?, ?)
+            """, (match_id, tournament_id, hg, ag, user_id, chat_id, due_at))
+        return match, opponent
+    finally:
+        conn.close()
+
+def get_pending_report(match_id: int) -> Optional[sqlite3.Row]:
+    conn = db()
+    c = conn.cursor()
+    c.execute("SELECT * FROM pending_results WHERE match_id=?", (match_id,))
+    row = c.fetchone()
+    conn.close()
+    return row
+
+def _take_report(c: sqlite3.Cursor, match_id: int, due_at: Optional[str] = None) -> Optional[sqlite3.Row]:
+    """Забирает заявку в рамках транзакции; None - ее уже обработали"""
+    c.execute("SELECT * FROM pending_results WHERE match_id=?", (match_id,))
+    pending = c.fetchone()
+    if not pending or (due_at and pending["due_at"] != due_at):
+        return None
+    c.execute("DELETE FROM pending_results WHERE match_id=? AND due_at=?", (match_id, pending["due_at"]))
+    return pending if c.rowcount else None
+
+def confirm_report(match_id: int, user_id: int, user_is_admin: bool) -> tuple:
+    """Подтверждение соперником (или админом). Возвращает (заявка, заметки)"""
+    conn = db()
+    try:
+        with conn:
+            c = conn.cursor()
+            pending = _take_report(c, match_id)
+            if not pending:
+                raise ResultError("Заявка уже обработана.")
+            c.execute("SELECT * FROM matches WHERE id=?", (match_id,))
+            match = c.fetchone()
+            if match and not match["played"]:
+                c.execute("SELECT name FROM players WHERE user_id=? AND tournament_id=?", (user_id, pending["tournament_id"]))
+                me = c.fetchone()
+                opponent = me and me["name"] in (match["home"], match["away"]) and user_id != pending["reporter_id"]
+                if not opponent and not user_is_admin:
+                    raise ResultError("Подтвердить может соперник или админ.")
+                notes = _apply_result(c, pending["tournament_id"], match_id,
+                                      pending["home_goals"], pending["away_goals"], user_id)
+        # Ниже заявка уже снята и удаление зафиксировано
+        if not match:
+            raise ResultError("Матча больше нет (расписание пересоздано) — заявка снята.")
+        if match["played"]:
+            raise ResultError(f"Матч #{match_no(match)} уже записан — заявка снята.")
+        return pending, notes
+    finally:
+        conn.close()
+
+def reject_report(match_id: int, user_id: int, user_is_admin: bool) -> sqlite3.Row:
+    """Отклонение соперником или отзыв автором заявки"""
+    conn = db()
+    try:
+        with conn:
+            c = conn.cursor()
+            c.execute("SELECT * FROM pending_results WHERE match_id=?", (match_id,))
+            pending = c.fetchone()
+            if not pending:
+                raise ResultError("Заявка уже обработана.")
+            c.execute("SELECT home, away FROM matches WHERE id=?", (match_id,))
+            match = c.fetchone()
+            if not match:
+                c.execute("DELETE FROM pending_results WHERE match_id=?", (match_id,))
+                return pending  # матча больше нет - снимать нечего, кроме самой заявки
+            c.execute("SELECT name FROM players WHERE user_id=? AND tournament_id=?", (user_id, pending["tournament_id"]))
+            me = c.fetchone()
+            if not (me and me["name"] in (match["home"], match["away"])) and not user_is_admin:
+                raise ResultError("Отклонить может участник матча или админ.")
+            c.execute("DELETE FROM pending_results WHERE match_id=?", (match_id,))
+        return pending
+    finally:
+        conn.close()
+
+def _auto_confirm_report(tournament_id: int, match_id: int, due_at: str) -> Optional[tuple]:
+    conn = db()
+    try:
+        with conn:
+            c = conn.cursor()
+            pending = _take_report(c, match_id, due_at)
+            if not pending:
+                return None  # подтвердили, отклонили или заявили заново
+            c.execute("SELECT * FROM matches WHERE id=?", (match_id,))
+            match = c.fetchone()
+            if not match or match["played"]:
+                return None  # матч удален при пересоздании расписания или уже записан
+            _apply_result(c, tournament_id, match_id, pending["home_goals"], pending["away_goals"], pending["reporter_id"])
+            return pending["chat_id"], [f"✅ #{match_no(match)} {_html_escape(match['home'])} {pending['home_goals']}:"
+                                        f"{pending['away_goals']} {_html_escape(match['away'])} — подтверждено автоматически"]
+    finally:
+        conn.close()
+
+def schedule_report(application: Application, match_id: int):
+    row = get_pending_report(match_id)
+    if row:
+        _push_report_timer(row)
+        _arm_timers(application)
+
+def get_report_keyboard(match_id: int) -> InlineKeyboardMarkup:
+    return InlineKeyboardMarkup([[
+        InlineKeyboardButton("✅ Подтвердить", callback_data=f"rep_ok_{match_id}"),
+        InlineKeyboardButton("❌ Отклонить", callback_data=f"rep_no_{match_id}"),
+    ]])
+
+async def report_button(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Кнопки заявки: права проверяются по привязке, админ - только если нужно"""
+    query = update.callback_query
+    try:
+        action, match_id = query.data[4:6], int(query.data[7:])
+        user_id = update.effective_user.id
+        pending = get_pending_report(match_id)
+        if not pending:
+            raise ResultError("Заявка уже обработана.")
+        # Участнику матча хватает привязки; остальных проверяем на админство через Telegram
+        linked = get_linked_player(pending["tournament_id"], user_id)
+        participant = linked and linked["name"] in get_match_players(match_id)
+        own_report = action == "ok" and user_id == pending["reporter_id"]
+        admin = await is_admin(update, context) if not participant or own_report else False
+        if action == "ok":
+            pending, notes = confirm_report(match_id, user_id, admin)
+            text = f"{query.message.text}\n\n✅ Подтверждено." + "".join(f"\n{n}" for n in notes)
+            schedule_live_table_update(context.application, pending["tournament_id"])
+        else:
+            reject_report(match_id, user_id, admin)
+            text = f"{query.message.text}\n\n❌ Заявка отклонена — результат не записан."
+        await query.answer()
+        await query.edit_message_text(text)
+    except ResultError as e:
+        await query.answer(str(e), show_alert=True)
+    except Exception as e:
+        print(f"Ошибка в report_button: {e}")
+        await query.answer("❌ Ошибка.", show_alert=True)
+
+# -------------------------
+# Обслуживание базы и бэкапы
+# -------------------------
+MAINTENANCE_INTERVAL = float(os.getenv("DB_MAINTENANCE_HOURS", "6")) * 3600
+BACKUP_INTERVAL = float(os.getenv("DB_BACKUP_HOURS", "24")) * 3600
+BACKUP_DIR = os.getenv("DB_BACKUP_DIR", os.path.join(os.path.dirname(DB_PATH), "backups"))
+BACKUP_KEEP = int(os.getenv("DB_BACKUP_KEEP", "7"))
+INCREMENTAL_VACUUM = os.getenv("DB_INCREMENTAL_VACUUM", "0") == "1"
+BACKUP_PAGES_PER_STEP = 256
+
+# Бэкап - операция над всей базой, поэтому не админы чата, а владельцы бота
+BOT_ADMINS = {int(x) for x in re.split(r"[,\s]+", os.getenv("BOT_ADMINS", "")) if x.isdigit()}
+
+def is_bot_admin(update: Update) -> bool:
+    return bool(update.effective_user) and update.effective_user.id in BOT_ADMINS
+
+def run_maintenance() -> Dict[str, float]:
+    """Чекпоинт WAL, обновление статистики планировщика и (по желанию) incremental vacuum.
+    Выполняется в отдельном потоке. Возвращает длительности шагов в мс"""
+    timings: Dict[str, float] = {}
+    conn = db()
+    try:
+        t0 = time.perf_counter()
+        busy, wal_pages, moved = conn.execute("PRAGMA wal_checkpoint(TRUNCATE);").fetchone()
+        timings["checkpoint"] = (time.perf_counter() - t0) * 1000
+        timings["wal_pages"] = wal_pages
+        if busy:
+            print("⚠️ wal_checkpoint: база занята, WAL усечен не полностью")
+
+        t0 = time.perf_counter()
+        conn.execute("PRAGMA optimize;")
+        timings["optimize"] = (time.perf_counter() - t0) * 1000
+
+        if INCREMENTAL_VACUUM:
+            t0 = time.perf_counter()
+            if conn.execute("PRAGMA auto_vacuum;").fetchone()[0] != 2:
+                # Режим включается только полной перестройкой файла - один раз
+                conn.execute("PRAGMA auto_vacuum=INCREMENTAL;")
+                conn.execute("VACUUM;")
+            freed = conn.execute("PRAGMA freelist_count;").fetchone()[0]
+            conn.execute("PRAGMA incremental_vacuum;").fetchall()
+            timings["vacuum"] = (time.perf_counter() - t0) * 1000
+            timings["freed_pages"] = freed
+    finally:
+        conn.close()
+    return timings
+
+def _rotate_backups():
+    base = os.path.splitext(os.path.basename(DB_PATH))[0]
+    files = sorted(f for f in os.listdir(BACKUP_DIR) if f.startswith(base + "-") and f.endswith(".db"))
+    for name in files[:-BACKUP_KEEP] if BACKUP_KEEP > 0 else []:
+        os.remove(os.path.join(BACKUP_DIR, name))
+
+def backup_database() -> tuple:
+    """Горячий бэкап через online backup API SQLite. Возвращает (путь, байт, секунд)"""
+    os.makedirs(BACKUP_DIR, exist_ok=True)
+    base = os.path.splitext(os.path.basename(DB_PATH))[0]
+    path = os.path.join(BACKUP_DIR, f"{base}-{datetime.now():%Y%m%d-%H%M%S}.db")
+    tmp = path + ".tmp"
+    t0 = time.perf_counter()
+    src = db()
+    dst = sqlite3.connect(tmp)
+    try:
+        # Копируем порциями, чтобы запись в базу не ждала весь бэкап
+        src.backup(dst, pages=BACKUP_PAGES_PER_STEP)
+    finally:
+        dst.close()
+        src.close()
+    os.replace(tmp, path)
+    _rotate_backups()
+    return path, os.path.getsize(path), time.perf_counter() - t0
+
+async def maintenance_job(context: ContextTypes.DEFAULT_TYPE):
+    try:
+        timings = await asyncio.to_thread(run_maintenance)
+        print("Обслуживание базы: " + ", ".join(f"{k}={v:.0f}" for k, v in timings.items()))
+    except Exception as e:
+        print(f"Ошибка обслуживания базы: {e}")
+
+async def backup_job(context: ContextTypes.DEFAULT_TYPE):
+    try:
+        path, size, seconds = await asyncio.to_thread(backup_database)
+        print(f"Бэкап {path}: {size / 1024:.0f} КБ за {seconds:.2f} с")
+    except Exception as e:
+        print(f"Ошибка бэкапа: {e}")
+
+def schedule_maintenance(application: Application):
+    if application.job_queue is None:
+        return
+    application.job_queue.run_repeating(maintenance_job, interval=MAINTENANCE_INTERVAL, first=60,
+                                        name="db_maintenance")
+    if BACKUP_INTERVAL > 0:
+        application.job_queue.run_repeating(backup_job, interval=BACKUP_INTERVAL, first=BACKUP_INTERVAL,
+                                            name="db_backup")
+
+async def cmd_start(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Команда /start - показывает главное меню"""
+    try:
+        chat_id = update.effective_chat.id
+        user_is_admin = await is_admin(update, context)
+        current_tournament = get_current_tournament(chat_id)
+        
+        text = "⚽ Добро пожаловать в Tournament Manager!\n\n"
+        if current_tournament:
+            text += f"🏆 Текущий турнир: {current_tournament['name']}\n\n"
+        text += "Управляйте турниром с помощью кнопок ниже:"
+        
+        await send_new_menu(update, context, text)
+        
+    except Exception as e:
+        print(f"Ошибка в cmd_start: {e}")
+        try:
+            await update.message.reply_text("❌ Произошла ошибка. Попробуйте еще раз.")
+        except Exception:
+            pass
+
+async def cmd_menu(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Команда /menu - показывает главное меню"""
+    try:
+        chat_id = update.effective_chat.id
+        user_is_admin = await is_admin(update, context)
+        current_tournament = get_current_tournament(chat_id)
+        
+        text = "⚽ Меню управления турниром:"
+        if current_tournament:
+            text += f"\n🏆 Текущий турнир: {current_tournament['name']}"
+        
+        await send_new_menu(update, context, text)
+        
+    except Exception as e:
+        print(f"Ошибка в cmd_menu: {e}")
+        try:
+            await update.message.reply_text("❌ Произошла ошибка. Попробуйте еще раз.")
+        except Exception:
+            pass
+
+async def cmd_new_tournament(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Команда для создания нового турнира"""
+    try:
+        if not await is_admin(update, context):
+            return await update.message.reply_text("❌ Только админы.")
+        
+        args = " ".join(context.args)
+        parts = [p.strip() for p in args.split("|")]
+        if not parts or not parts[0]:
+            return await update.message.reply_text("Формат: /newtournament Название | [кругов] | [приз]")
+        
+        name = parts[0]
+        rounds = int(parts[1]) if len(parts) > 1 and parts[1].isdigit() else 2
+        prize = parts[2] if len(parts) > 2 else "приз"
+        tid = add_tournament(update.effective_chat.id, name, prize, rounds)
+        
+        await send_new_menu(
+            update, context,
+            f"✅ Турнир '{_html_escape(name)}' создан и выбран как текущий.\n"
+            f"Кругов: {rounds}\nПриз: {_html_escape(prize)}",
+            parse_mode=ParseMode.HTML
+        )
+        
+    except Exception as e:
+        print(f"Ошибка в cmd_new_tournament: {e}")
+        await update.message.reply_text("❌ Ошибка создания турнира.")
+
+async def button_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Обработчик нажатий кнопок"""
+    try:
+        query = update.callback_query
+        if not query:
+            return
+            
+        await query.answer()
+        
+        data = query.data
         chat_id = update.effective_chat.id
         user_is_admin = await is_admin(update, context)
         current_tournament = get_current_tournament(chat_id)
         
-        text = "⚽ Добро пожаловать в Tournament Manager!\n\n"
-        if current_tournament:
-            text += f"🏆 Текущий турнир: {current_tournament['name']}\n\n"
-        text += "Управляйте турниром с помощью кнопок ниже:"
+        print(f"Button pressed: {data}")  # Для отладки
+
+        # Поиск клуба текстом живет, пока пользователь в меню выбора клуба; уход в другое
+        # меню его закрывает, иначе каждое сообщение в чате уходило бы в поиск
+        if context.user_data.get('stage') == 'club_search' and not (
+                data == "select_country" or data.startswith(("country_", "assign_club_", "select_player_"))):
+            context.user_data['stage'] = None
+        
+        if data == "main_menu":
+            text = "⚽ Меню управления турниром:"
+            if current_tournament:
+                text += f"\n🏆 Текущий турнир: {current_tournament['name']}"
+            await send_new_menu(update, context, text)
+        
+        elif data == "select_tournament":
+            tournaments = get_chat_tournaments(chat_id)
+            current_id = current_tournament['id'] if current_tournament else None
+            
+            await send_new_menu(
+                update, context,
+                "🏆 Выберите турнир:\n\n🟢 - текущий турнир\n⚪ - другие турниры",
+                reply_markup=get_tournaments_keyboard(tournaments, current_id)
+            )
+        
+        elif data.startswith("choose_tournament_"):
+            tournament_id = int(data[18:])
+            set_current_tournament(chat_id, tournament_id)
+            
+            # Получаем информацию о выбранном турнире
+            tournament = get_tournament(tournament_id)
+            
+            if tournament:
+                await send_new_menu(
+                    update, context,
+                    f"✅ Выбран турнир: {tournament['name']}\n\n⚽ Меню управления турниром:"
+                )
+            else:
+                await send_new_menu(update, context, "❌ Ошибка выбора турнира")
+        
+        elif data == "new_tournament":
+            if not user_is_admin:
+                await send_new_menu(update, context, "❌ Только администраторы группы могут создавать турниры.")
+                return
+            await query.edit_message_text("Введите название турнира:")
+            context.user_data['stage'] = 'tournament_name'
+        
+        elif data == "add_players_list":
+            if not current_tournament:
+                await send_new_menu(update, context, "❌ Нет выбранного турнира. Выберите турнир.")
+                return
+            await query.edit_message_text("Введите имена игроков через запятую:\nПример: Амир, Диас, Влад")
+            context.user_data['stage'] = 'add_players_list'
+        
+        elif data == "add_player":
+            if not current_tournament:
+                await send_new_menu(update, context, "❌ Нет выбранного турнира. Выберите турнир.")
+                return
+            await query.edit_message_text("Введите имя игрока:")
+            context.user_data['stage'] = 'add_player_name'
+        
+        elif data == "assign_clubs_menu":
+            if not current_tournament:
+                await send_new_menu(update, context, "❌ Нет выбранного турнира.")
+                return
+            
+            players_without_clubs = get_players_without_clubs(current_tournament['id'])
+            if not players_without_clubs:
+                await send_new_menu(update, context, "✅ Всем игрокам уже назначены клубы!")
+                return
+            
+            await send_new_menu(
+                update, context,
+                f"⚽ Назначение клубов игрокам\n\n"
+                f"👥 Игроков без клубов: {len(players_without_clubs)}\n\n"
+                "Выберите игрока:",
+                reply_markup=get_players_keyboard(current_tournament['id'])
+            )
+        
+        elif data.startswith("select_player_"):
+            player_id = int(data[14:])
+            player = get_player_by_id(player_id)
+            if not player:
+                await send_new_menu(update, context, "❌ Игрок не найден.")
+                return
+            
+            if not current_tournament:
+                await send_new_menu(update, context, "❌ Нет выбранного турнира.")
+                return
+            start_flow(chat_id, update.effective_user.id, ClubFlow(current_tournament['id'], player_id))
+            context.user_data['stage'] = 'club_search'
+            
+            await send_new_menu(
+                update, context,
+                f"👤 Выбран игрок: {player['name']}\n\n"
+                "🌍 Выберите страну для назначения клуба\n"
+                "🔎 или напишите часть названия (например: барса, mönch, psg):",
+                reply_markup=get_countries_keyboard()
+            )
+        
+        elif data == "select_country":
+            # Возвращаемся к выбору стран для текущего игрока
+            flow = get_flow(chat_id, update.effective_user.id, ClubFlow)
+            player = get_player_by_id(flow.player_id) if flow else None
+            player_name = player['name'] if player else 'игрок'
+            await send_new_menu(
+                update, context,
+                f"👤 Выбран игрок: {player_name}\n\n"
+                "🌍 Выберите страну для назначения клуба:",
+                reply_markup=get_countries_keyboard()
+            )
+        
+        elif data.startswith("country_"):
+            country = data[8:]  
+            flow = get_flow(chat_id, update.effective_user.id, ClubFlow)
+            player = get_player_by_id(flow.player_id) if flow else None
+            player_name = player['name'] if player else 'игрок'
+            if flow:
+                flow.country = country
+            
+            await send_new_menu(
+                update, context,
+                f"👤 Игрок: {player_name}\n"
+                f"🌍 Страна: {get_country_flag(country)} {country}\n\n"
+                f"⚽ Выберите клуб:",
+                reply_markup=get_clubs_keyboard(country, player_name)
+            )
+        
+        elif data.startswith("assign_club_"):
+            parts = data[12:].split("_", 1)  
+            country = parts[0]
+            club = parts[1]
+            
+            flow = get_flow(chat_id, update.effective_user.id, ClubFlow)
+            player = get_player_by_id(flow.player_id) if flow else None
+            
+            if not player:
+                await send_new_menu(update, context, "❌ Ошибка: игрок не выбран.")
+                return
+            
+            if not current_tournament or current_tournament['id'] != flow.tournament_id:
+                await send_new_menu(update, context, "❌ Нет выбранного турнира.")
+                return
+            
+            # Назначаем клуб выбранному игроку
+            player_name = player['name']
+            assign_club(current_tournament['id'], player_name, club)
+            
+            # Диалог закончен
+            end_flow(chat_id, update.effective_user.id)
+            if context.user_data.get('stage') == 'club_search':
+                context.user_data['stage'] = None
+            
+            # Проверяем, остались ли игроки без клубов
+            remaining_players = get_players_without_clubs(current_tournament['id'])
+            if remaining_players:
+                await send_new_menu(
+                    update, context,
+                    f"✅ {player_name} назначен клуб {get_country_flag(country)} {club}!\n\n"
+                    f"👥 Игроков без клубов осталось: {len(remaining_players)}\n\n"
+                    "Выберите следующего игрока:",
+                    reply_markup=get_players_keyboard(current_tournament['id'])
+                )
+            else:
+                await send_new_menu(
+                    update, context,
+                    f"✅ {player_name} назначен клуб {get_country_flag(country)} {club}!\n\n"
+                    "🎉 Всем игрокам назначены клубы! Можете генерировать расписание."
+                )
+        
+        elif data in ("assign_random", "assign_random_handicap"):
+            if not current_tournament:
+                await send_new_menu(update, context, "❌ Нет выбранного турнира.")
+                return
+            mode = "handicap" if data == "assign_random_handicap" else "balanced"
+            assigned, notes = assign_random_clubs(current_tournament['id'], mode)
+            lines = [f"{DRAW_MODES[mode]}: клубы разыграны!", ""]
+            lines += [f"👤 {name} — {club} (ур. {club_tier(club)})" for name, club in sorted(assigned.items())]
+            if notes:
+                lines += ["", "ℹ️ " + "; ".join(notes)]
+            await send_new_menu(update, context, "\n".join(lines))
+        
+        elif data == "generate_schedule":
+            if not user_is_admin:
+                await send_new_menu(update, context, "❌ Только администраторы могут генерировать расписание.")
+                return
+                
+            if not current_tournament:
+                await send_new_menu(update, context, "❌ Нет выбранного турнира.")
+                return
+            
+            # Проверяем есть ли уже матчи
+            existing_matches = get_schedule(current_tournament['id'])
+            if existing_matches:
+                await send_new_menu(
+                    update, context,
+                    "⚠️ В турнире уже есть матчи!\n\n"
+                    "🚨 Генерация нового расписания удалит все текущие результаты!\n\n"
+                    "Вы уверены?",
+                    reply_markup=InlineKeyboardMarkup([
+                        [InlineKeyboardButton("✅ Да, сгенерировать", callback_data="confirm_generate_schedule")],
+                        [InlineKeyboardButton("❌ Отмена", callback_data="main_menu")]
+                    ])
+                )
+            else:
+                generate_schedule(current_tournament['id'], current_tournament['rounds'])
+                schedule_live_table_update(context.application, current_tournament['id'])
+                await send_new_menu(update, context, "📅 Расписание сгенерировано!")
+        
+        elif data == "confirm_generate_schedule":
+            if not user_is_admin:
+                await send_new_menu(update, context, "❌ Только администраторы могут генерировать расписание.")
+                return
+                
+            if not current_tournament:
+                await send_new_menu(update, context, "❌ Нет выбранного турнира.")
+                return
+                
+            generate_schedule(current_tournament['id'], current_tournament['rounds'])
+            schedule_live_table_update(context.application, current_tournament['id'])
+            await send_new_menu(update, context, "📅 Расписание сгенерировано! Все предыдущие результаты удалены.")
+        
+        elif data == "show_schedule":
+            if not current_tournament:
+                await send_new_menu(update, context, "❌ Нет выбранного турнира.")
+                return
+                
+            text = format_schedule(current_tournament['id'])
+            if not text:
+                await send_new_menu(update, context, "📋 Нет матчей. Сгенерируйте расписание.")
+                return
+
+            await send_new_menu(update, context, text)
+        
+        elif data == "show_table":
+            if not current_tournament:
+                await send_new_menu(update, context, "❌ Нет выбранного турнира.")
+                return
+                
+            msg = format_standings(current_tournament)
+            await send_new_menu(
+                update, context,
+                f"📊 ТУРНИРНАЯ ТАБЛИЦА:\n\n{msg}",
+                parse_mode=ParseMode.HTML
+            )
+        
+        elif data == "tournament_format":
+            if not current_tournament:
+                await send_new_menu(update, context, "❌ Нет выбранного турнира.")
+                return
+
+            await send_new_menu(
+                update, context,
+                "🏟 Выберите формат турнира:\n\n"
+                "🔄 Круговой - каждый с каждым (кругов: как при создании)\n"
+                "🥊 Олимпийка - проигравший выбывает\n"
+                "⚔️ Double elimination - выбывание после двух поражений\n"
+                f"🏟 Группы по {current_tournament['group_size']}, "
+                f"в плей-офф выходят {current_tournament['group_advance']} (изменить: /groups 4 2)\n"
+                "♟ Швейцарка - пары с равными очками, новый тур после завершения предыдущего "
+                "(число туров: /swiss N)\n\n"
+                "После смены формата сгенерируйте расписание заново.",
+                reply_markup=get_formats_keyboard(current_tournament['format'] or "league")
+            )
+
+        elif data.startswith("set_format_"):
+            if not user_is_admin:
+                await send_new_menu(update, context, "❌ Только администраторы могут менять формат.")
+                return
+
+            if not current_tournament:
+                await send_new_menu(update, context, "❌ Нет выбранного турнира.")
+                return
+
+            fmt = data[11:]
+            if fmt not in TOURNAMENT_FORMATS:
+                await send_new_menu(update, context, "❌ Неизвестный формат.")
+                return
+
+            set_tournament_format(current_tournament['id'], fmt)
+            await send_new_menu(
+                update, context,
+                f"✅ Формат: {TOURNAMENT_FORMATS[fmt]}\n\nТеперь сгенерируйте расписание."
+            )
+
+        elif data == "toggle_live_table":
+            if not user_is_admin:
+                await send_new_menu(update, context, "❌ Только администраторы могут закреплять таблицу.")
+                return
+
+            if not current_tournament:
+                await send_new_menu(update, context, "❌ Нет выбранного турнира.")
+                return
+
+            if get_live_table(current_tournament['id']):
+                await disable_live_table(context.application, current_tournament['id'])
+                await send_new_menu(update, context, "📌 Живая таблица отключена. Таблица снова будет приходить после каждого результата.")
+            else:
+                await enable_live_table(context.application, chat_id, current_tournament)
+                await send_new_menu(update, context, "📌 Живая таблица закреплена и будет обновляться на месте.")
+        
+        elif data == "new_season":
+            if not user_is_admin:
+                await send_new_menu(update, context, "❌ Только администраторы могут создавать турниры.")
+                return
+
+            if not current_tournament:
+                await send_new_menu(update, context, "❌ Нет выбранного турнира.")
+                return
+
+            await send_new_menu(
+                update, context,
+                f"🔁 Новый сезон «{next_season_name(current_tournament['name'])}» "
+                f"с составом и настройками «{current_tournament['name']}».\n\n"
+                "Расписание сгенерируется сразу. Как быть с клубами?",
+                reply_markup=get_season_keyboard()
+            )
+
+        elif data.startswith("new_season_"):
+            if not user_is_admin:
+                await send_new_menu(update, context, "❌ Только администраторы могут создавать турниры.")
+                return
+
+            if not current_tournament:
+                await send_new_menu(update, context, "❌ Нет выбранного турнира.")
+                return
+
+            mode = data[11:]
+            if mode not in SEASON_CLUB_MODES:
+                await send_new_menu(update, context, "❌ Неизвестный вариант.")
+                return
+
+            name = next_season_name(current_tournament['name'])
+            tid = clone_tournament(current_tournament['id'], chat_id, name, mode)
+            await send_new_menu(
+                update, context,
+                f"✅ Создан турнир «{name}»: игроков {len(get_players(tid))}, "
+                f"матчей {len(get_schedule(tid))}.\nОн выбран текущим."
+            )
+
+        elif data == "record_result":
+            if not current_tournament:
+                await send_new_menu(update, context, "❌ Нет выбранного турнира.")
+                return
+            
+            await send_new_menu(
+                update, context,
+                "⚽ Выберите матч для записи результата:\n\n⚽ - не сыгран, ✅ - завершен",
+                reply_markup=get_matches_keyboard(current_tournament['id'], unplayed_only=True)
+            )
+        
+        elif data == "edit_result":
+            if not current_tournament:
+                await send_new_menu(update, context, "❌ Нет выбранного турнира.")
+                return
+            
+            await send_new_menu(
+                update, context,
+                "✏️ Выберите матч для изменения результата:\n\n✅ - завершенные матчи",
+                reply_markup=get_matches_keyboard(current_tournament['id'], unplayed_only=False, for_edit=True)
+            )
+        
+        elif data.startswith("select_match_"):
+            match_id = int(data[13:])
+            if not current_tournament:
+                await send_new_menu(update, context, "❌ Нет выбранного турнира.")
+                return
+
+            match = get_match_by_id(current_tournament['id'], match_id)
+            if not match:
+                await send_new_menu(update, context, "❌ Матч не найден.")
+                return
+
+            if match['played']:
+                await send_new_menu(
+                    update, context,
+                    f"❌ Результат этого матча уже записан: {match['home']} {match['home_goals']}:{match['away_goals']} {match['away']}"
+                )
+                return
+
+            start_flow(chat_id, update.effective_user.id, ScoreFlow(current_tournament['id'], match_id))
+
+            no = match_no(match)
+            await send_new_menu(
+                update, context,
+                f"⚽ Матч #{no}: {match['home']} vs {match['away']}\n\n"
+                f"Сколько голов забил {match['home']}?",
+                reply_markup=get_score_keyboard(match_id, match['home'])
+            )
+        
+        elif data.startswith("score_"):
+            parts = data[6:].split("_", 3)
+            if len(parts) < 3:
+                await send_new_menu(update, context, "❌ Ошибка формата данных.")
+                return
+                
+            match_id = int(parts[0])
+            player_name = parts[1]
+            goals = int(parts[2])
+
+            flow = get_flow(chat_id, update.effective_user.id, ScoreFlow)
+            if not flow or flow.edit or flow.match_id != match_id:
+                await send_new_menu(update, context, "❌ Ошибка: матч не выбран.")
+                return
+
+            if not current_tournament or current_tournament['id'] != flow.tournament_id:
+                await send_new_menu(update, context, "❌ Нет выбранного турнира.")
+                return
+
+            match = get_match_by_id(current_tournament['id'], match_id)
+            if not match:
+                end_flow(chat_id, update.effective_user.id)
+                await send_new_menu(update, context, "❌ Матч не найден.")
+                return
+
+            flow.set_goals(match, player_name, goals)
+            no = match_no(match)
+
+            if not flow.complete():
+                # Первый игрок - показываем форму для второго
+                other_player = match['away'] if player_name == match['home'] else match['home']
+                await send_new_menu(
+                    update, context,
+                    f"⚽ Матч #{no}: {match['home']} vs {match['away']}\n"
+                    f"✅ {player_name}: {goals} голов\n\n"
+                    f"Сколько голов забил {other_player}?",
+                    reply_markup=get_score_keyboard(match_id, other_player)
+                )
+            else:
+                # Второй игрок - записываем результат и показываем итог
+                home_goals, away_goals = flow.home_goals, flow.away_goals
+
+                # Записываем результат
+                try:
+                    notes = record_result(current_tournament['id'], match_id, home_goals, away_goals, update.effective_user.id)
+                except ResultError as e:
+                    flow.reset()
+                    await send_new_menu(update, context, f"❌ {e}")
+                    return
+                end_flow(chat_id, update.effective_user.id)
+                notes_text = "".join(f"\n{_html_escape(n)}" for n in notes)
+
+                if schedule_live_table_update(context.application, current_tournament['id']):
+                    await send_new_menu(
+                        update, context,
+                        f"✅ Матч #{no}: {_html_escape(match['home'])} {home_goals}:{away_goals} "
+                        f"{_html_escape(match['away'])} — таблица обновится в закрепе{notes_text}",
+                        parse_mode=ParseMode.HTML
+                    )
+                    return
+
+                match_comment = get_funny_match_comment(home_goals, away_goals)
+                ordered = get_standings(current_tournament['id'])
+                prize = get_current_tournament_prize(current_tournament['id'])
+                msg = format_standings(current_tournament)
+
+                home = _html_escape(match['home'])
+                away = _html_escape(match['away'])
+                comment = _html_escape(match_comment)
+
+                result_text = (
+                    f"✅ Результат записан!\n"
+                    f"⚽ Матч #{no}: {home} {home_goals}:{away_goals} {away}{notes_text}\n\n"
+                    f"{comment}\n\n"
+                    f"{msg}"
+                )
+
+                await send_new_menu(update, context, result_text, parse_mode=ParseMode.HTML)
+
+                fun = get_funny_message(ordered, prize)
+                if fun:
+                    await context.bot.send_message(chat_id=chat_id, text=fun)
+        
+        elif data == "finish_tournament":
+            if not user_is_admin:
+                await send_new_menu(update, context, "❌ Только администраторы могут завершить турнир.")
+                return
+                
+            if not current_tournament:
+                await send_new_menu(update, context, "❌ Нет выбранного турнира.")
+                return
+            
+            ordered = get_standings(current_tournament['id'])
+            if not ordered or all(player[1]['P'] == 0 for player in ordered):
+                await send_new_menu(update, context, "❌ Нельзя завершить турнир без сыгранных матчей!")
+                return
+            
+            await send_new_menu(
+                update, context,
+                "🏁 Вы уверены, что хотите завершить турнир?\n\n"
+                "⚠️ После завершения турнир нельзя будет изменить!",
+                reply_markup=InlineKeyboardMarkup([
+                    [InlineKeyboardButton("✅ Завершить турнир", callback_data="confirm_finish_tournament")],
+                    [InlineKeyboardButton("❌ Отмена", callback_data="main_menu")]
+                ])
+            )
         
-        await send_new_menu(update, context, text)
+        elif data == "confirm_finish_tournament":
+            if not user_is_admin:
+                await send_new_menu(update, context, "❌ Только администраторы могут завершить турнир.")
+                return
+                
+            if not current_tournament:
+                await send_new_menu(update, context, "❌ Нет выбранного турнира.")
+                return
+            
+            # Получаем финальные результаты
+            ordered = get_standings(current_tournament['id'])
+            prize = get_current_tournament_prize(current_tournament['id'])
+            msg = format_standings(current_tournament)
+            
+            winner = get_knockout_champion(current_tournament['id']) or (ordered[0][0] if ordered else "Неизвестно")
+            
+            # Убираем текущий турнир
+            clear_current_tournament(chat_id)
+            
+            await send_new_menu(
+                update, context,
+                f"🏁 ТУРНИР ЗАВЕРШЕН! 🏁\n\n"
+                f"🏆 Турнир: {current_tournament['name']}\n"
+                f"👑 ПОБЕДИТЕЛЬ: {winner}\n"
+                f"🎁 Приз: {prize}\n\n"
+                f"📊 ФИНАЛЬНАЯ ТАБЛИЦА:\n\n{msg}\n\n"
+                f"🎉 Поздравляем победителя!",
+                parse_mode=ParseMode.HTML
+            )
+            
+            # Отправляем отдельное сообщение с поздравлением
+            await context.bot.send_message(
+                chat_id=chat_id, 
+                text=f"🎊 {winner} забирает {prize}! Поздравляем! 🎊"
+            )
+        
+        elif data.startswith("edit_match_"):
+            match_id = int(data[11:])
+            if not current_tournament:
+                await send_new_menu(update, context, "❌ Нет выбранного турнира.")
+                return
+
+            match = get_match_by_id(current_tournament['id'], match_id)
+            if not match:
+                await send_new_menu(update, context, "❌ Матч не найден.")
+                return
+
+            start_flow(chat_id, update.effective_user.id, ScoreFlow(current_tournament['id'], match_id, edit=True))
+
+            no = match_no(match)
+            await send_new_menu(
+                update, context,
+                f"✏️ Редактирование матча #{no}: {match['home']} vs {match['away']}\n"
+                f"Текущий счет: {match['home_goals']}:{match['away_goals']}\n\n"
+                f"Новое количество голов для {match['home']}?",
+                reply_markup=get_score_keyboard(match_id, match['home'], is_edit=True)
+            )
+        
+        elif data.startswith("edit_score_"):
+            parts = data[11:].split("_", 3)
+            if len(parts) < 3:
+                await send_new_menu(update, context, "❌ Ошибка формата данных.")
+                return
+                
+            match_id = int(parts[0])
+            player_name = parts[1]
+            goals = int(parts[2])
+
+            flow = get_flow(chat_id, update.effective_user.id, ScoreFlow)
+            if not flow or not flow.edit or flow.match_id != match_id:
+                await send_new_menu(update, context, "❌ Ошибка: матч не выбран.")
+                return
+
+            if not current_tournament or current_tournament['id'] != flow.tournament_id:
+                await send_new_menu(update, context, "❌ Нет выбранного турнира.")
+                return
+
+            match = get_match_by_id(current_tournament['id'], match_id)
+            if not match:
+                end_flow(chat_id, update.effective_user.id)
+                await send_new_menu(update, context, "❌ Матч не найден.")
+                return
+
+            flow.set_goals(match, player_name, goals)
+            no = match_no(match)
+
+            if not flow.complete():
+                # Первый игрок - показываем форму для второго
+                other_player = match['away'] if player_name == match['home'] else match['home']
+                await send_new_menu(
+                    update, context,
+                    f"✏️ Редактирование матча #{no}: {match['home']} vs {match['away']}\n"
+                    f"✅ {player_name}: {goals} голов\n\n"
+                    f"Новое количество голов для {other_player}?",
+                    reply_markup=get_score_keyboard(match_id, other_player, is_edit=True)
+                )
+            else:
+                # Второй игрок - записываем результат и показываем итог
+                home_goals, away_goals = flow.home_goals, flow.away_goals
+
+                # Записываем новый результат
+                try:
+                    notes = record_result(current_tournament['id'], match_id, home_goals, away_goals, update.effective_user.id)
+                except ResultError as e:
+                    flow.reset()
+                    await send_new_menu(update, context, f"❌ {e}")
+                    return
+                end_flow(chat_id, update.effective_user.id)
+                notes_text = "".join(f"\n{_html_escape(n)}" for n in notes)
+
+                if schedule_live_table_update(context.application, current_tournament['id']):
+                    await send_new_menu(
+                        update, context,
+                        f"✅ Матч #{no} изменен: {match['home_goals']}:{match['away_goals']} → "
+                        f"{home_goals}:{away_goals} — таблица обновится в закрепе{notes_text}",
+                        parse_mode=ParseMode.HTML
+                    )
+                    return
+
+                match_comment = get_funny_match_comment(home_goals, away_goals)
+                ordered = get_standings(current_tournament['id'])
+                prize = get_current_tournament_prize(current_tournament['id'])
+                msg = format_standings(current_tournament)
+
+                home = _html_escape(match['home'])
+                away = _html_escape(match['away'])
+                comment = _html_escape(match_comment)
+                old_score = f"{match['home_goals']}:{match['away_goals']}"
+
+                result_text = (
+                    f"✅ Результат изменен!\n"
+                    f"⚽ Матч #{no}: {home} {home_goals}:{away_goals} {away}\n"
+                    f"📝 Было: {old_score} → Стало: {home_goals}:{away_goals}{notes_text}\n\n"
+                    f"{comment}\n\n"
+                    f"{msg}"
+                )
+
+                await send_new_menu(update, context, result_text, parse_mode=ParseMode.HTML)
+
+                fun = get_funny_message(ordered, prize)
+                if fun:
+                    await context.bot.send_message(chat_id=chat_id, text=fun)
         
+        else:
+            await send_new_menu(update, context, f"❌ Неизвестная команда: {data}")
+        
+    except Exception as e:
+        print(f"Ошибка в button_handler: {e}")
+        try:
+            await query.message.reply_text("❌ Произошла ошибка. Попробуйте /start")
+        except Exception:
+            pass
+
+# Обработчик текстовых сообщений
+async def handle_text(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Обработчик текстовых сообщений"""
+    try:
+        if 'stage' not in context.user_data or not context.user_data['stage']:
+            return
+
+        stage = context.user_data['stage']
+        text = update.message.text.strip()
+        chat_id = update.effective_chat.id
+        user_is_admin = await is_admin(update, context)
+
+        print(f"Text handler stage: {stage}, text: {text}")  # Для отладки
+
+        if stage == 'club_search':
+            flow = get_flow(chat_id, update.effective_user.id, ClubFlow)
+            if not flow:
+                context.user_data['stage'] = None
+                return
+            found = search_clubs(text)
+            if not found:
+                await update.message.reply_text("🔎 Ничего не нашлось. Попробуйте иначе или выберите страну.",
+                                                reply_markup=get_countries_keyboard())
+                return
+            player = get_player_by_id(flow.player_id)
+            await update.message.reply_text(f"🔎 Клуб для {player['name'] if player else 'игрока'}:",
+                                            reply_markup=get_club_search_keyboard(found))
+
+        elif stage == 'tournament_name':
+            if not user_is_admin:
+                context.user_data['stage'] = None
+                await send_new_menu(update, context, "❌ Только администраторы группы могут создавать турниры.")
+                return
+
+            context.user_data['new_tournament'] = {'name': text}
+            context.user_data['stage'] = 'tournament_rounds'
+            await update.message.reply_text("Сколько кругов? Введите число (по умолчанию 2).")
+
+        elif stage == 'tournament_rounds':
+            if text and not text.isdigit():
+                await update.message.reply_text("Пожалуйста, введите число кругов (например, 2).")
+                return
+
+            rounds = int(text) if text.isdigit() else 2
+            context.user_data['new_tournament']['rounds'] = rounds
+            context.user_data['stage'] = 'tournament_prize'
+            await update.message.reply_text("Какой приз? (можно текстом)")
+
+        elif stage == 'tournament_prize':
+            prize = text if text else "приз"
+            nt = context.user_data.get('new_tournament', {})
+            name = nt.get('name', 'Турнир')
+            rounds = nt.get('rounds', 2)
+
+            try:
+                add_tournament(chat_id, name, prize, rounds)
+            except Exception as e:
+                print(f"Ошибка создания турнира: {e}")
+                context.user_data['stage'] = None
+                await update.message.reply_text(f"❌ Не удалось создать турнир: {e}")
+                return
+
+            context.user_data['stage'] = None
+            context.user_data.pop('new_tournament', None)
+            await send_new_menu(
+                update, context,
+                f"✅ Турнир '{_html_escape(name)}' создан и выбран!\n"
+                f"🏆 Приз: {_html_escape(prize)}\n"
+                f"🔄 Кругов: {rounds}\n\n"
+                "Теперь добавляйте игроков и назначайте им клубы:",
+                parse_mode=ParseMode.HTML
+            )
+
+        elif stage == 'add_player_name':
+            current_tournament = get_current_tournament(chat_id)
+            if not current_tournament:
+                context.user_data['stage'] = None
+                await send_new_menu(update, context, "❌ Нет выбранного турнира.")
+                return
+
+            add_player(current_tournament['id'], text)
+            context.user_data['stage'] = None
+            await send_new_menu(update, context, f"✅ Игрок {text} добавлен в турнир!")
+
+        elif stage == 'add_players_list':
+            current_tournament = get_current_tournament(chat_id)
+            if not current_tournament:
+                context.user_data['stage'] = None
+                await send_new_menu(update, context, "❌ Нет выбранного турнира.")
+                return
+
+            player_names = [name.strip() for name in text.split(',') if name.strip()]
+            if not player_names:
+                await update.message.reply_text(
+                    "❌ Не найдено имен игроков. Попробуйте еще раз.\n"
+                    "Пример: Амир, Диас, Влад"
+                )
+                return
+
+            added_count = 0
+            for name in player_names:
+                if 0 < len(name) <= 50:
+                    add_player(current_tournament['id'], name)
+                    added_count += 1
+
+            context.user_data['stage'] = None
+            await send_new_menu(
+                update, context,
+                f"✅ Добавлено игроков: {added_count}\n"
+                f"👥 Список: {', '.join(player_names[:10])}{'...' if len(player_names) > 10 else ''}"
+            )
+
+        elif stage == 'bulk_results':
+            current_tournament = get_current_tournament(chat_id)
+            context.user_data['stage'] = None
+            if not current_tournament:
+                await send_new_menu(update, context, "❌ Нет выбранного турнира.")
+                return
+
+            await apply_bulk_results(update, context, current_tournament, update.message.text)
+
     except Exception as e:
-        print(f"Ошибка в cmd_start: {e}")
+        print(f"Ошибка в handle_text: {e}")
         try:
-            await update.message.reply_text("❌ Произошла ошибка. Попробуйте еще раз.")
+            await update.message.reply_text("❌ Произошла ошибка. Попробуйте /start")
         except Exception:
             pass
 
-async def cmd_menu(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    """Команда /menu - показывает главное меню"""
+# Команда для записи результата (остается текстовой для удобства)
+async def cmd_result(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Команда для записи результата матча"""
     try:
-        chat_id = update.effective_chat.id
-        user_is_admin = await is_admin(update, context)
-        current_tournament = get_current_tournament(chat_id)
+        current_tournament = get_current_tournament(update.effective_chat.id)
+        if not current_tournament:
+            await update.message.reply_text("❌ Нет выбранного турнира.")
+            return
+        if len(context.args) != 2:
+            await update.message.reply_text("📝 Формат: /result ID X-Y\nПример: /result 1 2-1")
+            return
         
-        text = "⚽ Меню управления турниром:"
-        if current_tournament:
-            text += f"\n🏆 Текущий турнир: {current_tournament['name']}"
+        match_id = int(context.args[0])
+        score = context.args[1].split("-")
+        if len(score) != 2:
+            await update.message.reply_text("❌ Неверный формат счёта. Используйте X-Y")
+            return
+        hg, ag = int(score[0]), int(score[1])
+        notes = record_result(current_tournament['id'], match_id, hg, ag, update.effective_user.id)
+        notes_text = "".join(f"\n{n}" for n in notes)
+
+        if schedule_live_table_update(context.application, current_tournament['id']):
+            await update.message.reply_text(f"✅ Результат {hg}:{ag} записан, таблица обновится в закрепе.{notes_text}")
+            return
         
-        await send_new_menu(update, context, text)
+        # Добавляем смешной комментарий
+        match_comment = get_funny_match_comment(hg, ag)
+        
+        ordered = get_standings(current_tournament['id'])
+        prize = get_current_tournament_prize(current_tournament['id'])
+        msg = format_standings(current_tournament)
+        fun = get_funny_message(ordered, prize)
         
+        await update.message.reply_text(
+            f"✅ Результат записан!{_html_escape(notes_text)}\n{match_comment}\n\n{msg}",
+            parse_mode=ParseMode.HTML
+        )
+        if fun:
+            await update.message.reply_text(fun)
+    except ResultError as e:
+        await update.message.reply_text(f"❌ {e}")
+    except ValueError:
+        await update.message.reply_text("❌ Неверный формат. Используйте: /result ID X-Y")
     except Exception as e:
-        print(f"Ошибка в cmd_menu: {e}")
+        print(f"Ошибка в cmd_result: {e}")
+        await update.message.reply_text("❌ Ошибка записи результата.")
+
+async def cmd_groups(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Команда /groups - размер групп и число выходящих в плей-офф"""
+    try:
+        if not await is_admin(update, context):
+            return await update.message.reply_text("❌ Только админы.")
+
+        current_tournament = get_current_tournament(update.effective_chat.id)
+        if not current_tournament:
+            await update.message.reply_text("❌ Нет выбранного турнира.")
+            return
+
+        if len(context.args) != 2:
+            await update.message.reply_text("📝 Формат: /groups РАЗМЕР ВЫХОДЯТ\nПример: /groups 4 2")
+            return
+
+        group_size, group_advance = int(context.args[0]), int(context.args[1])
+        if group_size < 2 or not 1 <= group_advance <= group_size:
+            await update.message.reply_text("❌ Группа - минимум 2 игрока, выходят от 1 до размера группы.")
+            return
+
+        set_group_settings(current_tournament['id'], group_size, group_advance)
+        await update.message.reply_text(
+            f"✅ Группы по {group_size}, в плей-офф выходят {group_advance}. "
+            "Сгенерируйте расписание, чтобы применить."
+        )
+    except ValueError:
+        await update.message.reply_text("❌ Неверный формат. Используйте: /groups 4 2")
+    except Exception as e:
+        print(f"Ошибка в cmd_groups: {e}")
+        await update.message.reply_text("❌ Ошибка настройки групп.")
+
+async def cmd_swiss(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Команда /swiss - число туров швейцарской системы"""
+    try:
+        if not await is_admin(update, context):
+            return await update.message.reply_text("❌ Только админы.")
+
+        current_tournament = get_current_tournament(update.effective_chat.id)
+        if not current_tournament:
+            await update.message.reply_text("❌ Нет выбранного турнира.")
+            return
+
+        if len(context.args) != 1:
+            await update.message.reply_text("📝 Формат: /swiss ТУРОВ\nПример: /swiss 7 (0 - по числу игроков)")
+            return
+
+        swiss_rounds = int(context.args[0])
+        if swiss_rounds < 0:
+            raise ValueError("negative rounds")
+        set_swiss_rounds(current_tournament['id'], swiss_rounds or None)
+        await update.message.reply_text(
+            f"✅ Туров в швейцарке: {swiss_rounds}" if swiss_rounds
+            else "✅ Число туров будет рассчитано по числу игроков (log₂ N)."
+        )
+    except ValueError:
+        await update.message.reply_text("❌ Неверный формат. Используйте: /swiss 7")
+    except Exception as e:
+        print(f"Ошибка в cmd_swiss: {e}")
+        await update.message.reply_text("❌ Ошибка настройки швейцарки.")
+
+async def cmd_tiebreaks(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Команда /tiebreaks - порядок правил при равенстве очков"""
+    try:
+        current_tournament = get_current_tournament(update.effective_chat.id)
+        if not current_tournament:
+            await update.message.reply_text("❌ Нет выбранного турнира.")
+            return
+
+        if not context.args:
+            current = parse_tiebreaks(current_tournament['tiebreaks'])
+            lines = ["⚖️ При равенстве очков сравниваются по порядку:"]
+            lines += [f"{i}. {TIEBREAK_RULES[r]}" for i, r in enumerate(current, start=1)]
+            lines.append(f"\nИзменить: /tiebreaks {DEFAULT_TIEBREAKS}")
+            lines.append("Правила: " + ", ".join(TIEBREAK_RULES))
+            await update.message.reply_text("\n".join(lines))
+            return
+
+        if not await is_admin(update, context):
+            return await update.message.reply_text("❌ Только админы.")
+
+        requested = [r.strip().lower() for r in " ".join(context.args).replace(" ", ",").split(",") if r.strip()]
+        unknown = [r for r in requested if r not in TIEBREAK_RULES]
+        if unknown or not requested:
+            await update.message.reply_text(
+                f"❌ Неизвестные правила: {', '.join(unknown) or '-'}\n"
+                f"Доступны: {', '.join(TIEBREAK_RULES)}"
+            )
+            return
+
+        set_tiebreaks(current_tournament['id'], requested)
+        await update.message.reply_text("✅ Тай-брейки: " + " → ".join(requested))
+    except Exception as e:
+        print(f"Ошибка в cmd_tiebreaks: {e}")
+        await update.message.reply_text("❌ Ошибка настройки тай-брейков.")
+
+async def cmd_fairplay(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Команда /fairplay - штрафные очки фейр-плей игроку"""
+    try:
+        if not await is_admin(update, context):
+            return await update.message.reply_text("❌ Только админы.")
+
+        current_tournament = get_current_tournament(update.effective_chat.id)
+        if not current_tournament:
+            await update.message.reply_text("❌ Нет выбранного турнира.")
+            return
+
+        if len(context.args) < 2:
+            await update.message.reply_text("📝 Формат: /fairplay Имя ОЧКИ\nПример: /fairplay Амир 3 (желтая - 1, красная - 3)")
+            return
+
+        points = int(context.args[-1])
+        name = " ".join(context.args[:-1])
+        if not add_fair_play_points(current_tournament['id'], name, points):
+            await update.message.reply_text(f"❌ Игрок {name} не найден.")
+            return
+        await update.message.reply_text(f"🟨 {name}: штрафных очков фейр-плей {points:+d}")
+    except ValueError:
+        await update.message.reply_text("❌ Неверный формат. Используйте: /fairplay Имя 3")
+    except Exception as e:
+        print(f"Ошибка в cmd_fairplay: {e}")
+        await update.message.reply_text("❌ Ошибка записи фейр-плей.")
+
+BULK_RESULTS_HELP = (
+    "📝 Пакетный ввод результатов — по одному матчу в строке:\n"
+    "ID X-Y — по ID матча (как в /result)\n"
+    "#N X:Y — по номеру матча из расписания\n\n"
+    "Пример:\n/results\n#1 2:1\n#2 0:0\n#5 3-2"
+)
+
+async def apply_bulk_results(update: Update, context: ContextTypes.DEFAULT_TYPE, tournament: sqlite3.Row, text: str):
+    """Проверяет и записывает пакет результатов, отвечает одним сообщением"""
+    rows, errors = parse_bulk_results(tournament['id'], text)
+    if errors:
+        shown = "\n".join(errors[:15])
+        more = f"\n…и ещё {len(errors) - 15}" if len(errors) > 15 else ""
+        await update.message.reply_text(f"❌ Ничего не записано, исправьте ошибки:\n{shown}{more}")
+        return
+    if not rows:
+        await update.message.reply_text(BULK_RESULTS_HELP)
+        return
+
+    try:
+        notes = record_results_bulk(tournament['id'], rows, update.effective_user.id)
+    except ResultError as e:
+        await update.message.reply_text(f"❌ Ничего не записано: {e}")
+        return
+    notes_text = "".join(f"\n{n}" for n in notes)
+
+    if schedule_live_table_update(context.application, tournament['id']):
+        await update.message.reply_text(f"✅ Записано результатов: {len(rows)}, таблица обновится в закрепе.{notes_text}")
+        return
+
+    ordered = get_standings(tournament['id'])
+    prize = get_current_tournament_prize(tournament['id'])
+    msg = format_standings(tournament)
+    fun = get_funny_message(ordered, prize)
+
+    lines = [f"✅ Записано результатов: {len(rows)}"]
+    for match, hg, ag in sorted(rows, key=lambda r: match_no(r[0])):
+        lines.append(f"#{match_no(match)}: {_html_escape(match['home'])} {hg}:{ag} {_html_escape(match['away'])}")
+    lines += [_html_escape(n) for n in notes]
+    text_out = "\n".join(lines) + f"\n\n{msg}"
+    if fun:
+        text_out += f"\n\n{_html_escape(fun)}"
+
+    await update.message.reply_text(text_out, parse_mode=ParseMode.HTML)
+
+async def cmd_results(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Команда /results - пакетный ввод результатов за тур"""
+    try:
+        current_tournament = get_current_tournament(update.effective_chat.id)
+        if not current_tournament:
+            await update.message.reply_text("❌ Нет выбранного турнира.")
+            return
+
+        # Тело команды - всё после /results, с сохранением переносов строк
+        body = update.message.text.split(maxsplit=1)
+        body = body[1] if len(body) > 1 else ""
+        if not body.strip():
+            context.user_data['stage'] = 'bulk_results'
+            await update.message.reply_text(BULK_RESULTS_HELP + "\n\nОтправьте строки следующим сообщением.")
+            return
+
+        await apply_bulk_results(update, context, current_tournament, body)
+    except Exception as e:
+        print(f"Ошибка в cmd_results: {e}")
+        await update.message.reply_text("❌ Ошибка записи результатов.")
+
+def format_event(event: sqlite3.Row) -> str:
+    title = EVENT_TITLES.get(event["kind"], event["kind"])
+    if event["match_number"] is None:
+        match = f"матч {event['match_id']}"
+    elif not event["away"]:
+        match = f"#{event['match_number']} {event['home']} — пропуск тура"
+    else:
+        match = f"#{event['match_number']} {event['home']} — {event['away']}"
+    score = f" {event['home_goals']}:{event['away_goals']}" if event["home_goals"] is not None else ""
+    undo = f" (откат события {event['undoes_seq']})" if event["undoes_seq"] else ""
+    return f"{event['seq']}. {title}: {match}{score}{undo}"
+
+async def cmd_undo(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Команда /undo - откат последнего результата"""
+    try:
+        if not await is_admin(update, context):
+            return await update.message.reply_text("❌ Только админы.")
+
+        current_tournament = get_current_tournament(update.effective_chat.id)
+        if not current_tournament:
+            await update.message.reply_text("❌ Нет выбранного турнира.")
+            return
+
         try:
-            await update.message.reply_text("❌ Произошла ошибка. Попробуйте еще раз.")
-        except Exception:
-            pass
+            event = undo_last_result(current_tournament['id'], update.effective_user.id)
+        except ResultError as e:
+            await update.message.reply_text(f"❌ {e}")
+            return
+        if not event:
+            await update.message.reply_text("ℹ️ Нечего отменять.")
+            return
+
+        if event["prev_home_goals"] is None:
+            text = f"↩️ Результат {event['home_goals']}:{event['away_goals']} отменен, матч снова не сыгран."
+        else:
+            text = f"↩️ Возвращен прежний счет {event['prev_home_goals']}:{event['prev_away_goals']}."
+        schedule_live_table_update(context.application, current_tournament['id'])
+        await update.message.reply_text(text)
+    except Exception as e:
+        print(f"Ошибка в cmd_undo: {e}")
+        await update.message.reply_text("❌ Ошибка отката результата.")
+
+async def cmd_history(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Команда /history - последние события журнала результатов"""
+    try:
+        current_tournament = get_current_tournament(update.effective_chat.id)
+        if not current_tournament:
+            await update.message.reply_text("❌ Нет выбранного турнира.")
+            return
+
+        events = get_event_log(current_tournament['id'])
+        if not events:
+            await update.message.reply_text("📜 Журнал пуст.")
+            return
+        lines = [format_event(e) for e in reversed(events)]
+        await update.message.reply_text("📜 Журнал результатов:\n" + "\n".join(lines) +
+                                        "\n\nТаблица на момент события: /tableat N")
+    except Exception as e:
+        print(f"Ошибка в cmd_history: {e}")
+        await update.message.reply_text("❌ Ошибка загрузки журнала.")
+
+async def cmd_table_at(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Команда /tableat N - таблица после события N журнала"""
+    try:
+        current_tournament = get_current_tournament(update.effective_chat.id)
+        if not current_tournament:
+            await update.message.reply_text("❌ Нет выбранного турнира.")
+            return
+
+        last = get_last_event_seq(current_tournament['id'])
+        if len(context.args) != 1:
+            await update.message.reply_text(f"📝 Формат: /tableat N (0…{last}, см. /history)")
+            return
+        seq = int(context.args[0])
+        if not 0 <= seq <= last:
+            await update.message.reply_text(f"❌ Событие должно быть от 0 до {last}.")
+            return
+
+        ordered = get_standings_as_of(current_tournament['id'], seq)
+        msg = format_table(current_tournament['id'], ordered)
+        await update.message.reply_text(f"🕰 Таблица после события {seq}:\n{msg}", parse_mode=ParseMode.HTML)
+    except ValueError:
+        await update.message.reply_text("❌ Неверный формат. Используйте: /tableat 12")
+    except Exception as e:
+        print(f"Ошибка в cmd_table_at: {e}")
+        await update.message.reply_text("❌ Ошибка построения таблицы.")
+
+H2H_SEPARATORS = re.compile(r"\s+(?:vs\.?|против|-|—)\s+|\s*[;,]\s*", re.IGNORECASE)
+
+def parse_h2h_args(chat_id: int, text: str) -> Optional[tuple]:
+    """Два имени: через vs/-/запятую или, если имена из одного слова, через пробел"""
+    parts = [p.strip() for p in H2H_SEPARATORS.split(text.strip(), maxsplit=1)]
+    if len(parts) == 2 and all(parts):
+        return parts[0], parts[1]
+    words = text.split()
+    # Без разделителя перебираем точки разреза и берем ту, где оба имени известны
+    for i in range(1, len(words)):
+        a, b = " ".join(words[:i]), " ".join(words[i:])
+        if resolve_player_names(chat_id, a) and resolve_player_names(chat_id, b):
+            return a, b
+    return None
+
+async def cmd_h2h(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Команда /h2h Имя1 Имя2 - личные встречи за все турниры чата"""
+    try:
+        chat_id = update.effective_chat.id
+        body = update.message.text.split(maxsplit=1)
+        pair = parse_h2h_args(chat_id, body[1]) if len(body) > 1 else None
+        if not pair:
+            await update.message.reply_text("📝 Формат: /h2h Амир Диас\nИмена из нескольких слов: /h2h Амир Б vs Диас")
+            return
+
+        a, b = pair
+        rows = get_h2h(chat_id, a, b)
+        if rows is None:
+            await update.message.reply_text("❌ Игрок не найден ни в одном турнире этого чата.")
+            return
+        if not rows:
+            await update.message.reply_text(f"🤝 {a} и {b} еще не встречались.")
+            return
+        await update.message.reply_text(format_h2h(a, b, rows), parse_mode=ParseMode.HTML)
+    except Exception as e:
+        print(f"Ошибка в cmd_h2h: {e}")
+        await update.message.reply_text("❌ Ошибка поиска личных встреч.")
+
+async def cmd_stats(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Команда /stats - статистика турнира, /stats clubs - клубы за все турниры"""
+    try:
+        if context.args and context.args[0].lower() in ("clubs", "клубы"):
+            await update.message.reply_text(format_club_stats(update.effective_chat.id), parse_mode=ParseMode.HTML)
+            return
+
+        current_tournament = get_current_tournament(update.effective_chat.id)
+        if not current_tournament:
+            await update.message.reply_text("❌ Нет выбранного турнира.")
+            return
+        await update.message.reply_text(format_tournament_stats(current_tournament), parse_mode=ParseMode.HTML)
+    except Exception as e:
+        print(f"Ошибка в cmd_stats: {e}")
+        await update.message.reply_text("❌ Ошибка расчета статистики.")
+
+async def cmd_export(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Команда /export [csv|json] - все турниры чата одним файлом"""
+    path = None
+    try:
+        fmt = (context.args[0].lower() if context.args else "csv").replace("jsonl", "json")
+        if fmt not in ("csv", "json"):
+            await update.message.reply_text("📝 Формат: /export csv или /export json")
+            return
+
+        chat_id = update.effective_chat.id
+        fd, path = tempfile.mkstemp(suffix=".export")
+        os.close(fd)
+        count = await asyncio.to_thread(write_chat_export, chat_id, fmt, path)
+        if not count:
+            await update.message.reply_text("❌ В этом чате еще нет турниров.")
+            return
+
+        filename = f"league_{chat_id}_{datetime.now():%Y%m%d}.{'csv' if fmt == 'csv' else 'jsonl'}"
+        with open(path, "rb") as f:
+            await update.message.reply_document(
+                document=f, filename=filename,
+                caption=f"📦 Экспорт: записей {count}. Загрузить обратно: /import",
+            )
+    except Exception as e:
+        print(f"Ошибка в cmd_export: {e}")
+        await update.message.reply_text("❌ Ошибка экспорта.")
+    finally:
+        if path and os.path.exists(path):
+            os.remove(path)
 
-async def cmd_new_tournament(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    """Команда для создания нового турнира"""
+IMPORT_HELP = (
+    "📥 Пришлите файл CSV или JSON lines в формате /export.\n"
+    "Турниры добавятся в этот чат как архивные; строки таблицы (standing) пересчитываются и не нужны."
+)
+
+async def cmd_import(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Команда /import - загрузка архивных турниров из файла"""
+    if not await is_admin(update, context):
+        return await update.message.reply_text("❌ Только админы.")
+    context.user_data['stage'] = 'import_file'
+    await update.message.reply_text(IMPORT_HELP)
+
+async def handle_document(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Файл импорта: после /import или с подписью /import"""
+    caption = (update.message.caption or "").strip()
+    if context.user_data.get('stage') != 'import_file' and not caption.startswith("/import"):
+        return
+    path = None
     try:
+        context.user_data['stage'] = None
         if not await is_admin(update, context):
             return await update.message.reply_text("❌ Только админы.")
-        
-        args = " ".join(context.args)
-        parts = [p.strip() for p in args.split("|")]
-        if not parts or not parts[0]:
-            return await update.message.reply_text("Формат: /newtournament Название | [кругов] | [приз]")
-        
-        name = parts[0]
-        rounds = int(parts[1]) if len(parts) > 1 and parts[1].isdigit() else 2
-        prize = parts[2] if len(parts) > 2 else "приз"
-        tid = add_tournament(update.effective_chat.id, name, prize, rounds)
-        
-        await send_new_menu(
-            update, context,
-            f"✅ Турнир '{_html_escape(name)}' создан и выбран как текущий.\n"
-            f"Кругов: {rounds}\nПриз: {_html_escape(prize)}",
-            parse_mode=ParseMode.HTML
+
+        document = update.message.document
+        if document.file_size and document.file_size > IMPORT_MAX_BYTES:
+            await update.message.reply_text(f"❌ Файл больше {IMPORT_MAX_BYTES // (1024 * 1024)} МБ.")
+            return
+
+        fd, path = tempfile.mkstemp(suffix=".import")
+        os.close(fd)
+        tg_file = await document.get_file()
+        await tg_file.download_to_drive(path)
+
+        tournaments, players, matches, errors = await asyncio.to_thread(
+            lambda: validate_import(iter_import_records(path)))
+        if errors:
+            await update.message.reply_text("❌ Ничего не импортировано, исправьте ошибки:\n" + "\n".join(errors))
+            return
+
+        ids = await asyncio.to_thread(import_tournaments, update.effective_chat.id, tournaments, players, matches)
+        await update.message.reply_text(
+            f"✅ Импортировано турниров: {len(ids)}, игроков: {len(players)}, матчей: {len(matches)}.\n"
+            "Выбрать турнир можно в меню."
         )
-        
+    except UnicodeDecodeError:
+        await update.message.reply_text("❌ Файл должен быть в UTF-8.")
     except Exception as e:
-        print(f"Ошибка в cmd_new_tournament: {e}")
-        await update.message.reply_text("❌ Ошибка создания турнира.")
+        print(f"Ошибка в handle_document: {e}")
+        await update.message.reply_text("❌ Ошибка импорта.")
+    finally:
+        if path and os.path.exists(path):
+            os.remove(path)
 
-async def button_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    """Обработчик нажатий кнопок"""
+DEADLINE_HELP = (
+    "📝 Формат: /deadline ТУР СРОК\n"
+    "Тур - игровой день: в нем каждый участник играет не больше одного матча\n"
+    "Срок: 25.10 21:00, 25.10 (до 23:59), +48h или +3d\n"
+    "Снять срок: /deadline ТУР off\n"
+    "Техническая ничья 0:0 после срока: /forfeit on|off"
+)
+
+async def cmd_deadline(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Команда /deadline - сроки туров и напоминания"""
     try:
-        query = update.callback_query
-        if not query:
+        current_tournament = get_current_tournament(update.effective_chat.id)
+        if not current_tournament:
+            await update.message.reply_text("❌ Нет выбранного турнира.")
             return
-            
-        await query.answer()
-        
-        data = query.data
-        chat_id = update.effective_chat.id
-        user_is_admin = await is_admin(update, context)
-        current_tournament = get_current_tournament(chat_id)
-        
-        print(f"Button pressed: {data}")  # Для отладки
-        
-        if data == "main_menu":
-            text = "⚽ Меню управления турниром:"
-            if current_tournament:
-                text += f"\n🏆 Текущий турнир: {current_tournament['name']}"
-            await send_new_menu(update, context, text)
-        
-        elif data == "select_tournament":
-            tournaments = get_chat_tournaments(chat_id)
-            current_id = current_tournament['id'] if current_tournament else None
-            
-            await send_new_menu(
-                update, context,
-                "🏆 Выберите турнир:\n\n🟢 - текущий турнир\n⚪ - другие турниры",
-                reply_markup=get_tournaments_keyboard(tournaments, current_id)
-            )
-        
-        elif data.startswith("choose_tournament_"):
-            tournament_id = int(data[18:])
-            set_current_tournament(chat_id, tournament_id)
-            
-            # Получаем информацию о выбранном турнире
-            conn = db()
-            c = conn.cursor()
-            c.execute("SELECT * FROM tournaments WHERE id=?", (tournament_id,))
-            tournament = c.fetchone()
-            conn.close()
-            
-            if tournament:
-                await send_new_menu(
-                    update, context,
-                    f"✅ Выбран турнир: {tournament['name']}\n\n⚽ Меню управления турниром:"
-                )
-            else:
-                await send_new_menu(update, context, "❌ Ошибка выбора турнира")
-        
-        elif data == "new_tournament":
-            if not user_is_admin:
-                await send_new_menu(update, context, "❌ Только администраторы группы могут создавать турниры.")
-                return
-            await query.edit_message_text("Введите название турнира:")
-            context.user_data['stage'] = 'tournament_name'
-        
-        elif data == "add_players_list":
-            if not current_tournament:
-                await send_new_menu(update, context, "❌ Нет выбранного турнира. Выберите турнир.")
-                return
-            await query.edit_message_text("Введите имена игроков через запятую:\nПример: Амир, Диас, Влад")
-            context.user_data['stage'] = 'add_players_list'
-        
-        elif data == "add_player":
-            if not current_tournament:
-                await send_new_menu(update, context, "❌ Нет выбранного турнира. Выберите турнир.")
-                return
-            await query.edit_message_text("Введите имя игрока:")
-            context.user_data['stage'] = 'add_player_name'
-        
-        elif data == "assign_clubs_menu":
-            if not current_tournament:
-                await send_new_menu(update, context, "❌ Нет выбранного турнира.")
-                return
-            
-            players_without_clubs = get_players_without_clubs(current_tournament['id'])
-            if not players_without_clubs:
-                await send_new_menu(update, context, "✅ Всем игрокам уже назначены клубы!")
-                return
-            
-            await send_new_menu(
-                update, context,
-                f"⚽ Назначение клубов игрокам\n\n"
-                f"👥 Игроков без клубов: {len(players_without_clubs)}\n\n"
-                "Выберите игрока:",
-                reply_markup=get_players_keyboard(current_tournament['id'])
-            )
-        
-        elif data.startswith("select_player_"):
-            player_id = int(data[14:])
-            player = get_player_by_id(player_id)
-            if not player:
-                await send_new_menu(update, context, "❌ Игрок не найден.")
-                return
-            
-            context.user_data['selected_player_id'] = player_id
-            context.user_data['selected_player_name'] = player['name']
-            
-            await send_new_menu(
-                update, context,
-                f"👤 Выбран игрок: {player['name']}\n\n"
-                "🌍 Выберите страну для назначения клуба:",
-                reply_markup=get_countries_keyboard()
-            )
-        
-        elif data == "select_country":
-            # Возвращаемся к выбору стран для текущего игрока
-            player_name = context.user_data.get('selected_player_name', 'игрок')
-            await send_new_menu(
-                update, context,
-                f"👤 Выбран игрок: {player_name}\n\n"
-                "🌍 Выберите страну для назначения клуба:",
-                reply_markup=get_countries_keyboard()
-            )
-        
-        elif data.startswith("country_"):
-            country = data[8:]  
-            player_name = context.user_data.get('selected_player_name', 'игрок')
-            context.user_data['selected_country'] = country
-            
-            await send_new_menu(
-                update, context,
-                f"👤 Игрок: {player_name}\n"
-                f"🌍 Страна: {get_country_flag(country)} {country}\n\n"
-                f"⚽ Выберите клуб:",
-                reply_markup=get_clubs_keyboard(country, player_name)
-            )
-        
-        elif data.startswith("assign_club_"):
-            parts = data[12:].split("_", 1)  
-            country = parts[0]
-            club = parts[1]
-            
-            player_id = context.user_data.get('selected_player_id')
-            player_name = context.user_data.get('selected_player_name')
-            
-            if not player_id or not player_name:
-                await send_new_menu(update, context, "❌ Ошибка: игрок не выбран.")
-                return
-            
-            if not current_tournament:
-                await send_new_menu(update, context, "❌ Нет выбранного турнира.")
-                return
-            
-            # Назначаем клуб выбранному игроку
-            assign_club(current_tournament['id'], player_name, club)
-            
-            # Очищаем данные о выбранном игроке
-            context.user_data.pop('selected_player_id', None)
-            context.user_data.pop('selected_player_name', None)
-            context.user_data.pop('selected_country', None)
-            
-            # Проверяем, остались ли игроки без клубов
-            remaining_players = get_players_without_clubs(current_tournament['id'])
-            if remaining_players:
-                await send_new_menu(
-                    update, context,
-                    f"✅ {player_name} назначен клуб {get_country_flag(country)} {club}!\n\n"
-                    f"👥 Игроков без клубов осталось: {len(remaining_players)}\n\n"
-                    "Выберите следующего игрока:",
-                    reply_markup=get_players_keyboard(current_tournament['id'])
-                )
-            else:
-                await send_new_menu(
-                    update, context,
-                    f"✅ {player_name} назначен клуб {get_country_flag(country)} {club}!\n\n"
-                    "🎉 Всем игрокам назначены клубы! Можете генерировать расписание."
-                )
-        
-        elif data == "assign_random":
-            if not current_tournament:
-                await send_new_menu(update, context, "❌ Нет выбранного турнира.")
-                return
-            assign_random_clubs(current_tournament['id'])
-            await send_new_menu(update, context, "🎲 Клубы назначены случайно!")
-        
-        elif data == "generate_schedule":
-            if not user_is_admin:
-                await send_new_menu(update, context, "❌ Только администраторы могут генерировать расписание.")
-                return
-                
-            if not current_tournament:
-                await send_new_menu(update, context, "❌ Нет выбранного турнира.")
-                return
-            
-            # Проверяем есть ли уже матчи
-            existing_matches = get_schedule(current_tournament['id'])
-            if existing_matches:
-                await send_new_menu(
-                    update, context,
-                    "⚠️ В турнире уже есть матчи!\n\n"
-                    "🚨 Генерация нового расписания удалит все текущие результаты!\n\n"
-                    "Вы уверены?",
-                    reply_markup=InlineKeyboardMarkup([
-                        [InlineKeyboardButton("✅ Да, сгенерировать", callback_data="confirm_generate_schedule")],
-                        [InlineKeyboardButton("❌ Отмена", callback_data="main_menu")]
-                    ])
-                )
-            else:
-                generate_schedule(current_tournament['id'], current_tournament['rounds'])
-                await send_new_menu(update, context, "📅 Расписание сгенерировано!")
-        
-        elif data == "confirm_generate_schedule":
-            if not user_is_admin:
-                await send_new_menu(update, context, "❌ Только администраторы могут генерировать расписание.")
-                return
-                
-            if not current_tournament:
-                await send_new_menu(update, context, "❌ Нет выбранного турнира.")
-                return
-                
-            generate_schedule(current_tournament['id'], current_tournament['rounds'])
-            await send_new_menu(update, context, "📅 Расписание сгенерировано! Все предыдущие результаты удалены.")
-        
-        elif data == "show_schedule":
-            if not current_tournament:
-                await send_new_menu(update, context, "❌ Нет выбранного турнира.")
-                return
-                
-            sched = get_schedule(current_tournament['id'])
-            if not sched:
-                await send_new_menu(update, context, "📋 Нет матчей. Сгенерируйте расписание.")
+        tid = current_tournament['id']
+
+        if not context.args:
+            rows = get_deadlines(tid)
+            if not rows:
+                await update.message.reply_text("⏰ Сроков нет.\n\n" + DEADLINE_HELP)
                 return
+            lines = [f"⏰ Сроки туров ({'тех. ничья после срока' if current_tournament['auto_forfeit'] else 'без тех. ничьих'}):"]
+            for d in rows:
+                status = "⌛ истек" if d["expired"] else ("🔔 напомнили" if d["reminded"] else "⏳")
+                when = datetime.fromisoformat(d["due_at"]).strftime(DEADLINE_FORMAT)
+                lines.append(f"Тур {d['round_no']}: до {when} {status}")
+            await update.message.reply_text("\n".join(lines))
+            return
+
+        if not await is_admin(update, context):
+            return await update.message.reply_text("❌ Только админы.")
+        if len(context.args) < 2:
+            await update.message.reply_text(DEADLINE_HELP)
+            return
+
+        round_no = int(context.args[0])
+        value = " ".join(context.args[1:])
+        if value.lower() in ("off", "нет", "-"):
+            found = delete_deadline(tid, round_no)
+            await update.message.reply_text(f"✅ Срок тура {round_no} снят." if found else "ℹ️ Срока у этого тура не было.")
+            return
+
+        due = parse_deadline(value)
+        if due <= datetime.now():
+            await update.message.reply_text("❌ Срок уже прошел.")
+            return
+        conn = db()
+        pending = _pending_round_matches(conn.cursor(), tid, round_no)
+        conn.close()
+        if not pending:
+            await update.message.reply_text(f"ℹ️ В туре {round_no} нет несыгранных матчей.")
+            return
+
+        set_deadline(tid, round_no, due)
+        schedule_deadline(context.application, tid, round_no)
+        hours = int(REMIND_BEFORE // 3600)
+        await update.message.reply_text(
+            f"⏰ Тур {round_no}: сыграть до {due.strftime(DEADLINE_FORMAT)} (матчей: {len(pending)}).\n"
+            f"Напомню за {hours} ч."
+            + ("\nПосле срока несыгранные матчи получат 0:0." if current_tournament['auto_forfeit'] else "")
+        )
+    except ValueError:
+        await update.message.reply_text("❌ Неверный формат.\n\n" + DEADLINE_HELP)
+    except Exception as e:
+        print(f"Ошибка в cmd_deadline: {e}")
+        await update.message.reply_text("❌ Ошибка настройки срока.")
 
-            lines = ["📅 РАСПИСАНИЕ МАТЧЕЙ:\n"]
-            for m in sched:
-                status = "✅" if m['played'] else "⏳"
-                hg = m['home_goals'] if m['home_goals'] is not None else "-"
-                ag = m['away_goals'] if m['away_goals'] is not None else "-"
-                no = match_no(m)
+async def cmd_forfeit(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Команда /forfeit on|off - техническая ничья после срока тура"""
+    try:
+        if not await is_admin(update, context):
+            return await update.message.reply_text("❌ Только админы.")
 
-                home_short = m['home'][:8] if len(m['home']) > 8 else m['home']
-                away_short = m['away'][:8] if len(m['away']) > 8 else m['away']
+        current_tournament = get_current_tournament(update.effective_chat.id)
+        if not current_tournament:
+            await update.message.reply_text("❌ Нет выбранного турнира.")
+            return
 
-                lines.append(f"{status} #{no}: {home_short} vs {away_short} [{hg}:{ag}]")
+        if len(context.args) != 1 or context.args[0].lower() not in ("on", "off"):
+            await update.message.reply_text("📝 Формат: /forfeit on или /forfeit off")
+            return
+        enabled = context.args[0].lower() == "on"
+        set_auto_forfeit(current_tournament['id'], enabled)
+        await update.message.reply_text(
+            "✅ После срока несыгранные матчи получат 0:0 (кроме плей-офф)." if enabled
+            else "✅ Технические ничьи отключены: после срока придет только напоминание."
+        )
+    except Exception as e:
+        print(f"Ошибка в cmd_forfeit: {e}")
+        await update.message.reply_text("❌ Ошибка настройки.")
 
-            await send_new_menu(update, context, "\n".join(lines))
-        
-        elif data == "show_table":
-            if not current_tournament:
-                await send_new_menu(update, context, "❌ Нет выбранного турнира.")
-                return
-                
-            ordered = get_standings(current_tournament['id'])
-            msg = format_table(current_tournament['id'], ordered)
-            await send_new_menu(
-                update, context,
-                f"📊 ТУРНИРНАЯ ТАБЛИЦА:\n\n{msg}",
-                parse_mode=ParseMode.HTML
-            )
-        
-        elif data == "record_result":
-            if not current_tournament:
-                await send_new_menu(update, context, "❌ Нет выбранного турнира.")
-                return
-            
-            await send_new_menu(
-                update, context,
-                "⚽ Выберите матч для записи результата:\n\n⚽ - не сыгран, ✅ - завершен",
-                reply_markup=get_matches_keyboard(current_tournament['id'], unplayed_only=True)
-            )
-        
-        elif data == "edit_result":
-            if not current_tournament:
-                await send_new_menu(update, context, "❌ Нет выбранного турнира.")
-                return
-            
-            await send_new_menu(
-                update, context,
-                "✏️ Выберите матч для изменения результата:\n\n✅ - завершенные матчи",
-                reply_markup=get_matches_keyboard(current_tournament['id'], unplayed_only=False, for_edit=True)
-            )
-        
-        elif data.startswith("select_match_"):
-            match_id = int(data[13:])
-            if not current_tournament:
-                await send_new_menu(update, context, "❌ Нет выбранного турнира.")
-                return
+async def cmd_club(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Команда /club Имя запрос - найти клуб по части названия и назначить одним нажатием"""
+    try:
+        current_tournament = get_current_tournament(update.effective_chat.id)
+        if not current_tournament:
+            await update.message.reply_text("❌ Нет выбранного турнира.")
+            return
+        # Имя игрока может быть из нескольких слов - берем самый длинный совпавший префикс
+        player, query = None, ""
+        for split in range(len(context.args) - 1, 0, -1):
+            player = find_player(current_tournament['id'], " ".join(context.args[:split]))
+            if player:
+                query = " ".join(context.args[split:])
+                break
+        if not player:
+            await update.message.reply_text("📝 Формат: /club Имя запрос\nПример: /club Амир барса")
+            return
+        found = search_clubs(query)
+        if not found:
+            await update.message.reply_text(f"🔎 По запросу «{query}» клубов не нашлось.")
+            return
+        start_flow(update.effective_chat.id, update.effective_user.id, ClubFlow(current_tournament['id'], player['id']))
+        await update.message.reply_text(f"🔎 Клуб для {player['name']}:", reply_markup=get_club_search_keyboard(found))
+    except Exception as e:
+        print(f"Ошибка в cmd_club: {e}")
+        await update.message.reply_text("❌ Ошибка поиска клуба.")
 
-            match = get_match_by_id(current_tournament['id'], match_id)
-            if not match:
-                await send_new_menu(update, context, "❌ Матч не найден.")
-                return
+async def cmd_iam(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Команда /iam Имя - привязать свой аккаунт к участнику турнира"""
+    try:
+        current_tournament = get_current_tournament(update.effective_chat.id)
+        if not current_tournament:
+            await update.message.reply_text("❌ Нет выбранного турнира.")
+            return
+        tid = current_tournament['id']
+        user = update.effective_user
 
-            if match['played']:
-                await send_new_menu(
-                    update, context,
-                    f"❌ Результат этого матча уже записан: {match['home']} {match['home_goals']}:{match['away_goals']} {match['away']}"
-                )
-                return
+        if not context.args:
+            player = get_linked_player(tid, user.id)
+            await update.message.reply_text(
+                f"🔗 Вы — {player['name']}. Счет своего матча: /report ID X-Y" if player
+                else "📝 Формат: /iam Имя (как в турнире). Админ может ответить так на сообщение игрока.")
+            return
 
-            context.user_data['selected_match_id'] = match_id
-            context.user_data['selected_match'] = dict(match)
-            context.user_data['match_scores'] = {}
+        # Ответом на сообщение админ привязывает автора того сообщения
+        reply = update.message.reply_to_message
+        force = False
+        if reply and reply.from_user and reply.from_user.id != user.id:
+            if not await is_admin(update, context):
+                return await update.message.reply_text("❌ Привязывать других может только админ.")
+            user, force = reply.from_user, True
 
-            no = match_no(match)
-            await send_new_menu(
-                update, context,
-                f"⚽ Матч #{no}: {match['home']} vs {match['away']}\n\n"
-                f"Сколько голов забил {match['home']}?",
-                reply_markup=get_score_keyboard(match_id, match['home'])
+        try:
+            player = link_player(tid, " ".join(context.args), user.id, force)
+        except ValueError as e:
+            await update.message.reply_text(f"❌ {e}")
+            return
+        await update.message.reply_text(f"🔗 {user.first_name} — это {player['name']} в турнире «{current_tournament['name']}».")
+    except Exception as e:
+        print(f"Ошибка в cmd_iam: {e}")
+        await update.message.reply_text("❌ Ошибка привязки.")
+
+async def cmd_report(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Команда /report ID X-Y - игрок заявляет счет, соперник подтверждает"""
+    try:
+        current_tournament = get_current_tournament(update.effective_chat.id)
+        if not current_tournament:
+            await update.message.reply_text("❌ Нет выбранного турнира.")
+            return
+        if len(context.args) != 2:
+            await update.message.reply_text("📝 Формат: /report ID X-Y\nПример: /report 1 2-1")
+            return
+        match_id = int(context.args[0])
+        score = context.args[1].replace(":", "-").split("-")
+        if len(score) != 2:
+            await update.message.reply_text("❌ Неверный формат счёта. Используйте X-Y")
+            return
+        hg, ag = int(score[0]), int(score[1])
+        try:
+            match, opponent = report_result(current_tournament['id'], match_id, hg, ag,
+                                            update.effective_user.id, update.effective_chat.id)
+        except ResultError as e:
+            await update.message.reply_text(f"❌ {e}")
+            return
+
+        hours = max(int(REPORT_CONFIRM_TIMEOUT // 3600), 1)
+        await update.message.reply_text(
+            f"📝 #{match_no(match)}: {match['home']} {hg}:{ag} {match['away']}\n"
+            f"{opponent}, подтвердите счет. Без ответа он будет записан через {hours} ч.",
+            reply_markup=get_report_keyboard(match_id)
+        )
+        schedule_report(context.application, match_id)
+    except ValueError:
+        await update.message.reply_text("❌ ID и счет должны быть числами.")
+    except Exception as e:
+        print(f"Ошибка в cmd_report: {e}")
+        await update.message.reply_text("❌ Ошибка заявки результата.")
+
+async def cmd_backup(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Команда /backup [send] - бэкап базы по требованию (для BOT_ADMINS)"""
+    try:
+        if not is_bot_admin(update):
+            return await update.message.reply_text("❌ Только для администраторов бота (BOT_ADMINS).")
+
+        await update.message.reply_text("💾 Делаю бэкап...")
+        path, size, seconds = await asyncio.to_thread(backup_database)
+        timings = await asyncio.to_thread(run_maintenance)
+        text = (
+            f"✅ Бэкап: {os.path.basename(path)}\n"
+            f"Размер: {size / 1024:.0f} КБ, за {seconds:.2f} с\n"
+            f"Чекпоинт WAL: {timings['checkpoint']:.0f} мс, optimize: {timings['optimize']:.0f} мс"
+        )
+        if context.args and context.args[0].lower() == "send":
+            with open(path, "rb") as f:
+                await update.message.reply_document(document=f, filename=os.path.basename(path), caption=text)
+        else:
+            await update.message.reply_text(text)
+    except Exception as e:
+        print(f"Ошибка в cmd_backup: {e}")
+        await update.message.reply_text("❌ Ошибка бэкапа.")
+
+async def cmd_slowqueries(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Команда /slowqueries [file|reset] - статистика SQL и медленные запросы с планами (для BOT_ADMINS)"""
+    try:
+        if not is_bot_admin(update):
+            return await update.message.reply_text("❌ Только для администраторов бота (BOT_ADMINS).")
+        if not QUERY_TRACE:
+            return await update.message.reply_text("Трассировка SQL выключена (QUERY_TRACE=0).")
+
+        arg = context.args[0].lower() if context.args else ""
+        if arg == "reset":
+            reset_query_stats()
+            await update.message.reply_text("🧹 Статистика запросов сброшена.")
+        elif arg == "file":
+            data = json.dumps(query_stats_dump(), ensure_ascii=False, indent=1).encode("utf-8")
+            await update.message.reply_document(
+                document=io.BytesIO(data), filename=f"slowqueries_{datetime.now():%Y%m%d_%H%M}.json",
+                caption="🐢 Все виды запросов с планами и журнал медленных",
             )
-        
-        elif data.startswith("score_"):
-            parts = data[6:].split("_", 3)
-            if len(parts) < 3:
-                await send_new_menu(update, context, "❌ Ошибка формата данных.")
-                return
-                
-            match_id = int(parts[0])
-            player_name = parts[1]
-            goals = int(parts[2])
+        else:
+            await update.message.reply_text(format_query_report())
+    except Exception as e:
+        print(f"Ошибка в cmd_slowqueries: {e}")
+        await update.message.reply_text("❌ Ошибка статистики запросов.")
 
-            match = context.user_data.get('selected_match')
-            if not match:
-                await send_new_menu(update, context, "❌ Ошибка: матч не выбран.")
-                return
+# -------------------------
+# Жизненный цикл: запуск, остановка, восстановление
+# -------------------------
+# Запуск - упорядоченные шаги (миграция базы первой и обязательна), после них
+# начинается прием обновлений. Все, без чего первое обновление обработать можно
+# (обслуживание, API, живые таблицы, прогрев кэшей недавних чатов), идет фоном
+# уже после старта приема. По SIGTERM прием прекращается, начатые
+# обработчики и задачи дорабатывают не дольше SHUTDOWN_GRACE, затем база
+# сбрасывается на диск и пишутся итоговые метрики. Живые таблицы, не
+# успевшие обновиться, догоняются при следующем запуске по версии данных.
+SHUTDOWN_GRACE = float(os.getenv("SHUTDOWN_GRACE", "20"))  # сек
+REPLAY_PENDING_UPDATES = os.getenv("REPLAY_PENDING_UPDATES", "0") == "1"
+REPLAY_MAX_AGE = float(os.getenv("REPLAY_MAX_AGE", "3600"))  # старше - не выполняем
+METRICS_FILE = os.getenv("METRICS_FILE", "")
+WARM_CHATS = int(os.getenv("WARM_CHATS", "50"))  # сколько недавних чатов прогревать
+WARM_DAYS = 7
 
-            if not current_tournament:
-                await send_new_menu(update, context, "❌ Нет выбранного турнира.")
-                return
+_lifecycle = {"started": time.time(), "updates": 0, "stale": 0}
 
-            context.user_data.setdefault('match_scores', {})
-            context.user_data['match_scores'][player_name] = goals
+async def admit_update(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Считает обновления; при повторе накопленных за простой отсеивает слишком старые сообщения"""
+    _lifecycle["updates"] += 1
+    message = update.message or update.edited_message
+    if REPLAY_PENDING_UPDATES and message and message.date:
+        if (datetime.now(timezone.utc) - message.date).total_seconds() > REPLAY_MAX_AGE:
+            _lifecycle["stale"] += 1
+            raise ApplicationHandlerStop
 
-            no = match_no(match)
+def get_recent_chats(limit: int = WARM_CHATS, days: int = WARM_DAYS) -> List[int]:
+    """Свои чаты, где недавно кто-то писал, - сначала самые свежие"""
+    since = (datetime.now() - timedelta(days=days)).isoformat()
+    conn = db()
+    c = conn.cursor()
+    c.execute("""
+        SELECT chat_id, MAX(last_seen) AS seen FROM chat_users
+        WHERE last_seen >= ? GROUP BY chat_id ORDER BY seen DESC
+    """, (since,))
+    chats = [r["chat_id"] for r in c.fetchall() if owns_chat(r["chat_id"])]
+    conn.close()
+    return chats[:limit]
 
-            if len(context.user_data['match_scores']) == 1:
-                # Первый игрок - показываем форму для второго
-                other_player = match['away'] if player_name == match['home'] else match['home']
-                await send_new_menu(
-                    update, context,
-                    f"⚽ Матч #{no}: {match['home']} vs {match['away']}\n"
-                    f"✅ {player_name}: {goals} голов\n\n"
-                    f"Сколько голов забил {other_player}?",
-                    reply_markup=get_score_keyboard(match_id, other_player)
-                )
-            else:
-                # Второй игрок - записываем результат и показываем итог
-                home_goals = context.user_data['match_scores'].get(match['home'], 0)
-                away_goals = context.user_data['match_scores'].get(match['away'], 0)
+def warm_current_tournaments(chat_ids: List[int]) -> List[sqlite3.Row]:
+    """Одним запросом заполняет кэш текущих турниров для списка чатов"""
+    if not chat_ids:
+        return []
+    conn = db()
+    c = conn.cursor()
+    c.execute(f"""
+        SELECT t.* FROM chat_current_tournament cct
+        JOIN tournaments t ON t.id = cct.tournament_id AND t.chat_id = cct.chat_id
+        WHERE cct.chat_id IN ({",".join("?" * len(chat_ids))})
+    """, chat_ids)
+    rows = c.fetchall()
+    conn.close()
+    for row in rows:
+        _current_tournament_cache.setdefault(row["chat_id"], row)
+    return rows
 
-                # Записываем результат
-                record_result(current_tournament['id'], match_id, home_goals, away_goals)
+async def warm_chats(application: Application, chat_ids: List[int]) -> str:
+    """Текущие турниры, готовые таблицы и расписания, списки админов групп"""
+    tournaments = warm_current_tournaments(chat_ids)
+    for t in tournaments:
+        try:
+            format_standings(t)
+            format_schedule(t['id'])
+        except Exception as e:
+            print(f"Ошибка прогрева турнира {t['id']}: {e}")
+        await asyncio.sleep(0)  # не задерживаем уже идущие обновления
+    groups = [chat_id for chat_id in chat_ids if chat_id < 0]
+    loaded = 0
+    for i in range(0, len(groups), 10):
+        results = await asyncio.gather(*(load_chat_admins(application.bot, chat_id) for chat_id in groups[i:i + 10]))
+        loaded += sum(results)
+    return f"чатов: {len(chat_ids)}, турниров: {len(tournaments)}, админов загружено: {loaded}"
 
-                match_comment = get_funny_match_comment(home_goals, away_goals)
-                ordered = get_standings(current_tournament['id'])
-                prize = get_current_tournament_prize(current_tournament['id'])
-                msg = format_table(current_tournament['id'], ordered)
+def checkpoint_database():
+    conn = db()
+    try:
+        conn.execute("PRAGMA wal_checkpoint(TRUNCATE);")
+    finally:
+        conn.close()
 
-                home = _html_escape(match['home'])
-                away = _html_escape(match['away'])
-                comment = _html_escape(match_comment)
+def collect_metrics() -> dict:
+    return {
+        "uptime_s": round(time.time() - _lifecycle["started"]),
+        "updates": _lifecycle["updates"],
+        "stale_skipped": _lifecycle["stale"],
+        "shard": list(WORKER_SHARD) if WORKER_SHARD else None,
+        "render_cache": render_cache_info(),
+        "current_tournament_cache": current_tournament_cache_info(),
+        "guard": guard_info(),
+        "flows": len(_flows),
+        "flow_bytes_by_chat": dict(sorted(flow_memory_by_chat().items(), key=lambda kv: -kv[1])[:10]),
+        "timers": len(_timer_heap),
+        "sql": query_stats_info(),
+    }
 
-                result_text = (
-                    f"✅ Результат записан!\n"
-                    f"⚽ Матч #{no}: {home} {home_goals}:{away_goals} {away}\n\n"
-                    f"{comment}\n\n"
-                    f"{msg}"
-                )
+def write_metrics() -> dict:
+    metrics = collect_metrics()
+    print("Метрики: " + json.dumps(metrics, ensure_ascii=False))
+    if METRICS_FILE:
+        path = METRICS_FILE
+        if WORKER_SHARD:
+            base, ext = os.path.splitext(METRICS_FILE)
+            path = f"{base}.{WORKER_SHARD[0]}{ext}"
+        with open(path + ".tmp", "w", encoding="utf-8") as f:
+            json.dump(metrics, f, ensure_ascii=False, indent=1)
+        os.replace(path + ".tmp", path)
+    return metrics
 
-                await send_new_menu(update, context, result_text, parse_mode=ParseMode.HTML)
+def _owns_database() -> bool:
+    # Общие для всей базы задачи держит единственный процесс или первый воркер
+    return WORKER_SHARD is None or WORKER_SHARD[0] == 0
 
-                fun = get_funny_message(ordered, prize)
-                if fun:
-                    await context.bot.send_message(chat_id=chat_id, text=fun)
+async def _startup_migrate(application: Application):
+    if WORKER_SHARD is not None:
+        return "уже выполнена приемником"
+    await asyncio.to_thread(init_db)
 
-                # Чистим состояние
-                context.user_data.pop('selected_match_id', None)
-                context.user_data.pop('selected_match', None)
-                context.user_data.pop('match_scores', None)
-        
-        elif data == "finish_tournament":
-            if not user_is_admin:
-                await send_new_menu(update, context, "❌ Только администраторы могут завершить турнир.")
-                return
-                
-            if not current_tournament:
-                await send_new_menu(update, context, "❌ Нет выбранного турнира.")
-                return
-            
-            ordered = get_standings(current_tournament['id'])
-            if not ordered or all(player[1]['P'] == 0 for player in ordered):
-                await send_new_menu(update, context, "❌ Нельзя завершить турнир без сыгранных матчей!")
-                return
-            
-            await send_new_menu(
-                update, context,
-                "🏁 Вы уверены, что хотите завершить турнир?\n\n"
-                "⚠️ После завершения турнир нельзя будет изменить!",
-                reply_markup=InlineKeyboardMarkup([
-                    [InlineKeyboardButton("✅ Завершить турнир", callback_data="confirm_finish_tournament")],
-                    [InlineKeyboardButton("❌ Отмена", callback_data="main_menu")]
-                ])
-            )
-        
-        elif data == "confirm_finish_tournament":
-            if not user_is_admin:
-                await send_new_menu(update, context, "❌ Только администраторы могут завершить турнир.")
-                return
-                
-            if not current_tournament:
-                await send_new_menu(update, context, "❌ Нет выбранного турнира.")
-                return
-            
-            # Получаем финальные результаты
-            ordered = get_standings(current_tournament['id'])
-            prize = get_current_tournament_prize(current_tournament['id'])
-            msg = format_table(current_tournament['id'], ordered)
-            
-            winner = ordered[0][0] if ordered else "Неизвестно"
-            
-            # Убираем текущий турнир
-            conn = db()
-            c = conn.cursor()
-            c.execute("DELETE FROM chat_current_tournament WHERE chat_id=?", (chat_id,))
-            conn.commit()
-            conn.close()
-            
-            await send_new_menu(
-                update, context,
-                f"🏁 ТУРНИР ЗАВЕРШЕН! 🏁\n\n"
-                f"🏆 Турнир: {current_tournament['name']}\n"
-                f"👑 ПОБЕДИТЕЛЬ: {winner}\n"
-                f"🎁 Приз: {prize}\n\n"
-                f"📊 ФИНАЛЬНАЯ ТАБЛИЦА:\n\n{msg}\n\n"
-                f"🎉 Поздравляем победителя!",
-                parse_mode=ParseMode.HTML
-            )
-            
-            # Отправляем отдельное сообщение с поздравлением
-            await context.bot.send_message(
-                chat_id=chat_id, 
-                text=f"🎊 {winner} забирает {prize}! Поздравляем! 🎊"
-            )
-        
-        elif data.startswith("edit_match_"):
-            match_id = int(data[11:])
-            if not current_tournament:
-                await send_new_menu(update, context, "❌ Нет выбранного турнира.")
-                return
+async def _startup_timers(application: Application):
+    return f"сроков и заявок: {load_timers(application)}"
+
+async def _startup_maintenance(application: Application):
+    if _owns_database():
+        schedule_maintenance(application)
+
+async def _startup_api(application: Application):
+    if _owns_database():
+        await start_api_server(application)
+
+async def _startup_warm(application: Application):
+    return await warm_chats(application, get_recent_chats())
+
+async def _startup_live_tables(application: Application):
+    stale = get_stale_live_tables()
+    for tid in stale:
+        schedule_live_table_update(application, tid)
+    return f"догоняем: {len(stale)}"
+
+async def _shutdown_api(application: Application):
+    server = application.bot_data.pop("api_server", None)
+    if server:
+        server.close()
+        await server.wait_closed()
+
+async def _shutdown_database(application: Application):
+    if _owns_database():
+        await asyncio.to_thread(checkpoint_database)
+
+async def _shutdown_metrics(application: Application):
+    write_metrics()
+
+# (название, шаг, обязателен ли) - выполняются строго по порядку
+STARTUP_HOOKS = [
+    ("миграция базы", _startup_migrate, True),
+    ("таймеры", _startup_timers, False),
+]
+# Фоном после начала приема обновлений
+WARMUP_HOOKS = [
+    ("недавние чаты", _startup_warm, False),
+    ("живые таблицы", _startup_live_tables, False),
+    ("обслуживание и бэкапы", _startup_maintenance, False),
+    ("HTTP API", _startup_api, False),
+]
+SHUTDOWN_HOOKS = [
+    ("HTTP API", _shutdown_api, False),
+    ("сброс WAL", _shutdown_database, False),
+    ("метрики", _shutdown_metrics, False),
+]
+
+async def run_hooks(application: Application, hooks: list, stage: str):
+    for name, hook, required in hooks:
+        t0 = time.perf_counter()
+        try:
+            note = await hook(application)
+        except Exception as e:
+            print(f"❌ {stage}, {name}: {e}")
+            if required:
+                raise
+            continue
+        print(f"  {stage}, {name}: {(time.perf_counter() - t0) * 1000:.0f} мс" + (f" ({note})" if note else ""))
 
-            match = get_match_by_id(current_tournament['id'], match_id)
-            if not match:
-                await send_new_menu(update, context, "❌ Матч не найден.")
-                return
+async def on_startup(application: Application):
+    """Шаги запуска до application.start(); прием обновлений начинается после них"""
+    await run_hooks(application, STARTUP_HOOKS, "запуск")
 
-            context.user_data['edit_match_id'] = match_id
-            context.user_data['edit_match'] = dict(match)
-            context.user_data['edit_match_scores'] = {}
+def start_warm_up(application: Application):
+    """Отложенные шаги запуска - вызывать, когда прием обновлений уже начат"""
+    print(f"Готов к приему обновлений через {(time.time() - _lifecycle['started']) * 1000:.0f} мс после загрузки")
+    application.create_task(run_hooks(application, WARMUP_HOOKS, "прогрев"), name="warm_up")
 
-            no = match_no(match)
-            await send_new_menu(
-                update, context,
-                f"✏️ Редактирование матча #{no}: {match['home']} vs {match['away']}\n"
-                f"Текущий счет: {match['home_goals']}:{match['away_goals']}\n\n"
-                f"Новое количество голов для {match['home']}?",
-                reply_markup=get_score_keyboard(match_id, match['home'], is_edit=True)
-            )
-        
-        elif data.startswith("edit_score_"):
-            parts = data[11:].split("_", 3)
-            if len(parts) < 3:
-                await send_new_menu(update, context, "❌ Ошибка формата данных.")
-                return
-                
-            match_id = int(parts[0])
-            player_name = parts[1]
-            goals = int(parts[2])
+async def on_shutdown(application: Application):
+    await run_hooks(application, SHUTDOWN_HOOKS, "остановка")
 
-            match = context.user_data.get('edit_match')
-            if not match:
-                await send_new_menu(update, context, "❌ Ошибка: матч не выбран.")
-                return
+async def drain_application(application: Application):
+    """Application.stop() дорабатывает очередь, задачи и job'ы - ограничиваем его по времени"""
+    try:
+        await asyncio.wait_for(application.stop(), SHUTDOWN_GRACE)
+    except asyncio.TimeoutError:
+        print(f"⚠️ Обработчики не уложились в {SHUTDOWN_GRACE:.0f} с и прерваны")
 
-            if not current_tournament:
-                await send_new_menu(update, context, "❌ Нет выбранного турнира.")
-                return
+def stop_signal_event() -> asyncio.Event:
+    """Событие, которое выставят SIGTERM/SIGINT"""
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGTERM, signal.SIGINT):
+        try:
+            loop.add_signal_handler(sig, stop.set)
+        except (NotImplementedError, RuntimeError):
+            pass  # Windows: остается KeyboardInterrupt
+    return stop
 
-            context.user_data.setdefault('edit_match_scores', {})
-            context.user_data['edit_match_scores'][player_name] = goals
+async def run_bot(application: Application):
+    """Запуск в режиме polling с корректной остановкой"""
+    stop = stop_signal_event()
+    async with application:
+        # Шаги запуска - до start(): job queue и прием обновлений видят уже мигрированную
+        # базу, а ошибка обязательного шага выходит из неподнятого приложения как есть
+        await on_startup(application)
+        await application.start()
+        # Без REPLAY_PENDING_UPDATES присланное во время простоя отбрасывается, как раньше
+        await application.updater.start_polling(drop_pending_updates=not REPLAY_PENDING_UPDATES)
+        start_warm_up(application)
+        print("Бот запущен.")
+        await stop.wait()
+        print("Остановка: прием обновлений прекращен, дорабатываем начатое...")
+        await application.updater.stop()
+        await drain_application(application)
+        await on_shutdown(application)
 
-            no = match_no(match)
+# -------------------------
+# HTTP: минимальный разбор запросов
+# -------------------------
+HTTP_MAX_BODY = 1024 * 1024
+HTTP_READ_TIMEOUT = 10
+HTTP_REASONS = {
+    200: "OK", 304: "Not Modified", 400: "Bad Request", 403: "Forbidden",
+    404: "Not Found", 405: "Method Not Allowed", 413: "Payload Too Large",
+    500: "Internal Server Error",
+}
 
-            if len(context.user_data['edit_match_scores']) == 1:
-                # Первый игрок - показываем форму для второго
-                other_player = match['away'] if player_name == match['home'] else match['home']
-                await send_new_menu(
-                    update, context,
-                    f"✏️ Редактирование матча #{no}: {match['home']} vs {match['away']}\n"
-                    f"✅ {player_name}: {goals} голов\n\n"
-                    f"Новое количество голов для {other_player}?",
-                    reply_markup=get_score_keyboard(match_id, other_player, is_edit=True)
-                )
-            else:
-                # Второй игрок - записываем результат и показываем итог
-                home_goals = context.user_data['edit_match_scores'].get(match['home'], 0)
-                away_goals = context.user_data['edit_match_scores'].get(match['away'], 0)
+async def read_http_request(reader: asyncio.StreamReader) -> Optional[tuple]:
+    """Читает один HTTP/1.1 запрос: (метод, путь, заголовки, тело) или None.
+    Слишком большое тело - ValueError"""
+    try:
+        head = await asyncio.wait_for(reader.readuntil(b"\r\n\r\n"), HTTP_READ_TIMEOUT)
+    except (asyncio.IncompleteReadError, asyncio.LimitOverrunError, asyncio.TimeoutError):
+        return None
+    lines = head.decode("latin-1").split("\r\n")
+    parts = lines[0].split(" ")
+    if len(parts) != 3:
+        return None
+    headers = {}
+    for line in lines[1:]:
+        if ":" in line:
+            key, value = line.split(":", 1)
+            headers[key.strip().lower()] = value.strip()
+    length = int(headers.get("content-length") or 0)
+    if length > HTTP_MAX_BODY:
+        raise ValueError(f"тело {length} байт")
+    body = await asyncio.wait_for(reader.readexactly(length), HTTP_READ_TIMEOUT) if length else b""
+    return parts[0].upper(), parts[1], headers, body
 
-                # Записываем новый результат
-                record_result(current_tournament['id'], match_id, home_goals, away_goals)
+def http_response(status: int, body: bytes = b"", content_type: str = "application/json; charset=utf-8",
+                  headers: Optional[Dict[str, str]] = None) -> bytes:
+    lines = [f"HTTP/1.1 {status} {HTTP_REASONS.get(status, '')}",
+             f"Content-Length: {len(body)}", "Connection: close"]
+    if body:
+        lines.append(f"Content-Type: {content_type}")
+    lines += [f"{key}: {value}" for key, value in (headers or {}).items()]
+    return ("\r\n".join(lines) + "\r\n\r\n").encode("latin-1") + body
 
-                match_comment = get_funny_match_comment(home_goals, away_goals)
-                ordered = get_standings(current_tournament['id'])
-                prize = get_current_tournament_prize(current_tournament['id'])
-                msg = format_table(current_tournament['id'], ordered)
+# -------------------------
+# HTTP API только для чтения (табло, внешние экраны)
+# -------------------------
+# GET /chats/<chat_id>/tournaments
+# GET /tournaments/<id>  |  /tournaments/<id>/standings|schedule|stats
+# ETag строится из версии данных турнира: опрос без изменений стоит одного
+# запроса к data_versions и отдает 304 без тела.
+API_PORT = int(os.getenv("API_PORT", "0"))  # 0 - API выключено
+API_HOST = os.getenv("API_HOST", "127.0.0.1")  # наружу - только вместе с API_TOKEN
+API_TOKEN = os.getenv("API_TOKEN", "")
+API_ROUTE_RE = re.compile(r"^/(?:chats/(?P<chat>-?\d+)/tournaments|tournaments/(?P<tid>\d+)(?:/(?P<view>standings|schedule|stats))?)/?$")
 
-                home = _html_escape(match['home'])
-                away = _html_escape(match['away'])
-                comment = _html_escape(match_comment)
-                old_score = f"{match['home_goals']}:{match['away_goals']}"
+def _api_tournament(t: sqlite3.Row) -> dict:
+    return {"id": t["id"], "chat_id": t["chat_id"], "name": t["name"], "prize": t["prize"],
+            "format": t["format"] or "league", "rounds": t["rounds"], "created_at": t["created_at"]}
 
-                result_text = (
-                    f"✅ Результат изменен!\n"
-                    f"⚽ Матч #{no}: {home} {home_goals}:{away_goals} {away}\n"
-                    f"📝 Было: {old_score} → Стало: {home_goals}:{away_goals}\n\n"
-                    f"{comment}\n\n"
-                    f"{msg}"
-                )
+def _api_table(ordered: List[tuple], clubs: Dict[str, str]) -> List[dict]:
+    return [{"pos": i, "player": name, "club": clubs.get(name),
+             "played": st["P"], "won": st["W"], "drawn": st["D"], "lost": st["L"],
+             "goals_for": st["GF"], "goals_against": st["GA"], "goal_diff": st["GD"], "points": st["PTS"]}
+            for i, (name, st) in enumerate(ordered, start=1)]
 
-                await send_new_menu(update, context, result_text, parse_mode=ParseMode.HTML)
+def _api_overview(tournament_id: int) -> dict:
+    players = get_players(tournament_id)
+    return {"tournament": _api_tournament(get_tournament(tournament_id)),
+            "players": [{"name": p["name"], "club": p["club"], "group": p["group_name"]} for p in players]}
 
-                fun = get_funny_message(ordered, prize)
-                if fun:
-                    await context.bot.send_message(chat_id=chat_id, text=fun)
+def _api_standings(tournament_id: int) -> dict:
+    players = get_players(tournament_id)
+    clubs = {p["name"]: p["club"] for p in players}
+    body = {"tournament": _api_tournament(get_tournament(tournament_id)),
+            "standings": _api_table(get_standings(tournament_id), clubs)}
+    groups = sorted({p["group_name"] for p in players if p["group_name"]})
+    if groups:
+        body["groups"] = {g: _api_table(get_standings(tournament_id, g), clubs) for g in groups}
+    return body
 
-                # Чистим состояние
-                context.user_data.pop('edit_match_id', None)
-                context.user_data.pop('edit_match', None)
-                context.user_data.pop('edit_match_scores', None)
-        
-        else:
-            await send_new_menu(update, context, f"❌ Неизвестная команда: {data}")
-        
-    except Exception as e:
-        print(f"Ошибка в button_handler: {e}")
-        try:
-            await query.message.reply_text("❌ Произошла ошибка. Попробуйте /start")
-        except Exception:
-            pass
+def _api_schedule(tournament_id: int) -> dict:
+    matches = [{"id": m["id"], "number": match_no(m), "home": m["home"], "away": m["away"],
+                "home_goals": m["home_goals"], "away_goals": m["away_goals"], "played": bool(m["played"]),
+                "stage": m["stage"], "round": m["round_no"], "group": m["group_name"]}
+               for m in get_schedule(tournament_id)]
+    return {"tournament": _api_tournament(get_tournament(tournament_id)), "matches": matches}
 
-# Обработчик текстовых сообщений
-async def handle_text(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    """Обработчик текстовых сообщений"""
+def _api_stats(tournament_id: int) -> dict:
+    stats = get_tournament_stats(tournament_id)
+    return {"tournament": _api_tournament(get_tournament(tournament_id)), **stats}
+
+API_VIEWS = {None: _api_overview, "standings": _api_standings, "schedule": _api_schedule, "stats": _api_stats}
+
+def _api_chat_version(chat_id: int) -> str:
+    """Версия списка турниров чата: число турниров, сумма версий и текущий турнир"""
+    conn = db()
+    c = conn.cursor()
+    c.execute("""
+        SELECT COUNT(*), COALESCE(SUM(v.version), 0), MAX(t.id) FROM tournaments t
+        LEFT JOIN data_versions v ON v.tournament_id = t.id WHERE t.chat_id=?
+    """, (chat_id,))
+    count, total, last = c.fetchone()
+    c.execute("SELECT tournament_id FROM chat_current_tournament WHERE chat_id=?", (chat_id,))
+    row = c.fetchone()
+    conn.close()
+    return f"{count}.{total}.{last or 0}.{row[0] if row else 0}"
+
+def _api_chat_tournaments(chat_id: int) -> dict:
+    # Из базы, а не из кэша: при нескольких воркерах API живет в первом,
+    # а текущий турнир чужих чатов меняют другие процессы
+    conn = db()
     try:
-        if 'stage' not in context.user_data or not context.user_data['stage']:
+        current = _load_current_tournament(conn.cursor(), chat_id)
+    finally:
+        conn.close()
+    return {"chat_id": chat_id, "current": current["id"] if current else None,
+            "tournaments": [_api_tournament(t) for t in get_chat_tournaments(chat_id)]}
+
+def _api_json(payload) -> bytes:
+    return json.dumps(payload, ensure_ascii=False, separators=(",", ":")).encode()
+
+def _etag_matches(header: str, etag: str) -> bool:
+    return header.strip() == "*" or etag in [e.strip() for e in header.split(",")]
+
+def api_request(method: str, path: str, headers: Dict[str, str]) -> tuple:
+    """Ответ API: (статус, тело, заголовки)"""
+    if method != "GET":
+        return 405, _api_json({"error": "method not allowed"}), {"Allow": "GET"}
+    path, _, query = path.partition("?")
+    if API_TOKEN:
+        supplied = headers.get("authorization", "").removeprefix("Bearer ").strip()
+        params = dict(p.partition("=")[::2] for p in query.split("&") if p)
+        if API_TOKEN not in (supplied, params.get("token")):
+            return 403, _api_json({"error": "forbidden"}), {}
+    route = API_ROUTE_RE.match(path)
+    if not route:
+        return 404, _api_json({"error": "not found"}), {}
+
+    if route["chat"]:
+        chat_id = int(route["chat"])
+        etag = f'W/"chat-{chat_id}-{_api_chat_version(chat_id)}"'
+        build = lambda: _api_json(_api_chat_tournaments(chat_id))
+    else:
+        tid, view = int(route["tid"]), route["view"]
+        if not get_tournament(tid):
+            return 404, _api_json({"error": "tournament not found"}), {}
+        etag = f'W/"{tid}-{get_data_version(tid)}-{view or "tournament"}"'
+        build = lambda: cached_render(tid, f"api_{view}", lambda: _api_json(API_VIEWS[view](tid)))
+
+    # no-cache: экран каждый раз спрашивает, но без изменений получает пустой 304
+    cache_headers = {"ETag": etag, "Cache-Control": "no-cache", "Access-Control-Allow-Origin": "*"}
+    if _etag_matches(headers.get("if-none-match", ""), etag):
+        return 304, b"", cache_headers
+    return 200, build(), cache_headers
+
+async def handle_api(reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+    try:
+        request = await read_http_request(reader)
+        if request is None:
             return
+        method, path, headers, _ = request
+        try:
+            status, body, extra = api_request(method, path, headers)
+        except Exception as e:
+            print(f"Ошибка API {path}: {e}")
+            status, body, extra = 500, _api_json({"error": "internal error"}), {}
+        writer.write(http_response(status, body, headers=extra))
+        await writer.drain()
+    except ValueError:
+        writer.write(http_response(413))
+    except ConnectionError:
+        pass
+    finally:
+        writer.close()
 
-        stage = context.user_data['stage']
-        text = update.message.text.strip()
-        chat_id = update.effective_chat.id
-        user_is_admin = await is_admin(update, context)
+async def start_api_server(application: Application):
+    if not API_PORT:
+        return
+    if not API_TOKEN and API_HOST not in ("127.0.0.1", "::1", "localhost"):
+        # Без токена любой, кто достучится до порта, увидит турниры всех чатов
+        print(f"❌ HTTP API не запущено: адрес {API_HOST} доступен извне, задайте API_TOKEN")
+        return
+    application.bot_data["api_server"] = await asyncio.start_server(handle_api, API_HOST, API_PORT)
+    print(f"HTTP API на порту {API_PORT}")
 
-        print(f"Text handler stage: {stage}, text: {text}")  # Для отладки
+# -------------------------
+# Несколько процессов: вебхук и воркеры по чатам
+# -------------------------
+# Приемник вебхука раскладывает обновления по N воркерам по хешу chat_id.
+# Чат всегда попадает в один и тот же процесс, а воркер обрабатывает свою
+# очередь строго по порядку - так сохраняется порядок событий в чате и
+# остаются верными кэши в памяти (текущий турнир, диалоги, H2H). База
+# общая: WAL плюс timeout в db() на случай занятой блокировки.
+BOT_WORKERS = int(os.getenv("BOT_WORKERS", "1"))
+WEBHOOK_URL = os.getenv("WEBHOOK_URL", "")
+WEBHOOK_PATH = os.getenv("WEBHOOK_PATH", "/telegram")
+WEBHOOK_PORT = int(os.getenv("PORT", "8080"))
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET", "")
 
-        if stage == 'tournament_name':
-            if not user_is_admin:
-                context.user_data['stage'] = None
-                await send_new_menu(update, context, "❌ Только администраторы группы могут создавать турниры.")
-                return
+WORKER_SHARD: Optional[tuple] = None  # (номер воркера, всего) в многопроцессном режиме
 
-            context.user_data['new_tournament'] = {'name': text}
-            context.user_data['stage'] = 'tournament_rounds'
-            await update.message.reply_text("Сколько кругов? Введите число (по умолчанию 2).")
+CHAT_UPDATE_KEYS = ("message", "edited_message", "channel_post", "edited_channel_post",
+                    "my_chat_member", "chat_member", "chat_join_request")
+USER_UPDATE_KEYS = ("inline_query", "chosen_inline_result", "shipping_query",
+                    "pre_checkout_query", "poll_answer")
 
-        elif stage == 'tournament_rounds':
-            if text and not text.isdigit():
-                await update.message.reply_text("Пожалуйста, введите число кругов (например, 2).")
-                return
+def update_chat_id(data: dict) -> int:
+    """Чат обновления по сырому JSON; для инлайн-запросов - id пользователя"""
+    for key in CHAT_UPDATE_KEYS:
+        if key in data and "chat" in data[key]:
+            return data[key]["chat"]["id"]
+    query = data.get("callback_query")
+    if query:
+        message = query.get("message")
+        return message["chat"]["id"] if message and "chat" in message else query["from"]["id"]
+    for key in USER_UPDATE_KEYS:
+        if key in data:
+            user = data[key].get("from") or data[key].get("user")
+            if user:
+                return user["id"]
+    return 0
 
-            rounds = int(text) if text.isdigit() else 2
-            context.user_data['new_tournament']['rounds'] = rounds
-            context.user_data['stage'] = 'tournament_prize'
-            await update.message.reply_text("Какой приз? (можно текстом)")
+def shard_of(chat_id: int, workers: int) -> int:
+    # crc32, а не hash(): у str он свой в каждом процессе
+    return zlib.crc32(str(chat_id).encode()) % workers
 
-        elif stage == 'tournament_prize':
-            prize = text if text else "приз"
-            nt = context.user_data.get('new_tournament', {})
-            name = nt.get('name', 'Турнир')
-            rounds = nt.get('rounds', 2)
+def owns_chat(chat_id: int) -> bool:
+    return WORKER_SHARD is None or shard_of(chat_id, WORKER_SHARD[1]) == WORKER_SHARD[0]
+
+class ReplayRequest(BaseRequest):
+    """Ответы Bot API без сети - для прогона записанного потока обновлений.
+    latency имитирует время ответа Telegram"""
+
+    def __init__(self, latency: float = 0.0):
+        self._message_id = 0
+        self._latency = latency
+
+    @property
+    def read_timeout(self) -> Optional[float]:
+        return None
+
+    async def initialize(self):
+        pass
 
+    async def shutdown(self):
+        pass
+
+    async def do_request(self, url, method, request_data=None, **timeouts) -> tuple:
+        endpoint = url.rsplit("/", 1)[-1]
+        params = request_data.parameters if request_data else {}
+        if self._latency:
+            await asyncio.sleep(self._latency)
+        if endpoint == "getMe":
+            result = {"id": 1, "is_bot": True, "first_name": "League", "username": "league_bot"}
+        elif endpoint == "getChatMember":
+            user = {"id": int(params.get("user_id", 0)), "is_bot": False, "first_name": "U"}
+            result = {"status": "creator", "user": user, "is_anonymous": False}
+        elif endpoint == "getChatAdministrators":
+            user = {"id": 1, "is_bot": False, "first_name": "Owner"}
+            result = [{"status": "creator", "user": user, "is_anonymous": False}]
+        elif endpoint.startswith(("send", "edit")) and "chat_id" in params:
+            self._message_id += 1
+            result = {"message_id": self._message_id, "date": int(time.time()),
+                      "chat": {"id": int(params["chat_id"]), "type": "group"}, "text": params.get("text", "")}
+        else:
+            result = True
+        return 200, json.dumps({"ok": True, "result": result}).encode()
+
+def worker_main(token: str, index: int, count: int, queue, done=None, replay: bool = False):
+    """Точка входа процесса-воркера"""
+    global WORKER_SHARD
+    WORKER_SHARD = (index, count)
+    # Останавливает приемник: он допишет очередь и пришлет None, воркер дорабатывает ее
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, signal.SIG_IGN)
+    if replay:
+        sys.stdout = open(os.devnull, "w")  # отладочные print обработчиков мешают замеру
+    asyncio.run(_worker_loop(token, queue, done, replay))
+
+async def _worker_loop(token: str, queue, done, replay: bool):
+    options = {"updater": None}
+    if replay:
+        options["request"] = ReplayRequest()
+    app = build_application(token, **options)
+    processed, started = 0, None
+    async with app:
+        if not replay:
+            await on_startup(app)
+        await app.start()
+        if not replay:
+            start_warm_up(app)
+        while True:
+            raw = await asyncio.to_thread(queue.get)
+            if raw is None:
+                break
+            if started is None:
+                started = time.perf_counter()
             try:
-                add_tournament(chat_id, name, prize, rounds)
+                await app.process_update(Update.de_json(json.loads(raw), app.bot))
             except Exception as e:
-                print(f"Ошибка создания турнира: {e}")
-                context.user_data['stage'] = None
-                await update.message.reply_text(f"❌ Не удалось создать турнир: {e}")
-                return
+                print(f"Ошибка обработки обновления в воркере {WORKER_SHARD[0]}: {e}")
+            processed += 1
+        await drain_application(app)
+        if not replay:
+            await on_shutdown(app)
+    if done is not None:
+        done.put((processed, time.perf_counter() - started if started else 0.0))
 
-            context.user_data['stage'] = None
-            context.user_data.pop('new_tournament', None)
-            await send_new_menu(
-                update, context,
-                f"✅ Турнир '{_html_escape(name)}' создан и выбран!\n"
-                f"🏆 Приз: {_html_escape(prize)}\n"
-                f"🔄 Кругов: {rounds}\n\n"
-                "Теперь добавляйте игроков и назначайте им клубы:",
-                parse_mode=ParseMode.HTML
-            )
+def start_workers(token: str, count: int, replay: bool = False) -> tuple:
+    import multiprocessing  # нужен только приемнику и замерам - не грузим при обычном запуске
+    ctx = multiprocessing.get_context("spawn")
+    queues = [ctx.Queue() for _ in range(count)]
+    done = ctx.Queue() if replay else None
+    procs = [ctx.Process(target=worker_main, args=(token, i, count, queues[i], done, replay),
+                         name=f"league-worker-{i}", daemon=True) for i in range(count)]
+    for proc in procs:
+        proc.start()
+    return queues, procs, done
 
-        elif stage == 'add_player_name':
-            current_tournament = get_current_tournament(chat_id)
-            if not current_tournament:
-                context.user_data['stage'] = None
-                await send_new_menu(update, context, "❌ Нет выбранного турнира.")
-                return
+def stop_workers(queues: list, procs: list):
+    for queue in queues:
+        queue.put(None)
+    deadline = time.monotonic() + SHUTDOWN_GRACE + 10
+    for proc in procs:
+        proc.join(timeout=max(deadline - time.monotonic(), 0.1))
 
-            add_player(current_tournament['id'], text)
-            context.user_data['stage'] = None
-            await send_new_menu(update, context, f"✅ Игрок {text} добавлен в турнир!")
+def route_update(queues: list, raw: str) -> int:
+    """Кладет обновление в очередь воркера его чата"""
+    shard = shard_of(update_chat_id(json.loads(raw)), len(queues))
+    queues[shard].put(raw)
+    return shard
 
-        elif stage == 'add_players_list':
-            current_tournament = get_current_tournament(chat_id)
-            if not current_tournament:
-                context.user_data['stage'] = None
-                await send_new_menu(update, context, "❌ Нет выбранного турнира.")
-                return
+async def run_ingress(token: str, workers: int):
+    """Приемник вебхука: проверяет секрет и раздает обновления воркерам"""
+    if not WEBHOOK_URL:
+        raise SystemExit("❌ Для нескольких воркеров нужен WEBHOOK_URL (публичный https-адрес)")
+    secret = WEBHOOK_SECRET or hashlib.sha256(token.encode()).hexdigest()[:32]
+    queues, procs, _ = start_workers(token, workers)
 
-            player_names = [name.strip() for name in text.split(',') if name.strip()]
-            if not player_names:
-                await update.message.reply_text(
-                    "❌ Не найдено имен игроков. Попробуйте еще раз.\n"
-                    "Пример: Амир, Диас, Влад"
-                )
+    async def handle(reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        try:
+            request = await read_http_request(reader)
+            if request is None:
                 return
+            method, path, headers, body = request
+            if path.split("?", 1)[0] != WEBHOOK_PATH:
+                status = 404
+            elif method != "POST":
+                status = 405
+            elif headers.get("x-telegram-bot-api-secret-token") != secret:
+                status = 403
+            else:
+                try:
+                    route_update(queues, body.decode("utf-8"))
+                    status = 200
+                except (ValueError, KeyError, TypeError):
+                    status = 400
+            writer.write(http_response(status))
+            await writer.drain()
+        except ValueError:
+            writer.write(http_response(413))
+        except ConnectionError:
+            pass
+        finally:
+            writer.close()
 
-            added_count = 0
-            for name in player_names:
-                if 0 < len(name) <= 50:
-                    add_player(current_tournament['id'], name)
-                    added_count += 1
+    stop = stop_signal_event()
+    async with Bot(token) as bot:
+        await bot.set_webhook(WEBHOOK_URL.rstrip("/") + WEBHOOK_PATH, secret_token=secret,
+                              drop_pending_updates=not REPLAY_PENDING_UPDATES)
+    server = await asyncio.start_server(handle, "0.0.0.0", WEBHOOK_PORT)
+    print(f"Вебхук на порту {WEBHOOK_PORT}, воркеров: {workers}")
+    try:
+        await stop.wait()
+        print("Остановка: новые обновления не принимаем, воркеры дорабатывают очереди...")
+    finally:
+        server.close()
+        await server.wait_closed()
+        await asyncio.to_thread(stop_workers, queues, procs)
 
-            context.user_data['stage'] = None
-            await send_new_menu(
-                update, context,
-                f"✅ Добавлено игроков: {added_count}\n"
-                f"👥 Список: {', '.join(player_names[:10])}{'...' if len(player_names) > 10 else ''}"
-            )
-            
-    except Exception as e:
-        print(f"Ошибка в handle_text: {e}")
-        try:
-            await update.message.reply_text("❌ Произошла ошибка. Попробуйте /start")
-        except Exception:
-            pass
+def _replay_update(update_id: int, chat_id: int, user_id: int, text: str = None, data: str = None) -> str:
+    chat = {"id": chat_id, "type": "group", "title": f"Bench {chat_id}"}
+    user = {"id": user_id, "is_bot": False, "first_name": f"U{user_id}"}
+    message = {"message_id": update_id, "date": int(time.time()), "chat": chat, "from": user, "text": text or "Меню"}
+    if data is not None:
+        message["from"] = {"id": 1, "is_bot": True, "first_name": "League"}
+        query = {"id": str(update_id), "from": user, "chat_instance": str(chat_id), "data": data, "message": message}
+        return json.dumps({"update_id": update_id, "callback_query": query})
+    if text.startswith("/"):
+        message["entities"] = [{"type": "bot_command", "offset": 0, "length": len(text.split()[0])}]
+    return json.dumps({"update_id": update_id, "message": message})
 
-# Команда для записи результата (остается текстовой для удобства)
-async def cmd_result(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    """Команда для записи результата матча"""
+def make_replay_stream(chats: int, per_chat: int, seed: int = 1) -> List[str]:
+    """Заводит по турниру на чат и собирает перемешанный поток обновлений:
+    таблица, расписание, статистика и ввод результатов. Порядок внутри чата сохранен"""
+    rnd = random.Random(seed)
+    per_chat_updates = []
+    for k in range(chats):
+        chat_id = -100000 - k
+        tid = add_tournament(chat_id, f"Bench {k}", "🏆", 2)
+        for i in range(8):
+            add_player(tid, f"P{k}_{i}")
+        generate_schedule(tid, 2)
+        conn = db()
+        match_ids = [r["id"] for r in conn.execute("SELECT id FROM matches WHERE tournament_id=? ORDER BY id", (tid,))]
+        conn.close()
+        rnd.shuffle(match_ids)
+        actions = []
+        for _ in range(per_chat):
+            roll = rnd.random()
+            if roll < 0.3 and match_ids:
+                actions.append({"text": f"/result {match_ids.pop()} {rnd.randint(0, 4)}-{rnd.randint(0, 4)}"})
+            elif roll < 0.6:
+                actions.append({"data": "show_table"})
+            elif roll < 0.8:
+                actions.append({"data": "show_schedule"})
+            else:
+                actions.append({"text": "/stats"})
+        per_chat_updates.append((chat_id, 1000 + k, actions))
+    stream = []
+    cursors = [0] * chats
+    live = list(range(chats))
+    while live:
+        k = rnd.choice(live)
+        chat_id, user_id, actions = per_chat_updates[k]
+        stream.append(_replay_update(len(stream) + 1, chat_id, user_id, **actions[cursors[k]]))
+        cursors[k] += 1
+        if cursors[k] == len(actions):
+            live.remove(k)
+    return stream
+
+def bench_workers(counts=(1, 2, 4), chats: int = 64, per_chat: int = 40):
+    """Замер масштабирования по воркерам на записанном потоке:
+    python bot_py.py --bench-workers [чатов]"""
+    global DB_PATH
+    token = "1:replay"
+    baseline = None
+    for count in counts:
+        path = os.path.join(tempfile.mkdtemp(prefix="league-bench-"), "bench.db")
+        DB_PATH = os.environ["LEAGUE_DB"] = path  # воркеры читают путь из окружения
+        os.environ["INPUT_GUARD"] = "0"  # синтетический поток быстрее любых лимитов
+        init_db()
+        stream = make_replay_stream(chats, per_chat)
+        queues, procs, done = start_workers(token, count, replay=True)
+        for raw in stream:
+            route_update(queues, raw)
+        stop_workers(queues, [])
+        results = [done.get() for _ in procs]
+        for proc in procs:
+            proc.join(timeout=30)
+        processed = sum(r[0] for r in results)
+        elapsed = max(r[1] for r in results)
+        rate = processed / elapsed if elapsed else 0.0
+        baseline = baseline or rate
+        print(f"воркеров {count}: {processed} обновлений за {elapsed:.2f} с - {rate:.0f}/с, x{rate / baseline:.2f}")
+
+def profile_imports(top: int = 12) -> float:
+    """Время импорта модуля по python -X importtime в чистом процессе:
+    python bot_py.py --profile-imports. Возвращает общее время, мс"""
+    import subprocess
+    module = os.path.splitext(os.path.basename(__file__))[0]
+    proc = subprocess.run([sys.executable, "-X", "importtime", "-c", f"import {module}"],
+                          cwd=os.path.dirname(os.path.abspath(__file__)), capture_output=True, text=True)
+    rows = []
+    for line in proc.stderr.splitlines():
+        m = re.match(r"import time:\s+(\d+) \|\s+(\d+) \|( *)(\S+)", line)
+        if m:
+            rows.append((int(m.group(2)) / 1000, int(m.group(1)) / 1000, len(m.group(3)), m.group(4)))
+    end = next((i for i, r in enumerate(rows) if r[3] == module and r[2] == 1), None)
+    if end is None:
+        print(proc.stderr[-2000:])
+        return 0.0
+    # Вывод идет после вложенных модулей: прямые зависимости (отступ 3) стоят перед строкой модуля
+    children = []
+    for row in reversed(rows[:end]):
+        if row[2] == 1:
+            break
+        if row[2] == 3:
+            children.append(row)
+    total = rows[end][0]
+    print(f"Импорт {module}: {total:.0f} мс (сам модуль {rows[end][1]:.1f} мс)")
+    if os.getenv("PYTHONDONTWRITEBYTECODE"):
+        print("  PYTHONDONTWRITEBYTECODE: модуль компилируется при каждом запуске - "
+              "соберите байткод заранее (python -m compileall) и снимите переменную")
+    for cumulative, own, _, name in sorted(children, reverse=True)[:top]:
+        print(f"  {name:<24} {cumulative:7.1f} мс (сам {own:.1f})")
+    return total
+
+def bench_startup(chats: int = 50, latency: float = 0.05):
+    """Холодный старт: импорт, миграция базы, первое обновление в чате до и после прогрева.
+    Telegram имитируется с задержкой latency: python bot_py.py --bench-startup [чатов]"""
+    global DB_PATH, INPUT_GUARD
+    import_ms = profile_imports(top=5)
+    DB_PATH = os.path.join(tempfile.mkdtemp(prefix="league-bench-"), "bench.db")
+    INPUT_GUARD = False  # повторное нажатие той же кнопки - часть замера
+    t0 = time.perf_counter()
+    init_db()
+    fresh_ms = (time.perf_counter() - t0) * 1000
+    t0 = time.perf_counter()
+    init_db()
+    migrated_ms = (time.perf_counter() - t0) * 1000
+    print(f"init_db: новая база {fresh_ms:.1f} мс, уже мигрированная {migrated_ms:.1f} мс")
+    make_replay_stream(chats, 1)  # турниры с расписанием; сам поток не нужен
+    for k in range(chats):
+        remember_chat_user(-100000 - k, 1000 + k)
+    presses = [_replay_update(k + 1, -100000 - k, 1000 + k, data="show_table") for k in range(chats)]
+
+    def reset_caches():
+        for cache in (_admin_cache, _chat_admins, _render_cache, _current_tournament_cache):
+            cache.clear()
+
+    async def first_updates(app) -> float:
+        t0 = time.perf_counter()
+        for raw in presses:
+            await app.process_update(Update.de_json(json.loads(raw), app.bot))
+        return (time.perf_counter() - t0) * 1000 / len(presses)
+
+    async def run():
+        app = build_application("1:replay", updater=None, request=ReplayRequest(latency))
+        async with app:
+            await app.start()
+            await on_startup(app)
+            reset_caches()
+            cold = await first_updates(app)
+            reset_caches()
+            t0 = time.perf_counter()
+            note = await warm_chats(app, get_recent_chats(limit=chats))
+            warm_s = time.perf_counter() - t0
+            warm = await first_updates(app)
+            await app.stop()
+        return cold, warm, warm_s, note
+
+    stdout = sys.stdout
+    sys.stdout = open(os.devnull, "w")  # отладочные print обработчиков мешают замеру
     try:
-        current_tournament = get_current_tournament(update.effective_chat.id)
-        if not current_tournament:
-            await update.message.reply_text("❌ Нет выбранного турнира.")
-            return
-        if len(context.args) != 2:
-            await update.message.reply_text("📝 Формат: /result ID X-Y\nПример: /result 1 2-1")
-            return
-        
-        match_id = int(context.args[0])
-        score = context.args[1].split("-")
-        if len(score) != 2:
-            await update.message.reply_text("❌ Неверный формат счёта. Используйте X-Y")
-            return
-        hg, ag = int(score[0]), int(score[1])
-        record_result(current_tournament['id'], match_id, hg, ag)
-        
-        # Добавляем смешной комментарий
-        match_comment = get_funny_match_comment(hg, ag)
-        
-        ordered = get_standings(current_tournament['id'])
-        prize = get_current_tournament_prize(current_tournament['id'])
-        msg = format_table(current_tournament['id'], ordered)
-        fun = get_funny_message(ordered, prize)
-        
-        await update.message.reply_text(
-            f"✅ Результат записан!\n{match_comment}\n\n{msg}",
-            parse_mode=ParseMode.HTML
-        )
-        if fun:
-            await update.message.reply_text(fun)
-    except ValueError:
-        await update.message.reply_text("❌ Неверный формат. Используйте: /result ID X-Y")
-    except Exception as e:
-        print(f"Ошибка в cmd_result: {e}")
-        await update.message.reply_text("❌ Ошибка записи результата.")
+        cold, warm, warm_s, note = asyncio.run(run())
+    finally:
+        sys.stdout.close()
+        sys.stdout = stdout
+    print(f"Прогрев ({note}): {warm_s:.2f} с")
+    print(f"Первое обновление в чате: холодно {cold:.1f} мс, после прогрева {warm:.1f} мс "
+          f"(ответ Telegram {latency * 1000:.0f} мс)")
 
 # -------------------------
 # Запуск бота
 # -------------------------
-def main():
+def build_application(token: str, **builder_options) -> Application:
+    """Создает приложение со всеми обработчиками; опции уходят в ApplicationBuilder"""
+    builder = Application.builder().token(token)
+    for name, value in builder_options.items():
+        getattr(builder, name)(value)
+    app = builder.build()
+    
+    # Команды
+    app.add_handler(CommandHandler("start", cmd_start))
+    app.add_handler(CommandHandler("menu", cmd_menu))
+    app.add_handler(CommandHandler("newtournament", cmd_new_tournament))
+    app.add_handler(CommandHandler("result", cmd_result))
+    app.add_handler(CommandHandler("results", cmd_results))
+    app.add_handler(CommandHandler("groups", cmd_groups))
+    app.add_handler(CommandHandler("swiss", cmd_swiss))
+    app.add_handler(CommandHandler("tiebreaks", cmd_tiebreaks))
+    app.add_handler(CommandHandler("fairplay", cmd_fairplay))
+    app.add_handler(CommandHandler("undo", cmd_undo))
+    app.add_handler(CommandHandler("history", cmd_history))
+    app.add_handler(CommandHandler("tableat", cmd_table_at))
+    app.add_handler(CommandHandler("h2h", cmd_h2h))
+    app.add_handler(CommandHandler("stats", cmd_stats))
+    app.add_handler(CommandHandler("export", cmd_export))
+    app.add_handler(CommandHandler("import", cmd_import))
+    app.add_handler(CommandHandler("deadline", cmd_deadline))
+    app.add_handler(CommandHandler("forfeit", cmd_forfeit))
+    app.add_handler(CommandHandler("backup", cmd_backup))
+    app.add_handler(CommandHandler("slowqueries", cmd_slowqueries))
+    app.add_handler(CommandHandler("club", cmd_club))
+    app.add_handler(CommandHandler("iam", cmd_iam))
+    app.add_handler(CommandHandler("report", cmd_report))
+    
+    # Прием (счетчик, отсев устаревших), фильтр повторов и флуда, учет чатов - раньше всех обработчиков
+    app.add_handler(TypeHandler(Update, admit_update), group=-3)
+    if INPUT_GUARD:
+        app.add_handler(TypeHandler(Update, input_guard), group=-2)
+    app.add_handler(TypeHandler(Update, track_chat_user), group=-1)
+    app.add_handler(InlineQueryHandler(inline_query))
+    
+    # Обработчики кнопок и текста
+    app.add_handler(CallbackQueryHandler(report_button, pattern=r"^rep_(ok|no)_\d+$"))
+    app.add_handler(CallbackQueryHandler(button_handler))
+    app.add_handler(MessageHandler(filters.TEXT & (~filters.COMMAND), handle_text))
+    app.add_handler(MessageHandler(filters.Document.ALL, handle_document))
+    return app
+
+def main(workers: int = BOT_WORKERS):
     """Основная функция запуска бота"""
     try:
-        print("Инициализация базы данных...")
-        init_db()
-        print("База данных инициализирована.")
-        
         token = os.getenv("BOT_TOKEN")
         if not token:
             raise SystemExit("❌ Установите переменную окружения BOT_TOKEN")
         
-        print("Создание приложения...")
-        app = Application.builder().token(token).build()
-        
-        # Команды
-        app.add_handler(CommandHandler("start", cmd_start))
-        app.add_handler(CommandHandler("menu", cmd_menu))
-        app.add_handler(CommandHandler("newtournament", cmd_new_tournament))
-        app.add_handler(CommandHandler("result", cmd_result))
+        if workers > 1:
+            # Воркеры стартуют на уже мигрированной базе
+            print("Инициализация базы данных...")
+            init_db()
+            print(f"Запуск приемника вебхука и {workers} воркеров...")
+            asyncio.run(run_ingress(token, workers))
+            return
         
-        # Обработчики кнопок и текста
-        app.add_handler(CallbackQueryHandler(button_handler))
-        app.add_handler(MessageHandler(filters.TEXT & (~filters.COMMAND), handle_text))
+        print("Создание приложения...")
+        app = build_application(token)
         
         print("Запуск бота...")
-        app.run_polling(drop_pending_updates=True)
+        asyncio.run(run_bot(app))
         
     except Exception as e:
         print(f"❌ Критическая ошибка запуска: {e}")
         raise
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    if "--bench-swiss" in sys.argv:
+        args = [a for a in sys.argv[1:] if a.isdigit()]
+        bench_swiss(int(args[0]) if args else 256)
+    elif "--profile-imports" in sys.argv:
+        profile_imports()
+    elif "--bench-startup" in sys.argv:
+        args = [a for a in sys.argv[1:] if a.isdigit()]
+        bench_startup(int(args[0]) if args else 50)
+    elif "--bench-workers" in sys.argv:
+        args = [a for a in sys.argv[1:] if a.isdigit()]
+        bench_workers(chats=int(args[0]) if args else 64)
+    elif "--workers" in sys.argv:
+        main(int(sys.argv[sys.argv.index("--workers") + 1]))
+    else:
+        main()
\ No newline at end of file